@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""compare image encodings for exported patches:
+bytes per patch, encoding and decoding time
+
+    bench_encoding.py data/fullsplit/all/*/*.png
+    bench_encoding.py --slide slide.svs --num 100 --side 512
+"""
+import sys
+import time
+import numpy as np
+from PIL import Image
+from slideslicer.encoding import ImageEncoding, decode_image
+
+DEFAULT_ENCODINGS = ['png', 'png:0', 'png:1', 'png:3', 'png:6', 'png:9',
+                     'webp', 'jpeg:95', 'jpeg:90', 'jpeg:75', 'raw']
+
+
+def read_slide_patches(fnsvs, num=100, side=512, level=0, seed=0):
+    "read random patches with at least some tissue from a slide"
+    import openslide
+    slide = openslide.OpenSlide(fnsvs)
+    w, h = slide.level_dimensions[level]
+    scale = slide.level_downsamples[level]
+    rng = np.random.RandomState(seed)
+    patches = []
+    for _ in range(50*num):
+        if len(patches) >= num:
+            break
+        x, y = rng.randint(0, w-side), rng.randint(0, h-side)
+        patch = np.asarray(slide.read_region((int(x*scale), int(y*scale)), level,
+                                             (side, side)))[..., :3]
+        # skip blank glass
+        if patch.mean() < 220:
+            patches.append(np.ascontiguousarray(patch))
+    return patches
+
+
+def benchmark(patches, encodings=DEFAULT_ENCODINGS, backend='cv2'):
+    results = []
+    for spec in encodings:
+        encoding = ImageEncoding.from_string(spec, backend=backend)
+        t0 = time.perf_counter()
+        blobs = [encoding.encode(pp) for pp in patches]
+        t1 = time.perf_counter()
+        decoded = [decode_image(bb, encoding.ext, backend=backend) for bb in blobs]
+        t2 = time.perf_counter()
+        err = np.mean([np.abs(dd.astype(float) - pp).mean() for dd, pp in zip(decoded, patches)])
+        results.append({'encoding': repr(encoding),
+                        'kbytes/patch': np.mean([len(bb) for bb in blobs]) / 1024,
+                        'encode ms': 1e3*(t1-t0)/len(patches),
+                        'decode ms': 1e3*(t2-t1)/len(patches),
+                        'mean abs err': err,
+                        })
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__,
+                        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('images', nargs='*', help='image patches to encode')
+    parser.add_argument('--slide', type=str, default=None,
+                        help='read random patches from this slide instead')
+    parser.add_argument('--num', type=int, default=100, help='number of patches to read from the slide')
+    parser.add_argument('--side', type=int, default=512, help='side of patches read from the slide')
+    parser.add_argument('--level', type=int, default=0, help='pyramid level of patches read from the slide')
+    parser.add_argument('--backend', type=str, default='cv2', help='cv2 or pil')
+    parser.add_argument('--encodings', nargs='+', default=DEFAULT_ENCODINGS)
+    prms = parser.parse_args()
+
+    if prms.slide is not None:
+        patches = read_slide_patches(prms.slide, num=prms.num, side=prms.side, level=prms.level)
+    else:
+        patches = [np.asarray(Image.open(fn).convert('RGB')) for fn in prms.images]
+    if len(patches) == 0:
+        parser.print_help()
+        sys.exit(1)
+
+    print('{} patches of shape {}'.format(len(patches), patches[0].shape))
+    results = benchmark(patches, encodings=prms.encodings, backend=prms.backend)
+    header = list(results[0].keys())
+    print(''.join('{:>14}'.format(hh) for hh in header))
+    for rr in results:
+        print('{:>14}'.format(rr['encoding']) +
+              ''.join('{:>14.2f}'.format(rr[hh]) for hh in header[1:]))
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""measure the import time of slideslicer modules in fresh interpreters
+and report which heavy dependencies they pull in
+
+    bench_import.py
+    bench_import.py --statement "from slideslicer import RoiReader" --repeats 10
+"""
+import sys
+import json
+import subprocess
+import numpy as np
+
+DEFAULT_STATEMENTS = ['import slideslicer',
+                      'from slideslicer.roi_reader import PatchIterator',
+                      'from slideslicer.sample_from_slide import save_tissue_chunks',
+                      ]
+HEAVY_MODULES = ['pandas', 'matplotlib', 'descartes', 'skimage', 'pycocotools']
+
+_TEMPLATE = '''
+import sys, time, json
+t0 = time.perf_counter()
+{statement}
+t1 = time.perf_counter()
+print(json.dumps({{"time": t1 - t0,
+                   "loaded": [mm for mm in {heavy!r} if mm in sys.modules]}}))
+'''
+
+
+def time_import(statement, repeats=5, heavy=HEAVY_MODULES):
+    "returns median import time in seconds and the heavy modules loaded"
+    times = []
+    for _ in range(repeats):
+        code = _TEMPLATE.format(statement=statement, heavy=heavy)
+        out = subprocess.run([sys.executable, '-c', code], check=True,
+                             stdout=subprocess.PIPE, universal_newlines=True).stdout
+        result = json.loads(out.strip().splitlines()[-1])
+        times.append(result['time'])
+    return float(np.median(times)), result['loaded']
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__,
+                        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--statement', nargs='+', default=DEFAULT_STATEMENTS,
+                        help='import statements to time')
+    parser.add_argument('--repeats', type=int, default=5)
+    prms = parser.parse_args()
+
+    for statement in prms.statement:
+        seconds, loaded = time_import(statement, repeats=prms.repeats)
+        print('{:>8.1f} ms\t{}\t[{}]'.format(1e3*seconds, statement, ', '.join(loaded)))
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""compare downsampling methods for patches read between pyramid levels:
+time per patch and agreement with exact area averaging (PSNR, dB)
+
+    bench_resample.py --slide slide.svs --num 50 --side 256 --factor 8
+    bench_resample.py --num 50 --side 256 --factor 4       # synthetic noise patches
+"""
+import time
+import numpy as np
+from PIL import Image
+from slideslicer.resample import resample, RESAMPLERS
+
+
+def read_slide_regions(fnsvs, num=50, side=256, factor=4, seed=0):
+    "read random RGBA level-0 regions that downsample to `side`"
+    import openslide
+    slide = openslide.OpenSlide(fnsvs)
+    w, h = slide.dimensions
+    rng = np.random.RandomState(seed)
+    size = side*factor
+    return [slide.read_region((rng.randint(0, w-size), rng.randint(0, h-size)), 0, (size, size))
+            for _ in range(num)]
+
+
+def psnr(a, b):
+    mse = np.mean((a.astype(float) - b.astype(float))**2)
+    return np.inf if mse == 0 else 10*np.log10(255**2 / mse)
+
+
+def benchmark(regions, side, methods=RESAMPLERS):
+    # exact area averaging in floating point as the reference
+    references = []
+    for reg in regions:
+        arr = np.asarray(reg)[..., :3].astype(float)
+        ff = arr.shape[0] // side
+        references.append(arr.reshape(side, ff, side, ff, 3).mean((1, 3)))
+    results = []
+    for method in methods:
+        t0 = time.perf_counter()
+        outputs = [resample(reg, (side, side), method=method) for reg in regions]
+        t1 = time.perf_counter()
+        results.append({'method': method,
+                        'ms/patch': 1e3*(t1-t0)/len(regions),
+                        'PSNR': np.mean([psnr(oo, rr) for oo, rr in zip(outputs, references)]),
+                        })
+    # the previous path: PIL RGBA resize with the Lanczos (`ANTIALIAS`) filter and conversion
+    t0 = time.perf_counter()
+    outputs = [np.asarray(reg.resize((side, side), Image.LANCZOS))[..., :3] for reg in regions]
+    t1 = time.perf_counter()
+    results.append({'method': 'legacy',
+                    'ms/patch': 1e3*(t1-t0)/len(regions),
+                    'PSNR': np.mean([psnr(oo, rr) for oo, rr in zip(outputs, references)]),
+                    })
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__,
+                        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--slide', type=str, default=None, help='read regions from this slide')
+    parser.add_argument('--num', type=int, default=50, help='number of patches')
+    parser.add_argument('--side', type=int, default=256, help='side of downsampled patches')
+    parser.add_argument('--factor', type=int, default=4, help='downsampling factor')
+    prms = parser.parse_args()
+
+    if prms.slide is not None:
+        regions = read_slide_regions(prms.slide, num=prms.num, side=prms.side, factor=prms.factor)
+    else:
+        rng = np.random.RandomState(0)
+        size = prms.side*prms.factor
+        regions = [Image.fromarray(rng.randint(0, 256, size=(size, size, 4), dtype=np.uint8), 'RGBA')
+                   for _ in range(prms.num)]
+
+    print('{} regions of {} px downsampled {}x'.format(len(regions), regions[0].size, prms.factor))
+    print('{:>10}{:>12}{:>10}'.format('method', 'ms/patch', 'PSNR'))
+    for rr in benchmark(regions, prms.side):
+        print('{:>10}{:>12.2f}{:>10.1f}'.format(rr['method'], rr['ms/patch'], rr['PSNR']))
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""compare read orders of `PatchIterator`: none, local (space-filling curve buckets), full shuffle
+
+Reads the patches through one slide handle per order (so that the tile cache
+of OpenSlide starts cold and is kept across batches) and reports the patch throughput,
+next to the hit rate of a simulated LRU cache of slide tiles:
+
+    bench_shuffle.py slide.svs --side 256 --subsample 4 --cache-tiles 512
+"""
+import time
+from collections import OrderedDict
+import numpy as np
+from slideslicer.roi_reader import RoiReader, PatchIterator
+from slideslicer.slideutils import sample_points
+
+
+def tile_hit_rate(points, patch_size, tile_size=240, cache_tiles=1024):
+    """fraction of slide tiles covered by patches centred at `points`
+    found in an LRU cache of `cache_tiles` tiles"""
+    cache = OrderedDict()
+    hits, total = 0, 0
+    half = patch_size // 2
+    for xc, yc in points:
+        x0, y0 = int(xc - half) // tile_size, int(yc - half) // tile_size
+        x1, y1 = int(xc + half - 1) // tile_size, int(yc + half - 1) // tile_size
+        for tx in range(x0, x1 + 1):
+            for ty in range(y0, y1 + 1):
+                total += 1
+                if (tx, ty) in cache:
+                    hits += 1
+                    cache.move_to_end((tx, ty))
+                else:
+                    cache[(tx, ty)] = True
+                    if len(cache) > cache_tiles:
+                        cache.popitem(last=False)
+    return hits / max(total, 1)
+
+
+def mean_step(points):
+    "mean distance between consecutive points"
+    return np.sqrt((np.diff(points, axis=0)**2).sum(1)).mean()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__,
+                        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('slide', type=str)
+    parser.add_argument('--side', type=int, default=256, help='side of the patches (output pixels)')
+    parser.add_argument('--subsample', type=int, default=4)
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--bucket-size', type=int, default=None)
+    parser.add_argument('--curve', type=str, default='hilbert', help='hilbert or zorder')
+    parser.add_argument('--tile-size', type=int, default=240, help='slide tile side (level-0 pixels)')
+    parser.add_argument('--cache-tiles', type=int, default=1024, help='capacity of the simulated tile cache')
+    parser.add_argument('--no-read', action='store_true', default=False,
+                        help='only simulate the tile cache, do not read patches')
+    parser.add_argument('--max-batches', type=int, default=50)
+    prms = parser.parse_args()
+
+    reader = RoiReader(prms.slide, save=False, verbose=False)
+    side_magn = prms.side * prms.subsample
+    points = np.concatenate([sample_points(roi['vertices'], spacing=side_magn)
+                             for roi in reader.tissue_rois])
+    print('{} points'.format(len(points)))
+
+    print('{:>8}{:>14}{:>14}{:>14}'.format('shuffle', 'mean step', 'tile hits', 'patches/s'))
+    for shuffle in [False, 'local', 'full']:
+        it = PatchIterator(reader, points=points, side=prms.side, subsample=prms.subsample,
+                           batch_size=prms.batch_size, shuffle=shuffle, seed=0,
+                           bucket_size=prms.bucket_size, curve=prms.curve)
+        ordered = np.asarray(it.points)[it.indices]
+        hit_rate = tile_hit_rate(ordered, side_magn, tile_size=prms.tile_size,
+                                 cache_tiles=prms.cache_tiles)
+        rate = np.nan
+        if not prms.no_read:
+            # a fresh handle, so that every order starts with a cold tile cache
+            reader.close()
+            nbatches = min(len(it), prms.max_batches)
+            t0 = time.perf_counter()
+            for ii in range(nbatches):
+                it[ii]
+            rate = nbatches * prms.batch_size / (time.perf_counter() - t0)
+        print('{:>8}{:>14.1f}{:>14.3f}{:>14.1f}'.format(str(shuffle), mean_step(ordered)/side_magn,
+                                                        hit_rate, rate))
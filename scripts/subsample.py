@@ -5,6 +5,7 @@ import json
 import numpy as np
 from PIL import Image
 from pycocotools.mask import encode, decode
+from slideslicer.encoding import ImageEncoding
 
 def get_outfile(infile, outdir):
     outfile = os.path.basename(infile)
@@ -91,6 +92,12 @@ if __name__ == '__main__':
       help='Original side (in pixels) of the image patches')
 
 
+    parser.add_argument(
+      '--encoding',
+      type=str,
+      default='png',
+      help='image encoding: png[:level], webp (lossless), jpeg[:quality], or raw (npy)')
+
     parser.add_argument('--img', dest='img', action='store_true')
     parser.add_argument('--no-img', dest='img', action='store_false')
     parser.set_defaults(img=True)
@@ -132,6 +139,7 @@ if __name__ == '__main__':
     
     if prms.img:
         print("SUBSAMPLING IMAGES")
+        encoding = ImageEncoding.from_string(prms.encoding)
         for infile in filegen(prms.indir):
             outfile = get_outfile(infile, outdir=outdir)
             os.makedirs(os.path.dirname(outfile), exist_ok=True)
@@ -139,7 +147,7 @@ if __name__ == '__main__':
                 try:
                     im = Image.open(infile)
                     im.thumbnail(size, Image.ANTIALIAS)
-                    im.save(outfile, "png")
+                    encoding.save(im, os.path.splitext(outfile)[0])
                 except IOError as ee:
                     print( "cannot create thumbnail for '%s'" % infile)
                     print(ee)
@@ -1,7 +1,45 @@
+# submodules are imported on first attribute access (PEP 562),
+# so that `import slideslicer.roi_reader` in data loader workers
+# does not pull in all of the package and its plotting dependencies
+import importlib
 
-from .slideutils import *
-from .roi_reader import *
-from .sample_from_slide import *
-from .geom_tools import *
-from . import parse_leica_xml as leica
-from . import cocohacks as coco
+_STAR_MODULES = ('slideutils', 'roi_reader', 'sample_from_slide', 'geom_tools')
+_ALIASES = {'leica': 'parse_leica_xml',
+            'coco': 'cocohacks',
+            }
+
+
+def _star_names_():
+    "public names of the star modules, as `from .module import *` exported them"
+    names = list(_ALIASES)
+    for modname in _STAR_MODULES:
+        module = importlib.import_module('.' + modname, __name__)
+        public = getattr(module, '__all__', None)
+        if public is None:
+            public = [nn for nn in vars(module) if not nn.startswith('_')]
+        names += [nn for nn in public if nn not in names]
+    return names
+
+
+def __getattr__(name):
+    if name == '__all__':
+        # computed on `from slideslicer import *` only, which imports the star modules
+        value = _star_names_()
+        globals()[name] = value
+        return value
+    if name in _ALIASES:
+        module = importlib.import_module('.' + _ALIASES[name], __name__)
+        globals()[name] = module
+        return module
+    if not name.startswith('_'):
+        for modname in _STAR_MODULES:
+            module = importlib.import_module('.' + modname, __name__)
+            if hasattr(module, name):
+                value = getattr(module, name)
+                globals()[name] = value
+                return value
+    raise AttributeError('module {} has no attribute {}'.format(__name__, name))
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_ALIASES))
@@ -0,0 +1,118 @@
+# coding: utf-8
+"""geometric augmentation from one oversized read
+
+Instead of rotating patches after they are read (which leaves empty corners),
+a region larger by a factor of √2 (plus the translation jitter) is read once
+and several rotated / flipped / shifted crops are cut out of it with `cv2.warpAffine`,
+as `CropRotateRoi` does for ROIs. The same affine matrices are applied
+to ROI masks (nearest neighbour) and to ROI polygons, so one slide read
+feeds `num_crops` training samples:
+
+    augment = Augmentation(num_crops=4, max_angle=180, flip=True, jitter=0.05, seed=0)
+    it = PatchIterator(reader, points=points, side=256, subsample=4, augment=augment)
+    batch_x, coords = it[0]     # batch_size * num_crops patches
+"""
+import numpy as np
+import cv2
+from shapely import affinity
+from shapely.geometry import box, Polygon, MultiPolygon
+
+INTERPOLATIONS = {'nearest': cv2.INTER_NEAREST,
+                  'linear': cv2.INTER_LINEAR,
+                  'cubic': cv2.INTER_CUBIC,
+                  }
+
+
+class Augmentation():
+    def __init__(self, num_crops=4, max_angle=180, flip=True, jitter=0.0,
+                 interpolation='linear', border_value=(255, 255, 255), seed=None):
+        """
+        Inputs:
+        num_crops     -- crops cut from every read region
+        max_angle     -- rotation angles are drawn uniformly from `[-max_angle, max_angle]` degrees
+        flip          -- flip half of the crops horizontally
+        jitter        -- maximal shift of the crop centre as a fraction of the patch side
+        interpolation -- `nearest`, `linear`, or `cubic` (for images; masks use `nearest`)
+        border_value  -- fill colour outside of the slide
+        seed          -- base random seed; batch `k` of epoch `n` is augmented with a generator
+                         seeded by `(seed, n, k)`, so that results do not depend on worker order
+        """
+        self.num_crops = num_crops
+        self.max_angle = max_angle
+        self.flip = flip
+        self.jitter = jitter
+        self.interpolation = INTERPOLATIONS[interpolation]
+        self.border_value = tuple(border_value)
+        self.seed = seed
+
+    def get_rng(self, key=None, epoch=0):
+        if self.seed is None:
+            return np.random.RandomState()
+        return np.random.RandomState([self.seed, epoch] + ([] if key is None else [key]))
+
+    def margin_side(self, side):
+        "side of the region to read so that any rotated and shifted crop lies within it"
+        big_side = int(np.ceil(side*np.sqrt(2) + 2*np.sqrt(2)*self.jitter*side)) + 2
+        # keep the margins even, so that the crop centre falls on the read centre
+        return big_side + (big_side - side) % 2
+
+    def sample_matrices(self, side, big_side, rng):
+        """draw `num_crops` affine `[2 x 3]` matrices mapping pixels of a
+        `big_side x big_side` region onto `side x side` crops"""
+        matrices = np.empty((self.num_crops, 2, 3))
+        # pixel centres are at integer coordinates in `cv2.warpAffine`
+        centre_big = np.r_[big_side, big_side] / 2 - 0.5
+        centre_out = np.r_[side, side] / 2 - 0.5
+        for kk in range(self.num_crops):
+            angle = np.deg2rad(rng.uniform(-self.max_angle, self.max_angle))
+            cos, sin = np.cos(angle), np.sin(angle)
+            linear = np.array([[cos, sin], [-sin, cos]])
+            if self.flip and rng.rand() < 0.5:
+                linear = linear.dot(np.diag([-1, 1]))
+            shift = rng.uniform(-self.jitter, self.jitter, size=2) * side
+            matrices[kk, :, :2] = linear
+            matrices[kk, :, 2] = centre_out - linear.dot(centre_big + shift)
+        return matrices
+
+    def apply_img(self, img, matrices, side, out=None, interpolation=None, border_value=None):
+        """warp an image with every matrix into `[K x side x side (x C)]`;
+        `out` may be a preallocated (contiguous) array of that shape"""
+        img = np.ascontiguousarray(img)
+        if out is None:
+            out = np.empty((len(matrices), side, side) + img.shape[2:], dtype=img.dtype)
+        interpolation = self.interpolation if interpolation is None else interpolation
+        border_value = self.border_value if border_value is None else border_value
+        for kk, matrix in enumerate(matrices):
+            cv2.warpAffine(img, matrix, (side, side), dst=out[kk],
+                           flags=interpolation,
+                           borderMode=cv2.BORDER_CONSTANT, borderValue=border_value)
+        return out
+
+    def apply_mask(self, mask, matrices, side):
+        "warp a mask with every matrix (nearest neighbour, zero outside)"
+        return self.apply_img(mask, matrices, side,
+                              interpolation=cv2.INTER_NEAREST, border_value=0)
+
+    def apply_rois(self, df, matrices, side):
+        """transform ROI polygons of a data frame (e.g. from `RoiReader.get_patch_rois`)
+        with every matrix and clip them to the crop; returns a list of data frames"""
+        window = box(0, 0, side, side)
+        out = []
+        for matrix in matrices:
+            coefs = [matrix[0, 0], matrix[0, 1], matrix[1, 0], matrix[1, 1],
+                     matrix[0, 2], matrix[1, 2]]
+            dfk = df.copy()
+            if len(dfk) == 0:
+                out.append(dfk)
+                continue
+            polygons = dfk['polygon'].map(lambda p: affinity.affine_transform(p, coefs) & window)
+            keep = polygons.map(lambda p: isinstance(p, (Polygon, MultiPolygon)) and p.area > 0)
+            dfk = dfk[keep.values].copy()
+            dfk['polygon'] = polygons[keep.values]
+            dfk['area'] = dfk['polygon'].map(lambda p: p.area)
+            dfk['area_fraction'] = dfk['area'] / side**2
+            dfk['vertices'] = dfk['polygon'].map(
+                lambda p: np.asarray(p.exterior.coords if isinstance(p, Polygon)
+                                     else max(p.geoms, key=lambda g: g.area).exterior.coords).tolist())
+            out.append(dfk)
+        return out
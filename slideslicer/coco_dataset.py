@@ -0,0 +1,350 @@
+# coding: utf-8
+"""streaming MS-COCO dataset files
+
+Instead of one JSON file per patch, `CocoDatasetWriter` appends images and
+their annotations into a single dataset file per split, assigning
+sequential image and annotation ids. Two layouts are supported:
+
+    json   -- a regular COCO file readable by `pycocotools.coco.COCO`:
+              {"annotations": [...], "images": [...], "categories": [...]}
+              (images are spooled to a temporary file while annotations are written)
+    jsonl  -- one line per image: {"image": {...}, "annotations": [...]}
+
+Next to the dataset file two sidecars are written:
+
+    {fn}.idx.npy    -- a structured array with a row per image:
+                       image_id, image_offset, image_size, ann_offset, ann_size, ann_count
+                       (byte ranges of the image record and of its annotations)
+    {fn}.meta.json  -- format, categories, and counts
+
+Memory use of the writer does not grow with the number of annotations.
+`LazyCocoDataset` memory-maps the dataset and the index and parses only
+the records that are requested.
+"""
+import os
+import json
+import mmap
+import tempfile
+from array import array
+from collections import OrderedDict
+import numpy as np
+
+INDEX_DTYPE = np.dtype([('image_id', '<i8'),
+                        ('image_offset', '<i8'),
+                        ('image_size', '<i8'),
+                        ('ann_offset', '<i8'),
+                        ('ann_size', '<i8'),
+                        ('ann_count', '<i8'),
+                        ])
+
+
+def get_index_filename(fn):
+    return fn + '.idx.npy'
+
+
+def get_meta_filename(fn):
+    return fn + '.meta.json'
+
+
+def _dumps_(obj):
+    # ASCII-only output keeps byte and character offsets equal
+    return json.dumps(obj, ensure_ascii=True).encode('ascii')
+
+
+class CocoDatasetWriter():
+    """write a COCO dataset incrementally
+
+    Usage:
+
+        with CocoDatasetWriter('train.json', categories=CATEGORY_LOOKUP) as dataset:
+            for ...:
+                filename, json_ = process_patch(rois, start_xy, img_size)
+                dataset.add(json_['images'], json_['annotations'])
+    """
+    def __init__(self, fn, categories=None, format=None,
+                 start_image_id=1, start_annotation_id=1):
+        """
+        Inputs:
+        fn          -- output file name
+        categories  -- mapping from category names to ids, or a list of names;
+                       unseen categories are assigned new ids as they come
+        format      -- `json` or `jsonl`; by default inferred from the file extension
+        """
+        self.fn = fn
+        if format is None:
+            format = 'jsonl' if fn.endswith('.jsonl') else 'json'
+        if format not in ('json', 'jsonl'):
+            raise ValueError('unknown format: %s' % format)
+        self.format = format
+
+        if isinstance(categories, (list, tuple)):
+            categories = {name: ii+1 for ii, name in enumerate(categories)}
+        self.categories = OrderedDict(categories or {})
+        self.next_image_id = start_image_id
+        self.next_annotation_id = start_annotation_id
+        self.num_images = 0
+        self.num_annotations = 0
+        self._index = array('q')
+
+        dirname = os.path.dirname(fn)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self._fh = open(fn, 'wb')
+        self._offset = 0
+        if self.format == 'json':
+            self._write_(b'{"annotations": [\n')
+            self._spool = tempfile.TemporaryFile('w+b', dir=dirname or None)
+            self._spool_offset = 0
+
+    def _write_(self, data):
+        self._fh.write(data)
+        self._offset += len(data)
+
+    def _get_category_id_(self, ann):
+        category_id = ann.get('category_id')
+        name = ann.get('category_name')
+        if isinstance(category_id, (int, np.integer)):
+            if name is None:
+                return int(category_id)
+            if name not in self.categories and int(category_id) not in self.categories.values():
+                self.categories[name] = int(category_id)
+        elif name is None:
+            name = category_id
+        if name not in self.categories:
+            # the id of a new name is taken by another category
+            self.categories[name] = 1 + max(self.categories.values(), default=0)
+        return self.categories[name]
+
+    def add(self, image, annotations=()):
+        """append an image record and its annotations;
+        overrides `id` of the image and `id`, `image_id` of the annotations.
+        Returns the assigned image id"""
+        image_id = self.next_image_id
+        self.next_image_id += 1
+        image = dict(image, id=image_id)
+
+        anns = []
+        for ann in annotations:
+            ann = dict(ann, id=self.next_annotation_id, image_id=image_id)
+            ann['category_id'] = self._get_category_id_(ann)
+            self.next_annotation_id += 1
+            anns.append(ann)
+
+        if self.format == 'jsonl':
+            line = _dumps_({'image': image, 'annotations': anns})
+            offset = self._offset
+            self._write_(line + b'\n')
+            self._index.extend([image_id, offset, len(line), offset, len(line), len(anns)])
+        else:
+            ann_offset = self._offset
+            for nn, ann in enumerate(anns):
+                if self.num_annotations + nn > 0:
+                    self._write_(b',\n')
+                if nn == 0:
+                    ann_offset = self._offset
+                self._write_(_dumps_(ann))
+            ann_size = self._offset - ann_offset if anns else 0
+
+            if self.num_images > 0:
+                self._spool.write(b',\n')
+                self._spool_offset += 2
+            record = _dumps_(image)
+            # image offsets are relative to the spool until `close`
+            self._index.extend([image_id, self._spool_offset, len(record),
+                                ann_offset, ann_size, len(anns)])
+            self._spool.write(record)
+            self._spool_offset += len(record)
+
+        self.num_annotations += len(anns)
+        self.num_images += 1
+        return image_id
+
+    @property
+    def categories_list(self):
+        return [{'id': cid, 'name': name} for name, cid in self.categories.items()]
+
+    def close(self):
+        if self._fh is None:
+            return
+        index = np.frombuffer(self._index.tobytes(), dtype=INDEX_DTYPE).copy()
+        if self.format == 'json':
+            self._write_(b'\n],\n"images": [\n')
+            index['image_offset'] += self._offset
+            self._spool.seek(0)
+            while True:
+                chunk = self._spool.read(1 << 20)
+                if not chunk:
+                    break
+                self._write_(chunk)
+            self._spool.close()
+            self._write_(b'\n],\n"categories": ')
+            self._write_(_dumps_(self.categories_list))
+            self._write_(b'}\n')
+        self._fh.close()
+        self._fh = None
+
+        np.save(get_index_filename(self.fn), index)
+        with open(get_meta_filename(self.fn), 'w') as fh:
+            json.dump({'format': self.format,
+                       'categories': self.categories_list,
+                       'num_images': self.num_images,
+                       'num_annotations': self.num_annotations,
+                       }, fh)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_coco_meta(fn):
+    with open(get_meta_filename(fn)) as fh:
+        return json.load(fh)
+
+
+def iter_coco_records(fn):
+    """stream `(image, annotations)` pairs from a dataset written by `CocoDatasetWriter`"""
+    meta = read_coco_meta(fn)
+    index = np.load(get_index_filename(fn), mmap_mode='r')
+    with open(fn, 'rb') as fh:
+        if meta['format'] == 'jsonl':
+            for line in fh:
+                record = json.loads(line)
+                yield record['image'], record['annotations']
+            return
+        for row in index:
+            fh.seek(row['image_offset'])
+            image = json.loads(fh.read(row['image_size']))
+            if row['ann_count'] > 0:
+                fh.seek(row['ann_offset'])
+                anns = json.loads(b'[' + fh.read(row['ann_size']) + b']')
+            else:
+                anns = []
+            yield image, anns
+
+
+class LazyCocoDataset():
+    """random access to a dataset written by `CocoDatasetWriter`
+    without loading it: both the dataset file and its index are memory-mapped,
+    and only the byte ranges of the requested images and annotations are parsed.
+
+    Usage:
+
+        dataset = LazyCocoDataset('train.json')
+        image, anns = dataset[0]
+        batch = dataset.load_batch(dataset.image_ids[:32])
+    """
+    def __init__(self, fn):
+        self.fn = fn
+        meta = read_coco_meta(fn)
+        self.format = meta['format']
+        self.categories = meta['categories']
+        self.index = np.load(get_index_filename(fn), mmap_mode='r')
+        self._pid = None
+
+    @property
+    def _data(self):
+        # (re)map lazily and per process, so that the object can be passed to loader workers
+        if self._pid != os.getpid():
+            with open(self.fn, 'rb') as fh:
+                self._mmap = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            self._pid = os.getpid()
+        return self._mmap
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_mmap', None)
+        state['_pid'] = None
+        return state
+
+    @property
+    def image_ids(self):
+        return self.index['image_id']
+
+    def __len__(self):
+        return len(self.index)
+
+    def _row_(self, image_id):
+        ids = self.index['image_id']
+        # ids assigned by the writer are sorted
+        pos = np.searchsorted(ids, image_id)
+        if pos >= len(ids) or ids[pos] != image_id:
+            raise KeyError(image_id)
+        return self.index[pos]
+
+    def _parse_(self, row):
+        data = self._data
+        if self.format == 'jsonl':
+            start = row['image_offset']
+            record = json.loads(data[start:start + row['image_size']])
+            return record['image'], record['annotations']
+        start = row['image_offset']
+        image = json.loads(data[start:start + row['image_size']])
+        if row['ann_count'] == 0:
+            return image, []
+        start = row['ann_offset']
+        anns = json.loads(b'[' + data[start:start + row['ann_size']] + b']')
+        return image, anns
+
+    def __getitem__(self, key):
+        "returns `(image, annotations)` for a position in the dataset"
+        return self._parse_(self.index[key])
+
+    def get_image(self, image_id):
+        return self._parse_(self._row_(image_id))[0]
+
+    def get_annotations(self, image_id):
+        return self._parse_(self._row_(image_id))[1]
+
+    def load_batch(self, image_ids):
+        "returns lists of image records and of their annotation lists"
+        records = [self._parse_(self._row_(image_id)) for image_id in image_ids]
+        return [rr[0] for rr in records], [rr[1] for rr in records]
+
+    def get_masks(self, image_id, category_ids=None):
+        """decode RLE masks of an image into a `[height x width x n]` uint8 array
+        (requires annotations saved with `rle=True`)"""
+        from pycocotools.mask import decode
+        image, anns = self._parse_(self._row_(image_id))
+        if category_ids is not None:
+            anns = [ann for ann in anns if ann['category_id'] in category_ids]
+        if len(anns) == 0:
+            return np.zeros((image['height'], image['width'], 0), dtype=np.uint8)
+        rles = [{'size': ann['size'], 'counts': ann['counts']} for ann in anns]
+        return decode(rles)
+
+    def __iter__(self):
+        for row in self.index:
+            yield self._parse_(row)
+
+
+def merge_coco_datasets(inputs, fnout, format=None):
+    """merge datasets written by `CocoDatasetWriter` (e.g. one per slide)
+    into a single dataset, re-assigning image and annotation ids in input order;
+    categories are matched by name and numbered in order of first appearance"""
+    categories = OrderedDict()
+    for fn in inputs:
+        for cat in read_coco_meta(fn)['categories']:
+            categories.setdefault(cat['name'], len(categories) + 1)
+    with CocoDatasetWriter(fnout, categories=categories, format=format) as dataset:
+        for fn in inputs:
+            id2name = {cat['id']: cat['name'] for cat in read_coco_meta(fn)['categories']}
+            for image, anns in iter_coco_records(fn):
+                for ann in anns:
+                    name = id2name.get(ann['category_id'], ann.get('category_name'))
+                    ann['category_id'] = categories[name]
+                dataset.add(image, anns)
+    return fnout
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='merge per-slide COCO datasets into one dataset per split')
+    parser.add_argument('output', type=str, help='output `.json` or `.jsonl` file')
+    parser.add_argument('inputs', nargs='+', type=str,
+                        help='datasets written by `CocoDatasetWriter`')
+    prms = parser.parse_args()
+    print(merge_coco_datasets(sorted(prms.inputs), prms.output))
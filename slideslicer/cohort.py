@@ -0,0 +1,157 @@
+# coding: utf-8
+"""cohort-level ingestion of slide annotations
+
+Parsed and validated ROIs are cached on disk under a key made of
+the SHA-1 of the annotation XML content, the slide file name and size,
+and the ROI extraction parameters:
+
+    {cache_dir}/{key[:2]}/{key}.json
+
+`RoiReader(..., cache_dir=cache_dir)` and `extract_rois_svs_xml(..., cache_dir=cache_dir)`
+look up this cache before parsing the XML, so that re-running a pipeline
+on an unchanged cohort skips XML parsing and tissue extraction.
+The two extract tissue differently and are cached under different keys;
+the cache can be pre-filled for both (e.g. for `sample_from_slide --roi-cache`)
+for a whole cohort in parallel:
+
+    python -m slideslicer.cohort --cache-dir roi-cache --processes 16 slides/*.svs
+"""
+import os
+import sys
+import json
+import hashlib
+import tempfile
+import numpy as np
+from warnings import warn
+
+
+def hash_file(fn, blocksize=1 << 20):
+    "SHA-1 of the file content"
+    sha = hashlib.sha1()
+    with open(fn, 'rb') as fh:
+        while True:
+            block = fh.read(blocksize)
+            if not block:
+                break
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def validate_rois(rois):
+    """drop ROIs without vertices or with non-finite coordinates
+    and convert vertices to lists"""
+    valid = []
+    for roi in rois:
+        verts = np.asarray(roi.get('vertices', []), dtype=float)
+        if verts.size == 0 or not np.isfinite(verts).all():
+            warn('skipping invalid ROI:\t{} #{}'.format(roi.get('name'), roi.get('id')))
+            continue
+        roi = dict(roi)
+        roi['vertices'] = verts.tolist()
+        valid.append(roi)
+    return valid
+
+
+class _NumpyEncoder_(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, np.ndarray):
+            return obj.tolist()
+        if isinstance(obj, np.generic):
+            return obj.item()
+        return json.JSONEncoder.default(self, obj)
+
+
+class RoiCache():
+    """a directory of parsed ROI lists keyed by annotation content"""
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def get_key(self, fnxml, fnslide=None, **params):
+        """key from the XML content hash, the slide name and size (if given),
+        and extraction parameters"""
+        sha = hashlib.sha1(hash_file(fnxml).encode())
+        if fnslide is not None:
+            sha.update(os.path.basename(fnslide).encode())
+            sha.update(str(os.path.getsize(fnslide)).encode())
+        sha.update(json.dumps(params, sort_keys=True, default=str).encode())
+        return sha.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.json')
+
+    def __contains__(self, key):
+        return os.path.exists(self.path(key))
+
+    def get(self, key):
+        "returns the cached list of ROIs or `None`"
+        try:
+            with open(self.path(key)) as fh:
+                return json.load(fh)['rois']
+        except (IOError, ValueError, KeyError):
+            return None
+
+    def put(self, key, rois, **info):
+        "atomically store a list of ROIs with optional extra `info`"
+        fn = self.path(key)
+        os.makedirs(os.path.dirname(fn), exist_ok=True)
+        fd, fntmp = tempfile.mkstemp(dir=os.path.dirname(fn), suffix='.tmp')
+        with os.fdopen(fd, 'w') as fh:
+            json.dump(dict(info, rois=rois), fh, cls=_NumpyEncoder_)
+        os.replace(fntmp, fn)
+        return fn
+
+
+def _ingest_slide_(args):
+    fnslide, cache_dir, kwargs = args
+    from .roi_reader import RoiReader
+    from .extract_rois_svs_xml import get_cached_rois
+    try:
+        reader = RoiReader(fnslide, cache_dir=cache_dir, save=False, verbose=False, **kwargs)
+        # the keys of `extract_rois_svs_xml`, which expects the slide next to the XML
+        if reader.fnxml.endswith('.xml') and os.path.exists(reader.fnxml[:-len('.xml')] + '.svs'):
+            get_cached_rois(reader.fnxml, cache_dir,
+                            remove_empty=kwargs.get('remove_empty', True),
+                            minlen=kwargs.get('minlen', 50))
+        return fnslide, len(reader), None
+    except Exception as ee:
+        return fnslide, 0, repr(ee)
+
+
+def ingest_cohort(slides, cache_dir, processes=None, **kwargs):
+    """parse annotations and extract tissue ROIs of all `slides` in parallel
+    and store them in the ROI cache, under the keys of both `RoiReader`
+    and `extract_rois_svs_xml` (for `.svs` slides).
+    Keyword arguments are passed to `RoiReader`.
+    Returns a list of `(slide, number of ROIs, error or None)`"""
+    from multiprocessing import Pool
+    tasks = [(fn, cache_dir, kwargs) for fn in slides]
+    results = []
+    with Pool(processes) as pool:
+        for fnslide, nrois, error in pool.imap_unordered(_ingest_slide_, tasks):
+            if error is None:
+                print(fnslide, nrois, sep='\t')
+            else:
+                print(fnslide, error, sep='\t', file=sys.stderr)
+            results.append((fnslide, nrois, error))
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='parse annotations of a cohort of slides in parallel and cache the ROIs')
+    parser.add_argument('slides', nargs='+', type=str, help='slide files (annotations are expected next to them)')
+    parser.add_argument('--cache-dir', type=str, required=True, help='ROI cache directory')
+    parser.add_argument('--processes', type=int, default=None, help='number of processes (default: all cores)')
+    parser.add_argument('--keep-empty', action='store_true', default=False,
+                        help='keep empty tissue chunks (with no annotations within)')
+    parser.add_argument('--minlen', type=int, default=50,
+                        help='minimal length of tissue chunk contour in thumbnail image')
+    prms = parser.parse_args()
+
+    results = ingest_cohort(prms.slides, prms.cache_dir, processes=prms.processes,
+                            remove_empty=not prms.keep_empty, minlen=prms.minlen)
+    nfailed = sum(1 for rr in results if rr[2] is not None)
+    print('{} slides ingested, {} failed'.format(len(results) - nfailed, nfailed), file=sys.stderr)
@@ -0,0 +1,339 @@
+# coding: utf-8
+"""tissue-compacted slide export
+
+Tissue chunks (`RoiReader.tissue_rois`) usually cover a small part of a slide.
+`compact_slide` cuts every chunk (with a margin), optionally straightens it with
+the `CropRotateRoi` transform, packs the chunks into a dense canvas with a shelf
+packing, and writes the canvas as a tiled pyramid (see `slideslicer.pyramid`).
+Chunks are copied tile by tile, so memory use does not depend on the slide size.
+A sidecar `{fn}.mapping.json` holds, for every chunk, the affine matrix
+from level-0 slide coordinates into the compact image,
+and the annotations transformed into compact coordinates.
+
+`CompactSlide` opens the compact image with the interface of `openslide.OpenSlide`
+in the coordinates of the original slide: `read_region` maps the requested region
+onto the chunks that cover it and reads only the compact image,
+so that existing code keeps working with original coordinates:
+
+    python -m slideslicer.compact slide.svs slide-compact.tif --straighten
+
+    slide = CompactSlide('slide-compact.tif')
+    region = slide.read_region((x, y), 1, (512, 512))   # original level-0 location
+    xy_compact = slide.to_compact(xy)
+    xy = slide.to_original(xy_compact)
+"""
+import sys
+import json
+import tempfile
+import numpy as np
+import cv2
+from PIL import Image
+from shapely.geometry import Polygon, Point
+from .slideutils import CropRotateRoi, rotate_region_tiled, get_contour_centre
+from .pyramid import write_pyramid, PyramidReader
+
+# white and transparent outside of the chunks
+BACKGROUND = (255, 255, 255, 0)
+
+
+def get_mapping_filename(fn):
+    return fn + '.mapping.json'
+
+
+def pack_shelves(sizes, align=16, spacing=0, width=None):
+    """place rectangles of `sizes` `[(w, h), ...]` on shelves of a canvas, tallest first;
+    positions are multiples of `align`. The canvas width defaults to the side of a square
+    of the total area (or the widest rectangle).
+    Returns positions `[N x 2]` `(x, y)` and the canvas size `(width, height)`"""
+    def up(x):
+        return int(-(-x // align) * align)
+
+    sizes = [(up(w + spacing), up(h + spacing)) for w, h in sizes]
+    if width is None:
+        area = sum(w*h for w, h in sizes)
+        width = max([up(np.sqrt(area))] + [w for w, _ in sizes])
+    positions = np.zeros((len(sizes), 2), dtype=int)
+    x = y = shelf = 0
+    for ii in sorted(range(len(sizes)), key=lambda ii: (-sizes[ii][1], ii)):
+        w, h = sizes[ii]
+        if x + w > width:
+            x, y, shelf = 0, y + shelf, 0
+        positions[ii] = x, y
+        x += w
+        shelf = max(shelf, h)
+    return positions, (int(width), int(y + shelf))
+
+
+def _copy_region_tiled_(slide, start, size, out, tile_size=2048):
+    "copy a level-0 region of a slide into an RGBA array, tile by tile"
+    width, height = size
+    for y0 in range(0, height, tile_size):
+        for x0 in range(0, width, tile_size):
+            tw, th = min(tile_size, width - x0), min(tile_size, height - y0)
+            out[y0:y0+th, x0:x0+tw] = np.asarray(
+                slide.read_region((int(start[0] + x0), int(start[1] + y0)), 0, (tw, th)))
+
+
+def _chunk_contour_(vertices, margin):
+    "the chunk outline grown by `margin` level-0 pixels"
+    polygon = Polygon(vertices)
+    if not polygon.is_valid:
+        polygon = polygon.buffer(0)
+    if margin:
+        polygon = polygon.buffer(margin)
+    if polygon.geom_type != 'Polygon':
+        polygon = polygon.convex_hull
+    return np.asarray(polygon.exterior.coords)
+
+
+def _affine_(matrix, xy):
+    xy = np.asarray(xy, dtype=float)
+    return xy.dot(np.asarray(matrix)[:, :2].T) + np.asarray(matrix)[:, 2]
+
+
+def _full_(matrix):
+    return CropRotateRoi._pad_affine_matrix_(np.asarray(matrix, dtype=float))
+
+
+def compact_slide(reader, fn, straighten=False, margin=64, align=16, spacing=16,
+                  tile_size=256, layout='auto', copy_tile_size=2048):
+    """pack the tissue chunks of a slide into a compact pyramidal image.
+
+    Inputs:
+    reader         -- `RoiReader` of the slide
+    fn             -- output `.tif` file or tile directory (see `write_pyramid`)
+    straighten     -- rotate every chunk to its minimal-area bounding rectangle (`CropRotateRoi`)
+    margin         -- level-0 pixels added around every chunk outline
+    align          -- chunks are placed at multiples of `align` pixels
+    spacing        -- minimal gap between chunks
+    tile_size      -- tile side of the pyramid
+    layout         -- pyramid layout: `tiff`, `tiles`, or `auto` (by the file extension)
+    copy_tile_size -- side of tiles read from the slide while copying chunks
+    Returns the mapping (also written into `{fn}.mapping.json`)"""
+    slide = reader.slide
+    chunks = []
+    for nn, roi in enumerate(reader.tissue_rois):
+        contour = _chunk_contour_(roi['vertices'], margin)
+        read_start = np.maximum(np.floor(contour.min(0)).astype(int), 0)
+        read_end = np.minimum(np.ceil(contour.max(0)).astype(int), slide.dimensions)
+        if straighten:
+            transform = CropRotateRoi(contour, use_offset=True, borderValue=BACKGROUND)
+            matrix = transform.full_affine_matrix.dot(
+                np.array([[1, 0, -transform.offset[0]], [0, 1, -transform.offset[1]], [0, 0, 1]]))
+            size = tuple(int(x) for x in transform.img_size)
+        else:
+            transform = None
+            matrix = np.array([[1, 0, -read_start[0]], [0, 1, -read_start[1]], [0, 0, 1]],
+                              dtype=float)
+            size = tuple(int(x) for x in read_end - read_start)
+        chunks.append({'id': roi.get('id', nn), 'contour': contour,
+                       'transform': transform, 'matrix': matrix, 'size': size,
+                       'read_start': read_start, 'read_size': read_end - read_start})
+    if len(chunks) == 0:
+        raise ValueError('no tissue chunks in {}'.format(reader.inputfile))
+
+    positions, (width, height) = pack_shelves([cc['size'] for cc in chunks],
+                                              align=align, spacing=spacing)
+    with tempfile.TemporaryFile() as fh:
+        canvas = np.memmap(fh, dtype=np.uint8, mode='w+', shape=(height, width, 4))
+    for y0 in range(0, height, copy_tile_size):
+        canvas[y0:y0+copy_tile_size] = BACKGROUND
+
+    for chunk, (x0, y0) in zip(chunks, positions):
+        w, h = chunk['size']
+        out = canvas[y0:y0+h, x0:x0+w]
+        if chunk['transform'] is not None:
+            rotate_region_tiled(slide, chunk['transform'], chunk['read_start'], chunk['read_size'],
+                                out=out, tile_size=copy_tile_size, border_value=BACKGROUND)
+        else:
+            _copy_region_tiled_(slide, chunk['read_start'], (w, h), out, tile_size=copy_tile_size)
+        chunk['matrix'] = np.array([[1, 0, x0], [0, 1, y0], [0, 0, 1]]).dot(chunk['matrix'])
+
+    # pyramid levels spaced as those of the slide (a power of 2, e.g. 4 for SVS)
+    level_factor = 2**max(1, int(round(np.log2(slide.level_downsamples[1])))) \
+        if slide.level_count > 1 else 4
+    level_dims = write_pyramid(canvas, fn, tile_size=tile_size, layout=layout,
+                               level_factor=level_factor)
+
+    annotations = []
+    for roi in reader.annotations:
+        chunk = _find_chunk_(chunks, get_contour_centre(roi['vertices']))
+        if chunk is None:
+            continue
+        roi = dict(roi)
+        roi['vertices'] = _affine_(chunk['matrix'][:2], roi['vertices']).tolist()
+        roi['chunk'] = chunk['id']
+        annotations.append(roi)
+
+    mapping = {'slide': reader.inputfile,
+               'dimensions': list(slide.dimensions),
+               'level_downsamples': list(slide.level_downsamples),
+               'compact_dimensions': [width, height],
+               'compact_levels': [list(dd) for dd in level_dims],
+               'straighten': straighten,
+               'chunks': [{'id': cc['id'],
+                           'contour': cc['contour'].tolist(),
+                           'matrix': cc['matrix'][:2].tolist(),
+                           'position': [int(x) for x in pos],
+                           'size': list(cc['size']),
+                           } for cc, pos in zip(chunks, positions)],
+               'annotations': annotations,
+               }
+    with open(get_mapping_filename(fn), 'w') as fh:
+        json.dump(mapping, fh)
+    return mapping
+
+
+def _find_chunk_(chunks, xy):
+    "the chunk whose contour contains a level-0 point (or the nearest one)"
+    point = Point(*np.asarray(xy, dtype=float).ravel()[:2])
+    distances = [Polygon(cc['contour']).distance(point) for cc in chunks]
+    if not distances:
+        return None
+    return chunks[int(np.argmin(distances))]
+
+
+class CompactSlide():
+    """a compact image written by `compact_slide`, read with the interface of
+    `openslide.OpenSlide` in the coordinates of the original slide.
+    Levels are those of the compact pyramid spaced as the levels of the original slide
+    (all of them for pyramids written by `compact_slide`)"""
+    def __init__(self, fn):
+        self.filename = fn
+        with open(get_mapping_filename(fn)) as fh:
+            self.mapping = json.load(fh)
+        self.pyramid = PyramidReader(fn)
+        self.chunks = self.mapping['chunks']
+        for chunk in self.chunks:
+            chunk['contour'] = np.asarray(chunk['contour'])
+            chunk['matrix'] = np.asarray(chunk['matrix'])
+            chunk['inverse'] = np.linalg.inv(_full_(chunk['matrix']))[:2]
+        self.annotations = self.mapping['annotations']
+        self.dimensions = tuple(self.mapping['dimensions'])
+
+        # pyramid downsamples are powers of 2, up to the rounding of odd sides
+        pyramid_ds = [2**int(round(np.log2(ds))) for ds in self.pyramid.level_downsamples]
+        downsamples = self.mapping['level_downsamples']
+        step = 1
+        if len(downsamples) > 1 and len(pyramid_ds) > 1:
+            step = max(1, int(round(np.log2(downsamples[1]) / np.log2(pyramid_ds[1]))))
+        self._levels = list(range(0, self.pyramid.level_count, step))
+        self.level_downsamples = tuple(float(pyramid_ds[ll]) for ll in self._levels)
+        self.level_dimensions = tuple(tuple(int(np.ceil(dd / ds)) for dd in self.dimensions)
+                                      for ds in self.level_downsamples)
+        self.properties = {'openslide.level-count': str(self.level_count)}
+        self.associated_images = {}
+
+    @property
+    def level_count(self):
+        return len(self._levels)
+
+    def get_best_level_for_downsample(self, downsample):
+        levels = [ll for ll, ds in enumerate(self.level_downsamples) if ds <= downsample*(1+1e-6)]
+        return max(levels) if levels else 0
+
+    def to_compact(self, xy):
+        """level-0 slide coordinates `[N x 2]` into compact coordinates (by the chunk of every point);
+        points outside of all chunks are NaN"""
+        xy = np.atleast_2d(np.asarray(xy, dtype=float))
+        out = np.full(xy.shape, np.nan)
+        for chunk in self.chunks:
+            polygon = Polygon(chunk['contour'])
+            inside = np.array([np.isnan(oo[0]) and polygon.covers(Point(*pp))
+                               for pp, oo in zip(xy, out)], dtype=bool).reshape(-1)
+            out[inside] = _affine_(chunk['matrix'], xy[inside])
+        return out
+
+    def to_original(self, xy):
+        "compact coordinates `[N x 2]` back into level-0 slide coordinates"
+        xy = np.atleast_2d(np.asarray(xy, dtype=float))
+        out = np.full(xy.shape, np.nan)
+        for chunk in self.chunks:
+            x0, y0 = chunk['position']
+            w, h = chunk['size']
+            inside = ((xy[:, 0] >= x0) & (xy[:, 0] < x0 + w) &
+                      (xy[:, 1] >= y0) & (xy[:, 1] < y0 + h))
+            out[inside] = _affine_(chunk['inverse'], xy[inside])
+        return out
+
+    def read_region(self, location, level, size):
+        """an RGBA PIL image of a region given by its level-0 `location` in the original slide;
+        pixels outside of the chunks are transparent"""
+        downsample = self.level_downsamples[level]
+        plevel = self._levels[level]
+        w, h = [int(ss) for ss in size]
+        x0, y0 = [float(cc) for cc in location]
+        out = np.zeros((h, w, 4), dtype=np.uint8)
+        window = Polygon([(x0, y0), (x0 + w*downsample, y0),
+                          (x0 + w*downsample, y0 + h*downsample), (x0, y0 + h*downsample)])
+        # output pixel -> level-0 slide point
+        to_slide = np.array([[downsample, 0, x0], [0, downsample, y0], [0, 0, 1]])
+        for chunk in self.chunks:
+            if not Polygon(chunk['contour']).intersects(window):
+                continue
+            # output pixel -> compact pixel at the pyramid level
+            matrix = np.diag([1/downsample, 1/downsample, 1]).dot(_full_(chunk['matrix'])).dot(to_slide)
+            corners = _affine_(matrix[:2], [(0, 0), (w, 0), (w, h), (0, h)])
+            cstart = np.floor(corners.min(0)).astype(int) - 2
+            csize = np.ceil(corners.max(0)).astype(int) + 2 - cstart
+            region, _ = self.pyramid.read_array(tuple(cstart * downsample), plevel, csize)
+            # only the packed rectangle of this chunk: its neighbours on the canvas
+            # are other parts of the slide
+            rx0, ry0 = np.round(np.asarray(chunk['position']) / downsample).astype(int) - cstart
+            rx1, ry1 = np.round((np.asarray(chunk['position']) + chunk['size']) / downsample
+                                ).astype(int) - cstart
+            inside = np.zeros(region.shape[:2], dtype=bool)
+            inside[max(0, ry0):max(0, ry1), max(0, rx0):max(0, rx1)] = True
+            region[~inside, 3] = 0
+            shift = np.array([[1, 0, -cstart[0]], [0, 1, -cstart[1]], [0, 0, 1]])
+            matrix = shift.dot(matrix)
+            translation_only = np.allclose(matrix[:2, :2], np.eye(2))
+            warped = cv2.warpAffine(np.ascontiguousarray(region), matrix[:2], (w, h),
+                                    flags=(cv2.INTER_NEAREST if translation_only else cv2.INTER_LINEAR)
+                                           | cv2.WARP_INVERSE_MAP,
+                                    borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+            # partly transparent pixels at chunk edges are blended with the background
+            fill = (warped[..., 3] == 255) & (out[..., 3] == 0)
+            out[fill] = warped[fill]
+        return Image.fromarray(out, 'RGBA')
+
+    def get_thumbnail(self, size):
+        downsample = max(dd / ss for dd, ss in zip(self.dimensions, size))
+        level = self.get_best_level_for_downsample(downsample)
+        img = self.read_region((0, 0), level, self.level_dimensions[level]).convert('RGB')
+        img.thumbnail(size)
+        return img
+
+    def close(self):
+        self.pyramid.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+if __name__ == '__main__':
+    import argparse
+    from .roi_reader import RoiReader
+
+    parser = argparse.ArgumentParser(
+        description='pack the tissue chunks of a slide into a compact pyramidal image')
+    parser.add_argument('slide', type=str, help='slide file (annotations are expected next to it)')
+    parser.add_argument('output', type=str, help='output `.tif` file or tile directory')
+    parser.add_argument('--straighten', action='store_true', default=False,
+                        help='rotate chunks to their minimal-area bounding rectangles')
+    parser.add_argument('--margin', type=int, default=64, help='level-0 pixels around chunks')
+    parser.add_argument('--tile-size', type=int, default=256, help='tile side of the pyramid')
+    parser.add_argument('--roi-cache', type=str, default=None, help='ROI cache directory')
+    prms = parser.parse_args()
+
+    reader = RoiReader(prms.slide, save=False, verbose=False, cache_dir=prms.roi_cache)
+    mapping = compact_slide(reader, prms.output, straighten=prms.straighten,
+                            margin=prms.margin, tile_size=prms.tile_size)
+    full = np.prod(mapping['dimensions'])
+    compact = np.prod(mapping['compact_dimensions'])
+    print('{} chunks, {}x{} -> {}x{} ({:.1%} of the area)'.format(
+          len(mapping['chunks']), *mapping['dimensions'], *mapping['compact_dimensions'],
+          compact / full), file=sys.stderr)
@@ -0,0 +1,138 @@
+# coding: utf-8
+"""encoding policy for exported image patches
+
+Supported formats:
+
+    png   -- lossless, zlib `level` 0..9 (library default if not given)
+    webp  -- lossless WebP
+    jpeg  -- lossy JPEG with given `quality` (1..100)
+    raw   -- uncompressed uint8 array in numpy `.npy` format;
+             largest but the fastest to write and read, e.g. for tar shards
+
+A policy can be given as a string `format[:param]`, e.g. `png:1`, `jpeg:90`, `webp`, `raw`.
+Images are expected in RGB(A) channel order, as returned by openslide / PIL.
+"""
+import io
+import numpy as np
+from PIL import Image
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+
+FORMATS = ('png', 'webp', 'jpeg', 'raw')
+EXTENSIONS = {'png': 'png', 'webp': 'webp', 'jpeg': 'jpg', 'raw': 'npy'}
+
+
+class ImageEncoding():
+    def __init__(self, format='png', level=None, quality=90, backend='cv2'):
+        """
+        Inputs:
+        format    -- one of `png`, `webp`, `jpeg`, `raw`
+        level     -- PNG compression level (0..9); `None` for the library default
+        quality   -- JPEG quality
+        backend   -- `cv2` (faster) or `pil`; falls back to `pil` if OpenCV is missing
+        """
+        format = format.lower().replace('jpg', 'jpeg')
+        if format not in FORMATS:
+            raise ValueError('unknown image encoding format: %s' % format)
+        self.format = format
+        self.level = level
+        self.quality = quality
+        self.backend = backend if cv2 is not None else 'pil'
+
+    @classmethod
+    def from_string(cls, spec, **kwargs):
+        "parse `format[:param]`, e.g. `png:1` or `jpeg:95`"
+        if isinstance(spec, cls):
+            return spec
+        format, _, param = spec.partition(':')
+        format = format.lower().replace('jpg', 'jpeg')
+        if param:
+            if format == 'png':
+                kwargs['level'] = int(param)
+            elif format == 'jpeg':
+                kwargs['quality'] = int(param)
+            else:
+                raise ValueError('format "%s" takes no parameters' % format)
+        return cls(format, **kwargs)
+
+    @property
+    def ext(self):
+        return EXTENSIONS[self.format]
+
+    def __repr__(self):
+        if self.format == 'png' and self.level is not None:
+            return 'png:%d' % self.level
+        if self.format == 'jpeg':
+            return 'jpeg:%d' % self.quality
+        return self.format
+
+    def encode(self, img):
+        "encode an RGB(A) image (numpy array or PIL image) into bytes"
+        if self.format == 'raw':
+            buf = io.BytesIO()
+            np.lib.format.write_array(buf, np.ascontiguousarray(img, dtype=np.uint8),
+                                      allow_pickle=False)
+            return buf.getvalue()
+        if self.backend == 'cv2':
+            return self._encode_cv2_(np.asarray(img))
+        return self._encode_pil_(img)
+
+    def _encode_cv2_(self, img):
+        if self.format == 'jpeg' and img.ndim == 3:
+            img = img[..., :3]
+        if img.ndim == 3:
+            code = cv2.COLOR_RGBA2BGRA if img.shape[-1] == 4 else cv2.COLOR_RGB2BGR
+            img = cv2.cvtColor(img, code)
+        if self.format == 'png':
+            params = [] if self.level is None else [cv2.IMWRITE_PNG_COMPRESSION, self.level]
+        elif self.format == 'webp':
+            # quality above 100 selects the lossless mode
+            params = [cv2.IMWRITE_WEBP_QUALITY, 101]
+        else:
+            params = [cv2.IMWRITE_JPEG_QUALITY, self.quality]
+        success, buf = cv2.imencode('.' + self.ext, img, params)
+        if not success:
+            raise IOError('failed to encode the image as %s' % self.format)
+        return buf.tobytes()
+
+    def _encode_pil_(self, img):
+        if not isinstance(img, Image.Image):
+            img = Image.fromarray(np.asarray(img))
+        buf = io.BytesIO()
+        if self.format == 'png':
+            kwargs = {} if self.level is None else {'compress_level': self.level}
+            img.save(buf, 'png', **kwargs)
+        elif self.format == 'webp':
+            img.save(buf, 'webp', lossless=True)
+        else:
+            img.convert('RGB').save(buf, 'jpeg', quality=self.quality)
+        return buf.getvalue()
+
+    def decode(self, data):
+        "decode bytes produced by `encode` into an RGB(A) uint8 array"
+        return decode_image(data, self.ext, backend=self.backend)
+
+    def save(self, img, prefix):
+        "save an image into `{prefix}.{ext}`; returns the file name"
+        fnout = '{}.{}'.format(prefix, self.ext)
+        with open(fnout, 'wb') as fh:
+            fh.write(self.encode(img))
+        return fnout
+
+
+def decode_image(data, ext=None, backend='cv2'):
+    """decode an encoded image into a uint8 array in RGB(A) channel order;
+    `.npy` data is recognized by its header"""
+    if ext == 'npy' or data[:6] == b'\x93NUMPY':
+        return np.load(io.BytesIO(data), allow_pickle=False)
+    if backend == 'cv2' and cv2 is not None:
+        img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+        if img.ndim == 3:
+            code = cv2.COLOR_BGRA2RGBA if img.shape[-1] == 4 else cv2.COLOR_BGR2RGB
+            img = cv2.cvtColor(img, code)
+        return img
+    return np.asarray(Image.open(io.BytesIO(data)))
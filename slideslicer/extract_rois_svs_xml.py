@@ -6,7 +6,6 @@ import re
 import json
 import openslide
 import numpy as np
-import pandas as pd
 from PIL import Image
 import numpy as np
 from shapely.geometry import Polygon
@@ -17,13 +16,17 @@ from .slideutils import (get_vertices, get_roi_dict, get_median_color,
                         get_thumbnail_magnification)
 
 from .roi_reader import remove_empty_tissue_chunks
+from .lazyimport import lazy_import
+
+pd = lazy_import('pandas')
 
 ## Read XML ROI, convert, and save as JSON
 def _shapely_polygon_from_roi_(roi):
     return Polygon(roi["vertices"])
 
 
-def extract_rois_svs_xml(fnxml, remove_empty=True, outdir=None, minlen=50, keeplevels=1):
+def extract_rois_svs_xml(fnxml, remove_empty=True, outdir=None, minlen=50, keeplevels=1,
+                         cache_dir=None):
     """
     extract and save rois
 
@@ -35,6 +38,8 @@ def extract_rois_svs_xml(fnxml, remove_empty=True, outdir=None, minlen=50, keepl
     keeplevels    -- number of path elements to keep 
                   when saving to provided `outdir`
                   (1 -- filename only; 2 -- incl 1 directory)
+    cache_dir     -- (optional) load / store the rois in a cache directory
+                  keyed by the annotation content (see `slideslicer.cohort`)
     """
     fnsvs = re.sub("\.xml$", ".svs", fnxml)
     fnjson = re.sub(".xml$", ".json", fnxml)
@@ -43,7 +48,36 @@ def extract_rois_svs_xml(fnxml, remove_empty=True, outdir=None, minlen=50, keepl
         fnjson = os.path.join(outdir, fnjson)
         os.makedirs(os.path.dirname(fnjson), exist_ok = True)
 
+    if cache_dir is not None:
+        roilist = get_cached_rois(fnxml, cache_dir, remove_empty=remove_empty, minlen=minlen)
+    else:
+        roilist = _extract_rois_(fnxml, fnsvs, remove_empty=remove_empty, minlen=minlen)
+
+    ## Save both contour lists together
+    with open(fnjson, 'w+') as fh:
+        json.dump(roilist, fh)
+
+    return fnjson
+
 
+def get_cached_rois(fnxml, cache_dir, remove_empty=True, minlen=50):
+    """ROIs of `extract_rois_svs_xml` from the cache in `cache_dir` (see `slideslicer.cohort`),
+    extracted and stored there on a miss"""
+    from .cohort import RoiCache, validate_rois
+    fnsvs = re.sub("\.xml$", ".svs", fnxml)
+    cache = RoiCache(cache_dir)
+    cache_key = cache.get_key(fnxml, fnslide=fnsvs,
+                              source='extract_rois_svs_xml',
+                              remove_empty=bool(remove_empty), minlen=minlen)
+    roilist = cache.get(cache_key)
+    if roilist is None:
+        roilist = validate_rois(_extract_rois_(fnxml, fnsvs, remove_empty=remove_empty,
+                                               minlen=minlen))
+        cache.put(cache_key, roilist, fnxml=fnxml)
+    return roilist
+
+
+def _extract_rois_(fnxml, fnsvs, remove_empty=True, minlen=50):
     ############################
     # parsing XML
     ############################
@@ -88,11 +122,7 @@ def extract_rois_svs_xml(fnxml, remove_empty=True, outdir=None, minlen=50, keepl
         roi_name_counts = pd.Series([rr["name"] for rr in roilist]).value_counts()
         print("counts of roi names after removing empty chunks")
         print(roi_name_counts)
-    ## Save both contour lists together
-    with open(fnjson, 'w+') as fh:
-        json.dump(roilist, fh)
-
-    return fnjson
+    return roilist
 
 if __name__ == "__main__":
     fnxml = sys.argv[1]
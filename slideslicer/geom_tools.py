@@ -122,3 +122,69 @@ def get_ellipse_verts(AxesLengths, Centroid, points=50):
     x = Xc + a*np.cos(t)*np.cos(phi) - b*np.sin(t)*np.sin(phi);
     y = Yc + a*np.cos(t)*np.sin(phi) + b*np.sin(t)*np.cos(phi);
     return x,y
+
+
+def _grid_cells_(points, cell_size=None):
+    """quantize `[N x 2]` points into integer grid cells of `cell_size`
+    (by default the smallest non-zero spacing between coordinates)"""
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    if cell_size is None:
+        steps = np.concatenate([np.diff(np.unique(points[:, 0])),
+                                np.diff(np.unique(points[:, 1]))])
+        steps = steps[steps > 0]
+        cell_size = steps.min() if len(steps) else 1
+    cells = np.floor((points - points.min(0)) / cell_size).astype(np.int64)
+    order = max(1, int(np.ceil(np.log2(cells.max() + 1)))) if len(cells) else 1
+    return cells, order
+
+
+def zorder_index(cells, order):
+    """Morton (Z-order) index of integer `[N x 2]` grid cells
+    on a `2**order x 2**order` grid"""
+    cells = np.asarray(cells, dtype=np.int64)
+    x, y = cells[:, 0], cells[:, 1]
+    d = np.zeros(len(cells), dtype=np.int64)
+    for bit in range(order):
+        d |= ((x >> bit) & 1) << (2*bit)
+        d |= ((y >> bit) & 1) << (2*bit + 1)
+    return d
+
+
+def hilbert_index(cells, order):
+    """Hilbert curve index of integer `[N x 2]` grid cells
+    on a `2**order x 2**order` grid"""
+    cells = np.asarray(cells, dtype=np.int64)
+    x, y = cells[:, 0].copy(), cells[:, 1].copy()
+    d = np.zeros(len(cells), dtype=np.int64)
+    s = 1 << (order - 1)
+    while s > 0:
+        rx = ((x & s) > 0).astype(np.int64)
+        ry = ((y & s) > 0).astype(np.int64)
+        d += s * s * ((3 * rx) ^ ry)
+        # rotate the quadrant
+        flip = (ry == 0) & (rx == 1)
+        x[flip] = s - 1 - x[flip]
+        y[flip] = s - 1 - y[flip]
+        swap = ry == 0
+        x[swap], y[swap] = y[swap], x[swap].copy()
+        s >>= 1
+    return d
+
+
+def curve_order(points, curve='hilbert', cell_size=None):
+    """indices that sort `[N x 2]` points along a space-filling curve:
+    `hilbert`, `zorder`, `row` (row-major) or `serpentine` (boustrophedon)"""
+    if len(points) == 0:
+        return np.arange(0)
+    cells, order = _grid_cells_(points, cell_size=cell_size)
+    if curve == 'hilbert':
+        return np.argsort(hilbert_index(cells, order), kind='stable')
+    elif curve == 'zorder':
+        return np.argsort(zorder_index(cells, order), kind='stable')
+    elif curve == 'row':
+        return np.lexsort((cells[:, 0], cells[:, 1]))
+    elif curve == 'serpentine':
+        x = np.where(cells[:, 1] % 2 == 1, -cells[:, 0], cells[:, 0])
+        return np.lexsort((x, cells[:, 1]))
+    else:
+        raise ValueError('unknown curve: %s' % curve)
@@ -1,5 +1,10 @@
 import numpy as np
-from skimage import color, exposure, transform, io
+from slideslicer.lazyimport import lazy_import
+
+color = lazy_import('skimage.color')
+exposure = lazy_import('skimage.exposure')
+transform = lazy_import('skimage.transform')
+io = lazy_import('skimage.io')
 
 def preprocess_img(img):
     if img.shape[-1] > 3:
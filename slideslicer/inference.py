@@ -0,0 +1,213 @@
+# coding: utf-8
+"""sliding-window inference over all tissue of a slide
+
+`SlidingWindowIterator` lays a slide-aligned grid of windows with a fixed
+overlap over the whole slide, keeps only windows that contain tissue
+(by the tissue chunks of a `RoiReader`, rasterized into a coarse mask),
+and yields batches of patches with their centres, ready for
+`slideslicer.stitch.Stitcher`:
+
+    windows = SlidingWindowIterator(reader, side=256, subsample=4, overlap=32, batch_size=32)
+    stitcher = windows.get_stitcher(level=2, num_channels=3, out='pred.npy')
+    for batch_x, coords in windows:
+        stitcher.add(coords, model(batch_x))
+    probmap = stitcher.finalize()
+
+Windows are grouped into square blocks of `block_size x block_size` grid cells,
+blocks are visited along a space-filling curve, and windows within a block
+row by row. The windows of a batch that are adjacent on the grid are read
+together: runs of windows in a grid row, merged with identical runs of the
+next rows, become one rectangular `read_region` call from which the patches
+are cropped. Only regions of tissue-bearing windows are ever read.
+"""
+import os
+import numpy as np
+import cv2
+from .geom_tools import curve_order
+from .roi_reader import _get_patch_
+
+
+def get_tissue_mask(rois, dimensions, cell_size):
+    """rasterize tissue polygons (level-0 vertices) into a uint8 mask
+    with `cell_size` level-0 pixels per mask pixel"""
+    width, height = [int(np.ceil(dd / cell_size)) for dd in dimensions]
+    mask = np.zeros((height, width), dtype=np.uint8)
+    polygons = [np.round(np.asarray(roi['vertices'], dtype=float) / cell_size).astype(np.int32)
+                for roi in rois if len(roi['vertices']) > 2]
+    if polygons:
+        cv2.fillPoly(mask, polygons, 1)
+    return mask
+
+
+def get_tissue_windows(mask, cell_size, window_size, stride, min_tissue=0.0):
+    """grid windows of level-0 side `window_size`, spaced by `stride` from the slide origin,
+    whose tissue fraction in `mask` (see `get_tissue_mask`) exceeds `min_tissue`.
+    Returns grid positions `[N x 2]` `(col, row)` and tissue fractions"""
+    height, width = mask.shape
+    integral = cv2.integral(mask)
+    ncols = int(np.ceil(width * cell_size / stride))
+    nrows = int(np.ceil(height * cell_size / stride))
+    cols, rows = np.meshgrid(np.arange(ncols), np.arange(nrows))
+    cols, rows = cols.ravel(), rows.ravel()
+    # window extents in mask pixels
+    x0 = np.clip(np.floor(cols * stride / cell_size).astype(int), 0, width)
+    y0 = np.clip(np.floor(rows * stride / cell_size).astype(int), 0, height)
+    x1 = np.clip(np.ceil((cols * stride + window_size) / cell_size).astype(int), 0, width)
+    y1 = np.clip(np.ceil((rows * stride + window_size) / cell_size).astype(int), 0, height)
+    area = np.maximum((x1 - x0) * (y1 - y0), 1)
+    tissue = (integral[y1, x1] - integral[y0, x1] - integral[y1, x0] + integral[y0, x0]) / area
+    keep = tissue > min_tissue
+    return np.stack([cols[keep], rows[keep]], axis=1), tissue[keep]
+
+
+def coalesce_windows(grid):
+    """group windows of a batch given by grid positions `[N x 2]` `(col, row)`
+    into rectangles of adjacent windows: runs along rows, merged with identical runs
+    of the following rows. Returns a list of `(col0, row0, col1, row1, members)`
+    with inclusive bounds and positions of member windows in `grid`"""
+    runs = []
+    order = sorted(range(len(grid)), key=lambda ii: (grid[ii][1], grid[ii][0]))
+    for ii in order:
+        col, row = grid[ii]
+        if runs and runs[-1][1] == row and runs[-1][2] == col - 1:
+            runs[-1][2] = col
+            runs[-1][3].append(ii)
+        else:
+            runs.append([col, row, col, [ii]])
+    rects = []
+    open_ = {}
+    for col0, row, col1, members in runs:
+        rect = open_.pop((col0, col1, row - 1), None)
+        if rect is None:
+            rect = [col0, row, col1, row, []]
+            rects.append(rect)
+        rect[3] = row
+        rect[4] += members
+        open_[(col0, col1, row)] = rect
+    return [tuple(rect) for rect in rects]
+
+
+class SlidingWindowIterator():
+    def __init__(self, roireader, side=256, subsample=4, overlap=0, batch_size=16,
+                 min_tissue=0.0, block_size=8, order='hilbert',
+                 color_last=True, batch_preprocess=None,
+                 use_cached=True, resampler='auto', mask_oversample=4):
+        """
+        Inputs:
+        roireader        -- `RoiReader` of the slide (its `tissue_rois` define the tissue)
+        side             -- side of patches in output pixels
+        subsample        -- downsampling factor of patches (an integer)
+        overlap          -- overlap of neighbouring windows in output pixels
+        batch_size       -- windows per batch
+        min_tissue       -- minimal tissue fraction of a window (by default, any tissue)
+        block_size       -- side of blocks of grid cells that are visited in turn
+        order            -- order of blocks: `hilbert`, `zorder`, `serpentine`, or `row`
+        color_last       -- batches are `[B x H x W x 3]` (otherwise `[B x 3 x H x W]`)
+        batch_preprocess -- function applied once to every uint8 batch
+        use_cached       -- read from the nearest pyramid level
+        resampler        -- downsampling method between pyramid levels (see `slideslicer.resample`)
+        mask_oversample  -- tissue mask pixels per grid step
+        """
+        if overlap >= side:
+            raise ValueError('overlap must be smaller than the patch side')
+        self.roireader = roireader
+        self.side = side
+        self.subsample = subsample
+        self.overlap = overlap
+        self.batch_size = batch_size
+        self.color_last = color_last
+        self.batch_preprocess = batch_preprocess
+        self.use_cached = use_cached
+        self.resampler = resampler
+        self.side_magn = side*subsample
+        self.stride_magn = (side - overlap)*subsample
+
+        # one handle for all batches, so that the tile cache of OpenSlide is kept
+        self._slide = roireader.slide
+        self._pid = os.getpid()
+        dimensions = self._slide.dimensions
+        cell_size = max(1, self.stride_magn // mask_oversample)
+        mask = get_tissue_mask(roireader.tissue_rois, dimensions, cell_size)
+        grid, tissue = get_tissue_windows(mask, cell_size, self.side_magn, self.stride_magn,
+                                          min_tissue=min_tissue)
+        # blocks along the curve, windows within a block row by row
+        blocks = grid // block_size
+        block_ids, block_inv = np.unique(blocks, axis=0, return_inverse=True)
+        block_inv = block_inv.ravel()
+        if order is not None and len(block_ids):
+            block_rank = np.empty(len(block_ids), dtype=int)
+            block_rank[curve_order(block_ids, curve=order)] = np.arange(len(block_ids))
+        else:
+            block_rank = np.arange(len(block_ids))
+        indices = np.lexsort((grid[:, 0], grid[:, 1], block_rank[block_inv]))
+        self.grid = grid[indices]
+        self.tissue = tissue[indices]
+        self.points = self.grid * self.stride_magn + self.side_magn // 2
+        self.index = -1
+
+    @property
+    def slide(self):
+        "the slide handle opened with the iterator (re-opened in other processes)"
+        if self._slide is None or self._pid != os.getpid():
+            self._slide = self.roireader.slide
+            self._pid = os.getpid()
+        return self._slide
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_slide'] = None
+        return state
+
+    def __len__(self):
+        return int(np.ceil(len(self.points)/self.batch_size))
+
+    def get_stitcher(self, level=0, **kwargs):
+        "a `slideslicer.stitch.Stitcher` for the predictions on these windows"
+        from .stitch import Stitcher
+        return Stitcher.from_slide(self.slide, self.side_magn, level=level, **kwargs)
+
+    def __getitem__(self, key):
+        return self.read_batch(key)
+
+    def read_batch(self, key, out=None):
+        """read batch number `key`: returns patches and their centres `[B x 2]` in level-0 pixels;
+        patches are written into `out` (a uint8 array of the full batch shape) if given"""
+        start = key*self.batch_size
+        end = min(len(self.points), start + self.batch_size)
+        grid = self.grid[start:end]
+        num = end - start
+        if out is not None:
+            batch_x = out[:num]
+        else:
+            batch_x = np.empty((num, self.side, self.side, 3) if self.color_last else
+                               (num, 3, self.side, self.side), dtype=np.uint8)
+        slide = self.slide
+        stride = self.side - self.overlap
+        for col0, row0, col1, row1, members in coalesce_windows(grid.tolist()):
+            x0, y0 = col0*self.stride_magn, row0*self.stride_magn
+            size = [(col1 - col0)*self.stride_magn + self.side_magn,
+                    (row1 - row0)*self.stride_magn + self.side_magn]
+            region = _get_patch_(slide, x0 + size[0]//2, y0 + size[1]//2,
+                                 patch_size=size, scale=self.subsample,
+                                 use_cached=self.use_cached, resampler=self.resampler)
+            region = np.asarray(region)[..., :3]
+            for ii in members:
+                col, row = grid[ii]
+                xs, ys = (col - col0)*stride, (row - row0)*stride
+                patch = region[ys:ys+self.side, xs:xs+self.side]
+                if not self.color_last:
+                    patch = np.moveaxis(patch, -1, -3)
+                batch_x[ii] = patch
+        if self.batch_preprocess is not None:
+            batch_x = self.batch_preprocess(batch_x)
+        return batch_x, self.points[start:end]
+
+    def __iter__(self):
+        self.index = -1
+        return self
+
+    def __next__(self):
+        self.index += 1
+        if self.index >= len(self):
+            raise StopIteration
+        return self[self.index]
@@ -0,0 +1,31 @@
+"""deferred imports of heavy optional dependencies
+
+    pd = lazy_import('pandas')
+
+binds a proxy that imports `pandas` on first attribute access,
+so that e.g. data loader workers that never touch pandas or matplotlib
+do not pay for importing them.
+"""
+import importlib
+
+
+class LazyModule():
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def _load_(self):
+        if self._module is None:
+            self.__dict__['_module'] = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load_(), attr)
+
+    def __repr__(self):
+        state = 'loaded' if self._module is not None else 'not loaded'
+        return '<lazy module {} ({})>'.format(self._name, state)
+
+
+def lazy_import(name):
+    return LazyModule(name)
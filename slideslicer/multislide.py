@@ -0,0 +1,278 @@
+# coding: utf-8
+"""patches from many slides through one dataset with bounded memory
+
+`MultiSlideDataset` takes one slide and one set of patch centres per slide,
+exposes a global index over all points, and draws batches across slides.
+Only the `max_open` most recently used slides are kept resident:
+their open OpenSlide handle and, for slides given by file name,
+their `RoiReader` (with its ROIs and bounding box index).
+Least recently used slides are closed and dropped,
+so that memory does not grow with the size of the cohort:
+
+    dataset = MultiSlideDataset(slide_files, points, weights=None,
+                                side=256, subsample=4, batch_size=16,
+                                num_samples=100000, block_size=16, max_open=8)
+    for epoch in range(num_epochs):
+        dataset.set_epoch(epoch)
+        for batch_x, coords, slide_ids in dataset:
+            ...
+"""
+from collections import OrderedDict
+import numpy as np
+from .roi_reader import RoiReader, _get_patch_
+
+
+class SlideCache():
+    """an LRU of open slides: `(RoiReader, OpenSlide handle)` pairs
+
+    Inputs:
+    sources       -- list of slide file names, `RoiReader` objects,
+                     or callables returning a `RoiReader`;
+                     readers are built from file names (in the lazy mode) on demand
+                     and dropped on eviction; readers passed as objects stay in memory,
+                     but their slide handles are closed and their memoized data frame
+                     and bounding box index (and ROIs of lazy readers) are dropped
+    max_open      -- maximal number of resident slides
+    reader_kwargs -- keyword arguments of `RoiReader` for slides given by file names
+    """
+    def __init__(self, sources, max_open=8, reader_kwargs=None):
+        self.sources = list(sources)
+        self.max_open = max_open
+        self.reader_kwargs = dict(save=False, verbose=False, lazy=True)
+        self.reader_kwargs.update(reader_kwargs or {})
+        self._open = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _load_(self, index):
+        source = self.sources[index]
+        if isinstance(source, RoiReader):
+            reader = source
+        elif callable(source):
+            reader = source()
+        else:
+            reader = RoiReader(source, **self.reader_kwargs)
+        return reader, reader.slide
+
+    def __getitem__(self, index):
+        "returns `(reader, slide)` for a slide by its position"
+        if index in self._open:
+            self.hits += 1
+            self._open.move_to_end(index)
+            return self._open[index]
+        self.misses += 1
+        self._open[index] = self._load_(index)
+        while len(self._open) > self.max_open:
+            evicted, (reader, _) = self._open.popitem(last=False)
+            self._release_(evicted, reader)
+        return self._open[index]
+
+    def _release_(self, index, reader):
+        reader.close()
+        if isinstance(self.sources[index], RoiReader):
+            # the reader outlives the cache entry: drop what it rebuilds on demand
+            attrs = ['_df', '_spatial_index']
+            if getattr(reader, 'lazy', False):
+                attrs += ['_rois', '_tissue_rois', '_annotations']
+            for attr in attrs:
+                reader.__dict__.pop(attr, None)
+
+    def __len__(self):
+        return len(self.sources)
+
+    @property
+    def resident(self):
+        return list(self._open.keys())
+
+    def close(self):
+        for index, (reader, _) in self._open.items():
+            self._release_(index, reader)
+        self._open.clear()
+
+    def __getstate__(self):
+        # handles are not shared with worker processes
+        state = self.__dict__.copy()
+        state['_open'] = OrderedDict()
+        return state
+
+
+class MultiSlideDataset():
+    def __init__(self, slides, points,
+                 weights=None, num_samples=None, block_size=1,
+                 side=128, subsample=8, batch_size=4,
+                 preprocess=None, color_last=True,
+                 roi=False, get_mask_for_names=None,
+                 use_cached=True, resampler='auto', max_open=8, reader_kwargs=None,
+                 sampler=None, seed=None):
+        """
+        Inputs:
+        slides      -- list of slide file names or `RoiReader` objects (see `SlideCache`)
+        points      -- list of `[N_i x 2]` arrays of patch centres, one per slide
+        weights     -- sampling weights of slides; if `None` and `num_samples` is `None`,
+                       all points are visited in the given order (slide by slide);
+                       if `None` and `num_samples` is given, slides are drawn
+                       proportionally to their numbers of points
+        num_samples -- number of points drawn per epoch
+        block_size  -- number of consecutive points drawn from one slide;
+                       larger blocks reduce switching between slides
+        max_open    -- maximal number of resident slides
+        sampler     -- draws `num_samples` global point indices per epoch
+                       through `sampler.sample(num_samples, rng)`
+                       instead of slide `weights`, e.g. a `ClassBalancedSampler`
+        seed        -- base random seed; epoch `n` is drawn with `seed + n`
+
+        The remaining arguments are as in `PatchIterator`.
+        Batches are `(batch_x, coords, slide_ids)`,
+        or `(batch_x, batch_roi, coords, slide_ids)` if `roi=True`.
+        """
+        if len(slides) != len(points):
+            raise ValueError('expected one set of points per slide: {} slides, {} point sets'
+                             .format(len(slides), len(points)))
+        self.cache = SlideCache(slides, max_open=max_open, reader_kwargs=reader_kwargs)
+        self.points = [np.asarray(pp).reshape(-1, 2) for pp in points]
+        self.offsets = np.concatenate([[0], np.cumsum([len(pp) for pp in self.points])])
+
+        if weights is not None:
+            weights = np.asarray(weights, dtype=float)
+            if len(weights) != len(slides):
+                raise ValueError('expected one weight per slide')
+            if num_samples is None:
+                num_samples = self.num_points
+        elif num_samples is not None:
+            weights = np.diff(self.offsets).astype(float)
+        if weights is not None:
+            # slides without points can not be drawn
+            weights = weights * (np.diff(self.offsets) > 0)
+            if weights.sum() <= 0:
+                raise ValueError('no slide with points and a positive weight')
+            weights = weights / weights.sum()
+        if sampler is not None:
+            if num_samples is None:
+                num_samples = self.num_points
+            if len(sampler.offsets) != len(self.offsets) or \
+                    (sampler.offsets != self.offsets).any():
+                raise ValueError('the sampler is built for different point sets')
+        self.sampler = sampler
+        self.weights = weights
+        self.num_samples = num_samples
+        self.block_size = block_size
+
+        self.side_magn = side*subsample
+        self.subsample = subsample
+        self.batch_size = batch_size
+        self._batch_size = 1 if batch_size is None or batch_size==0 else batch_size
+        self.preprocess = preprocess
+        self.color_last = color_last
+        self.roi = roi
+        self.get_mask_for_names = get_mask_for_names
+        self.use_cached = use_cached
+        self.resampler = resampler
+        self.seed = seed
+        self.set_epoch(0)
+
+    @classmethod
+    def from_plan(cls, fn, shard=0, num_shards=1, **kwargs):
+        """construct from a shard of a sampling plan file (see `slideslicer.sampling_plan`);
+        patch side and subsampling are taken from the plan"""
+        from .sampling_plan import load_sampling_plan, shard_plan, plan_points
+        plan, meta = load_sampling_plan(fn)
+        rows = shard_plan(plan, shard, num_shards)
+        slide_ids = np.unique(rows['slide_id'])
+        slides = [meta['slides'][ii] for ii in slide_ids]
+        points = [plan_points(rows[rows['slide_id'] == ii]) for ii in slide_ids]
+        subsample = meta['params']['subsample']
+        if float(subsample).is_integer():
+            subsample = int(subsample)
+        return cls(slides, points, side=meta['params']['side'], subsample=subsample, **kwargs)
+
+    @property
+    def num_points(self):
+        return int(self.offsets[-1])
+
+    def locate(self, index):
+        "global point index to `(slide index, point index within the slide)`"
+        slide_ind = np.searchsorted(self.offsets, index, side='right') - 1
+        return int(slide_ind), int(index - self.offsets[slide_ind])
+
+    def set_epoch(self, epoch):
+        "draw the global point indices of the epoch and rewind"
+        self.epoch = epoch
+        self.index = -1
+        if self.weights is None and self.sampler is None:
+            self.indices = np.arange(self.num_points)
+            return
+        seed = None if self.seed is None else self.seed + epoch
+        rng = np.random.RandomState(seed)
+        if self.sampler is not None:
+            self.indices = self.sampler.sample(self.num_samples, rng=rng)
+            return
+        nblocks = int(np.ceil(self.num_samples / self.block_size))
+        slide_inds = np.repeat(rng.choice(len(self.weights), size=nblocks, p=self.weights),
+                               self.block_size)[:self.num_samples]
+        counts = np.diff(self.offsets)[slide_inds]
+        self.indices = self.offsets[slide_inds] + (rng.rand(len(slide_inds)) * counts).astype(int)
+
+    def on_epoch_end(self):
+        self.set_epoch(self.epoch + 1)
+
+    def __len__(self):
+        return int(np.ceil(len(self.indices)/self._batch_size))
+
+    def read_sample(self, index):
+        "read a patch (and its ROIs if `roi=True`) by its global point index"
+        slide_ind, point_ind = self.locate(index)
+        reader, slide = self.cache[slide_ind]
+        pp = self.points[slide_ind][point_ind]
+        patch_size = [self.side_magn]*2
+        patch = _get_patch_(slide, *pp, patch_size=patch_size,
+                            scale=self.subsample, use_cached=self.use_cached,
+                            resampler=self.resampler)
+        patch = np.asarray(patch)[...,:3]
+        roi_ = None
+        if self.roi:
+            roi_ = reader.get_patch_rois(*pp, patch_size,
+                                         scale=self.subsample,
+                                         translate=True, cocorle=True,
+                                         refine_tissue=True, patch_img=patch,
+                                         get_mask_for_names=self.get_mask_for_names,
+                                         )
+            if not self.color_last and len(roi_.shape)>2:
+                roi_ = roi_.transpose(2,0,1)
+        if self.preprocess is not None:
+            patch = self.preprocess(patch)
+        if not self.color_last:
+            patch = patch.transpose(2,0,1)
+        return patch, roi_, pp, slide_ind
+
+    def __getitem__(self, key):
+        start = key*self._batch_size
+        end = min(len(self.indices), (1+key)*self._batch_size)
+        assert end>start
+        samples = [self.read_sample(self.indices[ind]) for ind in range(start, end)]
+        batch_x, batch_roi, coords, slide_ids = [list(x) for x in zip(*samples)]
+
+        if self.batch_size is None or self.batch_size==0:
+            batch_x, batch_roi, coords, slide_ids = batch_x[0], batch_roi[0], coords[0], slide_ids[0]
+        else:
+            batch_x = np.stack(batch_x)
+            coords = np.stack(coords)
+            slide_ids = np.asarray(slide_ids)
+            if self.roi and (self.get_mask_for_names is not None) and \
+                    len(set([x.shape for x in batch_roi]))==1:
+                batch_roi = np.stack(batch_roi)
+
+        if self.roi:
+            return (batch_x, batch_roi, coords, slide_ids)
+        return (batch_x, coords, slide_ids)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        self.index += 1
+        if self.index >= len(self):
+            raise StopIteration
+        return self[self.index]
+
+    def close(self):
+        self.cache.close()
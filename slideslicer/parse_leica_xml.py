@@ -1,4 +1,5 @@
 import numpy as np
+from array import array
 import lxml
 import lxml.etree
 
@@ -15,8 +16,8 @@ def _parse_vertices_(reg):
     return vertices
 
 
-def _parse_xml_region_all_attrs_(reg, vertices_np=False):
-    attrs = dict(reg.attrib)
+def _convert_attrs_(attrs):
+    "convert types of annotation attributes"
     types_ = {'Name':str,
               'Type':str,
                'PartOfGroup': str,
@@ -31,6 +32,16 @@ def _parse_xml_region_all_attrs_(reg, vertices_np=False):
             except Exception as ee:
                 attrs[kk] = -1
                 print(kk, ee)
+    return attrs
+
+
+def _lower_keys_(attrs):
+    return dict(zip(map(lambda x:x.lower(),attrs.keys()),
+                attrs.values()))
+
+
+def _parse_xml_region_all_attrs_(reg, vertices_np=False):
+    attrs = _convert_attrs_(dict(reg.attrib))
 
 #    for kk ['Id', 'Text', 'Area']:
 #        vv = attrs[kk]
@@ -41,8 +52,7 @@ def _parse_xml_region_all_attrs_(reg, vertices_np=False):
     attrs['Vertices'] = _parse_vertices_(reg)
     if vertices_np:
         attrs['Vertices'] = np.asarray(attrs['Vertices'])
-    return dict(zip(map(lambda x:x.lower(),attrs.keys()),
-                attrs.values()))
+    return _lower_keys_(attrs)
 
 def _parse_xml_region_(reg):
     "parse a `region` element from Leica annotation XML"
@@ -60,10 +70,74 @@ def _parse_xml_region_(reg):
            "vertices": vertices,
           }
 
-def parse_xml2annotations(fnxml):
+def iter_xml_annotations(fnxml, dtype=np.float32):
+    """Stream annotations from a leica XML annotation file.
+    The file is parsed incrementally with `lxml.etree.iterparse`;
+    coordinates are collected directly into a flat buffer
+    and parsed elements are freed, so that the peak memory
+    is bounded by the largest single annotation.
+
+    Yields dictionaries with lower-cased attributes of `Annotation` elements
+    and `vertices` as a `[n x 2]` array of given `dtype`
+    """
+    typecode = 'f' if np.dtype(dtype).itemsize == 4 else 'd'
+    coords = array(typecode)
+    for _, elem in lxml.etree.iterparse(fnxml, events=('end',),
+                                        tag=('Coordinate', 'Annotation')):
+        if elem.tag == 'Coordinate':
+            coords.append(float(elem.get('X')))
+            coords.append(float(elem.get('Y')))
+        else:
+            attrs = _convert_attrs_(dict(elem.attrib))
+            attrs['Vertices'] = np.frombuffer(coords, dtype=typecode).astype(dtype).reshape(-1, 2)
+            coords = array(typecode)
+            yield _lower_keys_(attrs)
+        # free the parsed element and its already processed siblings
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+
+def parse_xml2columns(fnxml, dtype=np.float32):
+    """Convert a leica XML annotation into a compact columnar form:
+    {
+     'vertices': [N x 2] array of all vertices concatenated,
+     'offsets' : [n+1] array; vertices of i-th annotation are `vertices[offsets[i]:offsets[i+1]]`,
+     <attribute>: list of n values for every other attribute (id, name, type, ...)
+    }
+    see `columns2annotations` for the inverse
+    """
+    coords = array('f' if np.dtype(dtype).itemsize == 4 else 'd')
+    offsets = [0]
+    columns = {}
+    for nn, roi in enumerate(iter_xml_annotations(fnxml, dtype=dtype)):
+        coords.extend(roi.pop('vertices').ravel())
+        offsets.append(len(coords)//2)
+        for kk in list(columns) + [kk for kk in roi if kk not in columns]:
+            columns.setdefault(kk, [None]*nn).append(roi.get(kk))
+    columns['vertices'] = np.frombuffer(coords, dtype=dtype).reshape(-1, 2)
+    columns['offsets'] = np.asarray(offsets, dtype=np.int64)
+    return columns
+
+
+def columns2annotations(columns):
+    "convert the output of `parse_xml2columns` into a list of dictionaries"
+    offsets = columns['offsets']
+    attrs = [kk for kk in columns if kk not in ('vertices', 'offsets')]
+    rois = []
+    for nn, (start, end) in enumerate(zip(offsets[:-1], offsets[1:])):
+        roi = {kk: columns[kk][nn] for kk in attrs}
+        roi['vertices'] = columns['vertices'][start:end]
+        rois.append(roi)
+    return rois
+
+
+def parse_xml2annotations(fnxml, vertices_np=False):
     """Convert a leica XML annotation to a list of dictionaries
     Input:
         xml file name
+        vertices_np -- return vertices as float32 numpy arrays
+                       (by default: lists of [x, y] pairs)
         
     Output:
         a list of dictionaries with entries:
@@ -71,21 +145,12 @@ def parse_xml2annotations(fnxml):
          - tag      : "Textt" field
          - vertices : list of [(x1, y1), (x2, y2), ...] 
     """
-    root = lxml.etree.parse(fnxml)
+    if vertices_np:
+        return list(iter_xml_annotations(fnxml))
     rois = []
-
-    annotations = root.xpath('//*/Annotation')
-    for ann in annotations:
-        # try:
-        #     attrbs = ann.xpath('./Attributes')[0]
-        #     attrb = attrbs.xpath('''./Attribute[contains(@Name,'Description')]''')[0]
-        #     name = attrb.xpath('./@Value')
-        #     name = name[0]
-        # except:
-        #     name = None
-        # Get all "Region" elements in the tree
-        #for reg in ann.xpath('./*/Region'):
-        rois.append(_parse_xml_region_all_attrs_(ann))
+    for roi in iter_xml_annotations(fnxml, dtype=np.float64):
+        roi['vertices'] = roi['vertices'].tolist()
+        rois.append(roi)
     return rois
 
 # legacy
@@ -0,0 +1,78 @@
+# coding: utf-8
+"""a minimal staged thread pipeline connected with bounded queues
+
+    source -> [stage 1 workers] -> queue -> [stage 2 workers] -> ...
+
+The source is consumed in the calling thread. A full queue blocks
+the upstream stage, which keeps the number of items in flight
+(and thus memory) bounded by the queue sizes and worker counts,
+and lets the slowest stage rather than the sum of the stages set the throughput.
+Most of the heavy lifting in slide export (openslide decoding, cv2, zlib, pycocotools)
+releases the GIL, so threads are sufficient.
+"""
+import threading
+from queue import Queue
+
+_DONE = object()
+
+
+def _worker_(func, inq, outq, errors):
+    while True:
+        item = inq.get()
+        if item is _DONE:
+            break
+        if errors:
+            # drain the queue so that upstream stages do not block
+            continue
+        try:
+            out = func(item)
+        except BaseException as ee:
+            errors.append(ee)
+            continue
+        if outq is not None:
+            outq.put(out)
+
+
+def run_pipeline(source, stages, queue_size=8):
+    """run items from `source` through a sequence of stages
+
+    Inputs:
+    source      -- an iterable of items; iterated in the calling thread
+    stages      -- a list of `(function, num_workers)` tuples;
+                   each function takes an output of the previous stage;
+                   outputs of the last stage are discarded
+    queue_size  -- capacity of each queue in front of a stage
+
+    Returns the number of items consumed from `source`.
+    The first exception raised within a stage is re-raised after shutdown.
+    """
+    queues = [Queue(maxsize=queue_size) for _ in stages]
+    errors = []
+    threads = []
+    for nn, (func, num_workers) in enumerate(stages):
+        outq = queues[nn+1] if nn+1 < len(stages) else None
+        group = [threading.Thread(target=_worker_,
+                                  args=(func, queues[nn], outq, errors),
+                                  daemon=True)
+                 for _ in range(max(1, num_workers))]
+        for th in group:
+            th.start()
+        threads.append(group)
+
+    count = 0
+    try:
+        for item in source:
+            if errors:
+                break
+            queues[0].put(item)
+            count += 1
+    finally:
+        # shut down stage by stage, so that sentinels follow all items
+        for nn, group in enumerate(threads):
+            for _ in group:
+                queues[nn].put(_DONE)
+            for th in group:
+                th.join()
+    if errors:
+        raise errors[0]
+    return count
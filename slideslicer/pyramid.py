@@ -0,0 +1,342 @@
+# coding: utf-8
+"""tiled multi-resolution pyramids of heatmaps and label rasters
+
+`write_pyramid` turns an `[H x W (x C)]` array, typically the memory-mapped canvas
+of a `slideslicer.stitch.Stitcher`, into a tiled pyramid of levels downsampled
+by `level_factor` (a power of 2; 4 by default, as in SVS slides) until the level
+fits in one tile. Every level is built tile by tile from the previous one by halving
+(reduced levels are kept in temporary memory maps), so nothing is loaded whole
+into memory. Two layouts are supported:
+
+    tiff   -- a tiled (Big)TIFF with the reduced levels as sub-IFDs, written with `tifffile`
+    tiles  -- a directory `{fn}/{level}/{row}_{col}.png` (uint8 L, RGB, or RGBA)
+              or `.npy` (other data) with a `{fn}/pyramid.json` index
+
+`PyramidReader` opens either layout with the interface of `openslide.OpenSlide`
+(`dimensions`, `level_dimensions`, `level_downsamples`, `read_region`, ...),
+so that it can stand in for a slide in `RoiReader`-free code paths such as `_get_patch_`
+(which assumes levels downsampled by 4, its default `magn_base`):
+
+    write_pyramid(stitcher.finalize(), 'pred.tif', reduce='mean')
+    pyramid = PyramidReader('pred.tif')
+    region = pyramid.read_region((x, y), 2, (512, 512))
+
+    patch = _get_patch_(pyramid, xc, yc, patch_size=[1024, 1024], scale=4, resampler='auto')
+
+    python -m slideslicer.pyramid pred.npy pred.tif --reduce mean
+"""
+import os
+import json
+import tempfile
+import warnings
+import numpy as np
+from PIL import Image
+
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+REDUCTIONS = ('mean', 'max', 'nearest')
+
+
+def _num_halvings_(level_factor):
+    halvings = int(round(np.log2(level_factor)))
+    if halvings < 1 or 2**halvings != level_factor:
+        raise ValueError('level factor must be a power of 2: %s' % level_factor)
+    return halvings
+
+
+def get_level_dimensions(dimensions, tile_size=256, num_levels=None, level_factor=4):
+    """sizes `(width, height)` of pyramid levels downsampled by `level_factor` (a power of 2),
+    down to the first level that fits in one tile (or `num_levels` levels)"""
+    _num_halvings_(level_factor)
+    levels = [tuple(int(x) for x in dimensions)]
+    while (num_levels is None and max(levels[-1]) > tile_size) or \
+            (num_levels is not None and len(levels) < num_levels):
+        width, height = levels[-1]
+        if width == 1 and height == 1:
+            break
+        levels.append((-(-width//level_factor), -(-height//level_factor)))
+    return levels
+
+
+def reduce_block(block, method='mean'):
+    """downsample an `[h x w x C]` block by 2; odd edges are padded by replication.
+    `mean` averages (NaN-aware for floats), `max` keeps the maximum (e.g. for label rasters),
+    `nearest` keeps the top-left pixel"""
+    if method not in REDUCTIONS:
+        raise ValueError('unknown reduction: %s' % method)
+    if method == 'nearest':
+        return block[::2, ::2]
+    h, w = block.shape[:2]
+    if h % 2 or w % 2:
+        block = np.pad(block, ((0, h % 2), (0, w % 2), (0, 0)), mode='edge')
+    blocks = block.reshape((block.shape[0]//2, 2, block.shape[1]//2, 2) + block.shape[2:])
+    if method == 'max':
+        return blocks.max(axis=(1, 3))
+    if np.issubdtype(block.dtype, np.floating):
+        # all-NaN blocks (e.g. outside of the tissue) stay NaN
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            out = np.nanmean(blocks.astype(np.float32), axis=(1, 3))
+        return out.astype(block.dtype)
+    out = blocks.sum(axis=(1, 3), dtype=np.uint32 if block.dtype.itemsize <= 2 else np.int64)
+    return ((out + 2) // 4).astype(block.dtype)
+
+
+def _as_3d_(arr):
+    return arr if arr.ndim == 3 else arr[..., None]
+
+
+def _halve_(src, tile_size, method):
+    "`src` downsampled by 2 into a temporary memory map, built tile by tile"
+    height, width = (src.shape[0] + 1)//2, (src.shape[1] + 1)//2
+    # the mapping stays valid after the file is closed and is removed with it
+    with tempfile.TemporaryFile() as fh:
+        dst = np.memmap(fh, dtype=src.dtype, mode='w+', shape=(height, width, src.shape[2]))
+    for y0 in range(0, height, tile_size):
+        for x0 in range(0, width, tile_size):
+            block = src[2*y0:2*(y0+tile_size), 2*x0:2*(x0+tile_size)]
+            reduced = reduce_block(np.asarray(block), method)
+            dst[y0:y0+tile_size, x0:x0+tile_size] = reduced[:min(tile_size, height-y0),
+                                                             :min(tile_size, width-x0)]
+    return dst
+
+
+def _build_levels_(data, level_dims, tile_size, method, level_factor=4):
+    "yield level arrays; every level is the previous one halved `log2(level_factor)` times"
+    src = _as_3d_(data)
+    yield src
+    for _ in level_dims[1:]:
+        for _ in range(_num_halvings_(level_factor)):
+            src = _halve_(src, tile_size, method)
+        yield src
+
+
+def _iter_tiles_(level, tile_size):
+    "full-size tiles of a level in row-major order, padded with zeros at the edges"
+    height, width = level.shape[:2]
+    for y0 in range(0, height, tile_size):
+        for x0 in range(0, width, tile_size):
+            tile = np.asarray(level[y0:y0+tile_size, x0:x0+tile_size])
+            if tile.shape[:2] != (tile_size, tile_size):
+                full = np.zeros((tile_size, tile_size) + tile.shape[2:], dtype=tile.dtype)
+                full[:tile.shape[0], :tile.shape[1]] = tile
+                tile = full
+            yield tile
+
+
+def _is_image_(dtype, channels):
+    return np.dtype(dtype) == np.uint8 and channels in (1, 3, 4)
+
+
+def write_pyramid(data, fn, tile_size=256, num_levels=None, reduce='mean',
+                  layout='auto', compression='zlib', level_factor=4):
+    """write an `[H x W (x C)]` array (e.g. a memory map) as a tiled pyramid
+    (see the module docstring).
+
+    Inputs:
+    data        -- level-0 data
+    fn          -- output `.tif` / `.tiff` file or tile directory
+    tile_size   -- tile side (a multiple of 16 for TIFF)
+    num_levels  -- number of levels (default: down to one tile)
+    reduce      -- downsampling of levels: `mean` (heatmaps), `max` or `nearest` (label rasters)
+    layout      -- `tiff`, `tiles`, or `auto` (by the file extension)
+    compression -- TIFF tile compression (e.g. `zlib`, `None`)
+    level_factor -- downsampling between levels (a power of 2; 4 matches `_get_patch_`)
+    Returns the level dimensions"""
+    if layout == 'auto':
+        layout = 'tiff' if fn.lower().endswith(('.tif', '.tiff')) else 'tiles'
+    if layout not in ('tiff', 'tiles'):
+        raise ValueError('unknown pyramid layout: %s' % layout)
+    height, width = data.shape[:2]
+    channels = data.shape[2] if data.ndim == 3 else 1
+    level_dims = get_level_dimensions((width, height), tile_size, num_levels, level_factor)
+    levels = _build_levels_(data, level_dims, tile_size, reduce, level_factor)
+
+    if layout == 'tiff':
+        if tifffile is None:
+            raise ImportError('writing TIFF pyramids requires `tifffile`; use `layout="tiles"`')
+        photometric = 'rgb' if channels in (3, 4) and data.dtype == np.uint8 else 'minisblack'
+        extrasamples = ('unassalpha',) if photometric == 'rgb' and channels == 4 else None
+        with tifffile.TiffWriter(fn, bigtiff=True) as tif:
+            for nn, level in enumerate(levels):
+                shape = level.shape if channels > 1 else level.shape[:2]
+                tiles = _iter_tiles_(level, tile_size)
+                if channels == 1:
+                    tiles = (tile[..., 0] for tile in tiles)
+                tif.write(tiles, shape=shape, dtype=level.dtype,
+                          tile=(tile_size, tile_size), compression=compression,
+                          photometric=photometric, extrasamples=extrasamples,
+                          planarconfig='contig' if channels > 1 else None,
+                          subifds=len(level_dims) - 1 if nn == 0 else None,
+                          subfiletype=1 if nn > 0 else 0,
+                          metadata=None)
+        return level_dims
+
+    as_image = _is_image_(data.dtype, channels)
+    for nn, level in enumerate(levels):
+        os.makedirs(os.path.join(fn, str(nn)), exist_ok=True)
+        lheight, lwidth = level.shape[:2]
+        for row, y0 in enumerate(range(0, lheight, tile_size)):
+            for col, x0 in enumerate(range(0, lwidth, tile_size)):
+                tile = np.asarray(level[y0:y0+tile_size, x0:x0+tile_size])
+                path = os.path.join(fn, str(nn), '{}_{}'.format(row, col))
+                if as_image:
+                    Image.fromarray(tile[..., 0] if channels == 1 else tile).save(path + '.png')
+                else:
+                    np.save(path + '.npy', tile)
+    with open(os.path.join(fn, 'pyramid.json'), 'w') as fh:
+        json.dump({'level_dimensions': level_dims,
+                   'tile_size': tile_size,
+                   'dtype': np.dtype(data.dtype).str,
+                   'channels': channels,
+                   'format': 'png' if as_image else 'npy',
+                   'reduce': reduce,
+                   }, fh)
+    return level_dims
+
+
+class PyramidReader():
+    """read a pyramid written by `write_pyramid` with the interface of `openslide.OpenSlide`.
+    `read_region` returns an RGBA PIL image for uint8 RGB(A) pyramids, as OpenSlide does,
+    and an `[h x w (x C)]` numpy array otherwise; pixels outside of the level
+    are transparent, or `fill_value` for arrays"""
+    def __init__(self, fn, fill_value=0):
+        self.filename = fn
+        self.fill_value = fill_value
+        self._tif = None
+        if os.path.isdir(fn):
+            with open(os.path.join(fn, 'pyramid.json')) as fh:
+                meta = json.load(fh)
+            self.level_dimensions = tuple(tuple(dd) for dd in meta['level_dimensions'])
+            self.tile_size = meta['tile_size']
+            self.dtype = np.dtype(meta['dtype'])
+            self.channels = meta['channels']
+            self._format = meta['format']
+        else:
+            if tifffile is None:
+                raise ImportError('reading TIFF pyramids requires `tifffile`')
+            self._tif = tifffile.TiffFile(fn)
+            self._pages = [level.keyframe for level in self._tif.series[0].levels]
+            self.level_dimensions = tuple((page.imagewidth, page.imagelength)
+                                          for page in self._pages)
+            self.tile_size = self._pages[0].tilewidth
+            self.dtype = self._pages[0].dtype
+            self.channels = self._pages[0].samplesperpixel
+        width, height = self.level_dimensions[0]
+        self.level_downsamples = tuple((width / ww + height / hh) / 2
+                                       for ww, hh in self.level_dimensions)
+        self.properties = {'openslide.level-count': str(self.level_count)}
+        self.associated_images = {}
+
+    @property
+    def dimensions(self):
+        return self.level_dimensions[0]
+
+    @property
+    def level_count(self):
+        return len(self.level_dimensions)
+
+    def get_best_level_for_downsample(self, downsample):
+        levels = [ll for ll, ds in enumerate(self.level_downsamples) if ds <= downsample*(1+1e-6)]
+        return max(levels) if levels else 0
+
+    def read_tile(self, level, row, col):
+        "a tile as an `[h x w x C]` array (edge tiles of the tile layout may be smaller)"
+        if self._tif is None:
+            path = os.path.join(self.filename, str(level), '{}_{}'.format(row, col))
+            if self._format == 'png':
+                tile = np.asarray(Image.open(path + '.png'))
+            else:
+                tile = np.load(path + '.npy')
+            return _as_3d_(tile)
+        page = self._pages[level]
+        tiles_across = -(-page.imagewidth // page.tilewidth)
+        index = row * tiles_across + col
+        fh = self._tif.filehandle
+        with fh.lock:
+            fh.seek(page.dataoffsets[index])
+            data = fh.read(page.databytecounts[index])
+        segment = page.decode(data, index, jpegtables=page.jpegtables)[0]
+        return segment.reshape(page.tilelength, page.tilewidth, -1)
+
+    def read_array(self, location, level, size):
+        """read a region as an `[h x w x C]` array; `location` is the top left corner
+        in level-0 pixels (as in `openslide.OpenSlide.read_region`).
+        Also returns a boolean mask of pixels within the level"""
+        downsample = self.level_downsamples[level]
+        lwidth, lheight = self.level_dimensions[level]
+        x0, y0 = [int(np.floor(cc / downsample)) for cc in location]
+        w, h = [int(ss) for ss in size]
+        out = np.full((h, w, self.channels), self.fill_value, dtype=self.dtype)
+        valid = np.zeros((h, w), dtype=bool)
+        ts = self.tile_size
+        xs, ys = max(0, x0), max(0, y0)
+        xe, ye = min(lwidth, x0 + w), min(lheight, y0 + h)
+        for row in range(ys // ts, -(-ye // ts)):
+            for col in range(xs // ts, -(-xe // ts)):
+                tile = self.read_tile(level, row, col)
+                tx0, ty0 = col*ts, row*ts
+                # intersection of the tile with the requested region
+                ix0, iy0 = max(xs, tx0), max(ys, ty0)
+                ix1, iy1 = min(xe, tx0 + ts), min(ye, ty0 + ts)
+                out[iy0-y0:iy1-y0, ix0-x0:ix1-x0] = tile[iy0-ty0:iy1-ty0, ix0-tx0:ix1-tx0]
+                valid[iy0-y0:iy1-y0, ix0-x0:ix1-x0] = True
+        return out, valid
+
+    def read_region(self, location, level, size):
+        out, valid = self.read_array(location, level, size)
+        if not _is_image_(self.dtype, self.channels) or self.channels == 1:
+            return out if self.channels > 1 else out[..., 0]
+        rgba = np.zeros(out.shape[:2] + (4,), dtype=np.uint8)
+        rgba[..., :self.channels] = out
+        if self.channels == 3:
+            rgba[..., 3] = 255
+        rgba[~valid] = 0
+        return Image.fromarray(rgba, 'RGBA')
+
+    def get_thumbnail(self, size):
+        "a thumbnail from the smallest level that is still larger than `size`"
+        downsample = max(dd / ss for dd, ss in zip(self.dimensions, size))
+        level = self.get_best_level_for_downsample(downsample)
+        region = self.read_region((0, 0), level, self.level_dimensions[level])
+        img = region.convert('RGB') if isinstance(region, Image.Image) else \
+            Image.fromarray(np.asarray(region))
+        img.thumbnail(size)
+        return img
+
+    def close(self):
+        if self._tif is not None:
+            self._tif.close()
+            self._tif = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='write a `.npy` canvas (e.g. stitched predictions) as a tiled pyramid')
+    parser.add_argument('input', type=str, help='input `.npy` array `[H x W (x C)]`')
+    parser.add_argument('output', type=str, help='output `.tif` file or tile directory')
+    parser.add_argument('--tile-size', type=int, default=256, help='tile side')
+    parser.add_argument('--num-levels', type=int, default=None, help='number of levels')
+    parser.add_argument('--reduce', type=str, default='mean', choices=REDUCTIONS,
+                        help='downsampling: `mean` for heatmaps, `max` or `nearest` for labels')
+    parser.add_argument('--layout', type=str, default='auto', choices=['auto', 'tiff', 'tiles'])
+    parser.add_argument('--level-factor', type=int, default=4,
+                        help='downsampling between levels (a power of 2)')
+    prms = parser.parse_args()
+
+    level_dims = write_pyramid(np.load(prms.input, mmap_mode='r'), prms.output,
+                               tile_size=prms.tile_size, num_levels=prms.num_levels,
+                               reduce=prms.reduce, layout=prms.layout,
+                               level_factor=prms.level_factor)
+    print('levels:', ' '.join('{}x{}'.format(*dd) for dd in level_dims))
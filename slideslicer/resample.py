@@ -0,0 +1,108 @@
+# coding: utf-8
+"""downsampling of slide regions
+
+Resamplers take an `[H x W x C]` uint8 array (or a PIL image)
+and return a uint8 array of the target size:
+
+    box        -- integer-factor reduction by averaging `f x f` blocks (numpy reshape-mean);
+                  exact area averaging, falls back to `area` for non-integer factors
+    area       -- `cv2.resize(..., interpolation=cv2.INTER_AREA)`
+    pil        -- Pillow Lanczos filter with `reducing_gap`
+                  (a fast integer pre-reduction before the filter)
+    lanczos    -- Pillow Lanczos filter without pre-reduction (formerly `ANTIALIAS`)
+    auto       -- `area` (which is an exact box average for integer factors and the fastest);
+                  without OpenCV, `box` for integer factors and `pil` otherwise
+
+RGBA regions returned by openslide are reduced to RGB before resampling.
+Arrays of other types (heatmaps and label rasters read from `slideslicer.pyramid`)
+are resized with `resample_array`.
+"""
+import numpy as np
+from PIL import Image
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+RESAMPLERS = ('auto', 'box', 'area', 'pil', 'lanczos')
+
+
+def _as_rgb_array_(img, nchannels=3):
+    if isinstance(img, Image.Image):
+        if img.mode == 'RGBA' and nchannels == 3:
+            img = img.convert('RGB')
+        img = np.asarray(img)
+    return img[..., :nchannels] if img.ndim == 3 else img
+
+
+def _integer_factor_(shape, size):
+    "common integer reduction factor from `shape` `(h, w)` to `size` `(w, h)`, or `None`"
+    fy, fx = shape[0] / size[1], shape[1] / size[0]
+    factor = int(round(fx))
+    if factor >= 1 and abs(fx - factor) < 1e-6 and abs(fy - factor) < 1e-6:
+        return factor
+    # allow for the rounding of odd sizes
+    factor = shape[1] // size[0]
+    if factor >= 1 and shape[1] // factor == size[0] and shape[0] // factor == size[1]:
+        return factor
+    return None
+
+
+def reduce_box(img, factor):
+    "average `factor x factor` blocks of an `[H x W (x C)]` array; trailing rows / columns are cropped"
+    if factor == 1:
+        return img
+    h, w = img.shape[0] // factor, img.shape[1] // factor
+    blocks = img[:h*factor, :w*factor].reshape((h, factor, w, factor) + img.shape[2:])
+    # uint16 sums are exact for factors up to 16
+    dtype = np.uint16 if factor <= 16 else np.uint32
+    out = blocks.sum(axis=(1, 3), dtype=dtype)
+    out += factor*factor // 2
+    return (out // (factor*factor)).astype(np.uint8)
+
+
+def resample(img, size, method='auto', reducing_gap=2.0, nchannels=3):
+    """downsample an image to `size = (width, height)` with a given `method` (see module docstring);
+    returns a uint8 array with `nchannels` channels"""
+    if method not in RESAMPLERS:
+        raise ValueError('unknown resampler: %s' % method)
+    size = (int(size[0]), int(size[1]))
+    if method in ('pil', 'lanczos'):
+        if not isinstance(img, Image.Image):
+            img = Image.fromarray(_as_rgb_array_(img, nchannels))
+        elif img.mode == 'RGBA' and nchannels == 3:
+            img = img.convert('RGB')
+        img = img.resize(size, Image.LANCZOS,
+                         reducing_gap=reducing_gap if method == 'pil' else None)
+        return np.asarray(img)
+
+    img = _as_rgb_array_(img, nchannels)
+    if (img.shape[1], img.shape[0]) == size:
+        return img
+    if method == 'box' or (method == 'auto' and cv2 is None):
+        factor = _integer_factor_(img.shape, size)
+        if factor is not None:
+            return reduce_box(img, factor)
+        if cv2 is None:
+            return resample(img, size, method='pil', reducing_gap=reducing_gap)
+    if cv2 is None:
+        raise ImportError('`area` resampling requires OpenCV')
+    return cv2.resize(np.ascontiguousarray(img), size, interpolation=cv2.INTER_AREA)
+
+
+def resample_array(arr, size):
+    """resize an `[H x W (x C)]` array of any type to `size = (width, height)`:
+    floats are area-averaged, integer arrays (label rasters) keep nearest values"""
+    size = (int(size[0]), int(size[1]))
+    if (arr.shape[1], arr.shape[0]) == size:
+        return arr
+    if np.issubdtype(arr.dtype, np.floating):
+        if cv2 is None:
+            raise ImportError('resampling of float arrays requires OpenCV')
+        out = cv2.resize(np.ascontiguousarray(arr, dtype=np.float32), size,
+                         interpolation=cv2.INTER_AREA)
+        return out.reshape(size[::-1] + arr.shape[2:]).astype(arr.dtype)
+    rows = (np.arange(size[1]) + 0.5) * arr.shape[0] / size[1]
+    cols = (np.arange(size[0]) + 0.5) * arr.shape[1] / size[0]
+    return arr[rows.astype(int)[:, None], cols.astype(int)]
@@ -1,14 +1,11 @@
+import os
 import re
 import json
 import numpy as np
-import pandas as pd
 import openslide
 import shapely
 from shapely import affinity
 from shapely.geometry import Polygon, MultiPolygon, MultiLineString, GeometryCollection
-from descartes import PolygonPatch
-import matplotlib.pyplot as plt
-from matplotlib import colors
 from itertools import cycle
 from functools import partial, reduce
 from warnings import warn
@@ -17,41 +14,63 @@ from .slideutils import (get_vertices, get_roi_dict, get_median_color,
                         get_thumbnail_magnification, plot_contour)
 
 from .parse_leica_xml import parse_xml2annotations
-from .geom_tools import resolve_selfintersection, get_ellipse_verts_from_bbox
+from .geom_tools import resolve_selfintersection, get_ellipse_verts_from_bbox, curve_order
 from .slideutils import sample_points, CentredRectangle
+from .lazyimport import lazy_import
 
+# pandas and plotting libraries are loaded on first use
+pd = lazy_import('pandas')
 
 
-class ROIFrame(pd.DataFrame):
-    def __init__(self, *args, **kwargs):
-        pd.DataFrame.__init__(self, *args, **kwargs)
+def _get_roiframe_():
+    if 'ROIFrame' in globals():
+        return globals()['ROIFrame']
 
-    def to_dict(self, orient='records'):
-        return pd.DataFrame.to_dict(self, orient=orient)
+    class ROIFrame(pd.DataFrame):
+        def __init__(self, *args, **kwargs):
+            pd.DataFrame.__init__(self, *args, **kwargs)
 
-    def to_json(self, path_or_buf=None, orient='records',
-                lines=False, compression=None, index=True,
-                **kwargs):
-        return pd.DataFrame.to_json(self, orient=orient,
-                lines=lines, compression=compression, index=index,
-                **kwargs)
+        def to_dict(self, orient='records'):
+            return pd.DataFrame.to_dict(self, orient=orient)
+
+        def to_json(self, path_or_buf=None, orient='records',
+                    lines=False, compression=None, index=True,
+                    **kwargs):
+            return pd.DataFrame.to_json(self, orient=orient,
+                    lines=lines, compression=compression, index=index,
+                    **kwargs)
+
+        def __getitem__(self, key):
+            data = pd.DataFrame.__getitem__(self, key)
+            if isinstance(data, pd.DataFrame):
+                return ROIFrame(data)
+            else:
+                return data
+    ROIFrame.__qualname__ = 'ROIFrame'
+    globals()['ROIFrame'] = ROIFrame
+    return ROIFrame
+
+
+def __getattr__(name):
+    # `ROIFrame` subclasses a pandas data frame and is defined on first use
+    if name == 'ROIFrame':
+        return _get_roiframe_()
+    raise AttributeError('module {} has no attribute {}'.format(__name__, name))
 
-    def __getitem__(self, key):
-        data = pd.DataFrame.__getitem__(self, key)
-        if isinstance(data, pd.DataFrame):
-            return ROIFrame(data)
-        else:
-            return data
-        
 
 def _get_patch_(slide, xc, yc,
               patch_size = [1024, 1024],
               magn_base = 4,
               scale = 2,
               use_cached=True,
+              resampler=None,
              ):
     """retrieve a patch from openslide with given center point, size, and subsampling rate
-    currently tested only on Leica SVS slides"""
+    currently tested only on Leica SVS slides.
+    With `resampler=None` a PIL RGBA image is returned (resampled with the Lanczos filter);
+    otherwise an RGB uint8 array downsampled with the given method (see `slideslicer.resample`).
+    Slides that return arrays from `read_region` (float or label pyramids of `slideslicer.pyramid`)
+    give an array of the same type"""
     if scale>0:
         target_subsample = max(scale, 1/scale)
     else:
@@ -65,31 +84,76 @@ def _get_patch_(slide, xc, yc,
 
     size_ = [ps//(magn_base**magn_exp) for ps in patch_size]
     region_ = slide.read_region((int(xc-patch_size[0]//2), int(yc-patch_size[1]//2)), magn_exp, size_)
+    if isinstance(region_, np.ndarray):
+        from .resample import resample_array
+        return resample_array(region_, [int(subsample * s) for s in region_.shape[1::-1]])
+    if resampler is not None:
+        from .resample import resample
+        return resample(region_, [int(subsample * s) for s in region_.size], method=resampler)
     if subsample!= 1.0:
+        # `LANCZOS` is the filter formerly known as `ANTIALIAS`
         region_ = region_.resize([int(subsample * s) for s in region_.size], 
-                                 openslide.Image.ANTIALIAS)
-        #region_ = np.asarray(region_)[...,:3]
-        #region_ = cv2.resize(region_, (0,0), fx=subsample, fy=subsample,
-        #                        interpolation = cv2.INTER_AREA)
+                                 openslide.Image.LANCZOS)
     return region_
 
 
+def _get_patch_pyramid_(slide, xc, yc, size, scales,
+                        use_cached=True, resampler='auto'):
+    """retrieve patches of the same output `size = (w, h)` centred at `(xc, yc)`
+    at several `scales` (downsampling factors relative to level 0).
+    Scales are grouped by the pyramid level they are read from;
+    every level is read and decoded once, over the field of view of its coarsest scale,
+    and finer scales are cropped from it and downsampled.
+    Returns a `[len(scales) x h x w x 3]` uint8 array"""
+    from .resample import resample
+    w, h = size
+    downsamples = slide.level_downsamples
+    groups = {}
+    for nn, scale in enumerate(scales):
+        if use_cached:
+            # downsamples of real slides are inexact, e.g. `(1, 4.000121, 16.0069)`
+            level = max(ll for ll, ds in enumerate(downsamples) if ds <= scale*(1+1e-2)) \
+                    if scale >= 1 else 0
+        else:
+            level = 0
+        groups.setdefault(level, []).append(nn)
+
+    out = np.empty((len(scales), h, w, 3), dtype=np.uint8)
+    for level, members in groups.items():
+        ds = downsamples[level]
+        maxscale = max(scales[nn] for nn in members)
+        # region of the coarsest scale, in pixels of the level
+        rw, rh = int(np.ceil(w*maxscale/ds)), int(np.ceil(h*maxscale/ds))
+        x0, y0 = xc - rw*ds/2, yc - rh*ds/2
+        region = np.asarray(slide.read_region((int(round(x0)), int(round(y0))), level, (rw, rh)))[..., :3]
+        for nn in members:
+            cw, ch = int(round(w*scales[nn]/ds)), int(round(h*scales[nn]/ds))
+            left, top = (rw - cw)//2, (rh - ch)//2
+            crop = region[top:top+ch, left:left+cw]
+            if (cw, ch) != (w, h):
+                crop = resample(crop, (w, h), method=resampler)
+            out[nn] = crop
+    return out
+
+
 def find_chunk_content(roilist):
     """finds features (gloms, infl, etc) contained within tissue chunks.
+    ROIs are identified by their positions in `roilist`
+    (names are shared by all chunks and `id`s may be missing).
     Returns a dictionary:
-    {tissue_chunk_1_id: [feature_1_id, ..., feature_n_id],
-     tissue_chunk_1_id: [...]
+    {tissue_chunk_1_position: [feature_1_position, ..., feature_n_position],
+     tissue_chunk_2_position: [...]
     }
     Requires `shapely` package
     """
     pgs_tissue = {}
     pgs_feature = {}
-    for roi in roilist:
+    for nn, roi in enumerate(roilist):
         try:
             if roi["name"]=="tissue":
-                pgs_tissue[roi['name']] = Polygon(roi["vertices"])
+                pgs_tissue[nn] = Polygon(roi["vertices"])
             else:
-                pgs_feature[roi['name']] = Polygon(roi["vertices"])
+                pgs_feature[nn] = Polygon(roi["vertices"])
         except ValueError as ee:
             warn(str(ee))
             continue
@@ -111,7 +175,7 @@ def remove_empty_tissue_chunks(roilist):
     """removes tissue chunks that contain no annotation contours within"""
     chunk_content = find_chunk_content(roilist)
     empty_chunks = set([kk for kk,vv in chunk_content.items() if len(vv)==0])
-    return [roi for roi in roilist if roi['name'] not in empty_chunks]
+    return [roi for nn, roi in enumerate(roilist) if nn not in empty_chunks]
 
 
 class RoiReader():
@@ -125,6 +189,8 @@ class RoiReader():
                   save=True, outdir=None, minlen=50,
                   annotation_format='leica',
                   slide_format='leica',
+                  cache_dir=None,
+                  lazy=False,
                   verbose=True):
         """
         extract and save rois
@@ -140,37 +206,129 @@ class RoiReader():
         keeplevels    -- number of file path elements to keep 
                          when saving to provided `outdir`
                          (1 -- filename only; 2 -- incl 1 directory)
+        cache_dir     -- (optional) load / store parsed ROIs in a cache directory
+                         keyed by the annotation content (see `slideslicer.cohort`)
+        lazy          -- do not read anything at construction;
+                         annotations (`annotations`), tissue chunks (`tissue_rois`),
+                         combined ROIs (`rois`), their data frame (`df`),
+                         and the bounding box index (`spatial_index`)
+                         are computed on first access and memoized;
+                         saving (`save=True`) is deferred until `rois` are loaded
         """
-	self.inputfile = inputfile
+        self.inputfile = inputfile
         self.filenamebase = re.sub('.(svs|tif)$','', re.sub(".xml$", "", inputfile))             ######### Place changed 
         self.verbose = verbose
-        ############################
-        # parsing annotations
-        ############################
         self.slide_format = slide_format
-        if annotation_format == 'leica':
-            if alt_annotation_file:
-                fnxml = alt_annotation_file
+        self.annotation_format = annotation_format
+        if alt_annotation_file:
+            self.fnxml = alt_annotation_file
+        else:
+            self.fnxml = self.filenamebase + '.xml'
+        self.threshold_tissue = threshold_tissue
+        self.remove_empty = remove_empty
+        self.threshold_color = threshold_color
+        self.minlen = minlen
+        self.cache_dir = cache_dir
+        self.lazy = lazy
+        self._save_on_load = save
+
+        if lazy:
+            # fail early on a missing slide
+            os.stat(inputfile)
+        else:
+            self.load_rois()
+
+    def load_rois(self):
+        """parse annotations, add tissue chunks, and save the result (if requested);
+        called at construction or, in the lazy mode, at first access to `rois`"""
+        if self.cache_dir is not None and os.path.exists(self.fnxml):
+            from .cohort import RoiCache
+            cache = RoiCache(self.cache_dir)
+            cache_key = cache.get_key(self.fnxml,
+                                      fnslide=self.inputfile if self.threshold_tissue else None,
+                                      annotation_format=self.annotation_format,
+                                      threshold_tissue=self.threshold_tissue,
+                                      remove_empty=self.remove_empty,
+                                      threshold_color=self.threshold_color,
+                                      minlen=self.minlen)
+            rois = cache.get(cache_key)
+        else:
+            cache = None
+            rois = None
+
+        if rois is not None:
+            self.rois = rois
+        else:
+            ############################
+            # parsing annotations
+            ############################
+            # for an ellipse, 
+            #    area = $\pi \times r \times R$
+            if self.threshold_tissue:
+                self.add_tissue(remove_empty=self.remove_empty,
+                                color=self.threshold_color, filtersize=7, minlen=self.minlen)
             else:
-                fnxml = self.filenamebase + '.xml'
+                self.rois = list(self.annotations)
+
+            if cache is not None:
+                from .cohort import validate_rois
+                self.rois = validate_rois(self.rois)
+                cache.put(cache_key, self.rois, inputfile=self.inputfile, fnxml=self.fnxml)
+
+        if self.threshold_tissue:
+            # the tissue chunks kept in `rois`, whether they come from the cache or not
+            self.tissue_rois = [roi for roi in self.rois if roi['name']=='tissue']
+
+        if self._save_on_load:
+            self.save()
+        return self._rois
+
+    def parse_annotations(self):
+        rois = []
+        if self.annotation_format == 'leica':
+            fnxml = self.fnxml
             try:
-                self.rois = parse_xml2annotations(fnxml)
-                for roi in self.rois:
+                rois = parse_xml2annotations(fnxml)
+                for roi in rois:
                     roi['name'] = roi['name']
             except:
                 warn('ROI file not found;\nexpected:\t{}'.format(fnxml))
         else:
-            NotImplementedError('format "%s" is not supported yet' % annotation_format)
-            
-        # for an ellipse, 
-        #    area = $\pi \times r \times R$
+            NotImplementedError('format "%s" is not supported yet' % self.annotation_format)
+        self._annotations = rois
+        return rois
 
-        if threshold_tissue:
-            self.add_tissue(remove_empty=remove_empty,
-                            color=threshold_color, filtersize=7, minlen=minlen)
+    @property
+    def annotations(self):
+        "annotation ROIs parsed from the annotation file"
+        if '_annotations' not in self.__dict__:
+            self.parse_annotations()
+        return self._annotations
 
-        if save:
-            self.save()
+    @property
+    def rois(self):
+        "annotation and tissue ROIs"
+        if '_rois' not in self.__dict__:
+            self.load_rois()
+        return self._rois
+
+    @rois.setter
+    def rois(self, rois):
+        self._rois = rois
+        # invalidate derived data
+        self.__dict__.pop('_df', None)
+        self.__dict__.pop('_spatial_index', None)
+
+    @property
+    def tissue_rois(self):
+        "tissue chunk ROIs extracted by thresholding the thumbnail"
+        if '_tissue_rois' not in self.__dict__:
+            self.extract_tissue(color=self.threshold_color, filtersize=7, minlen=self.minlen)
+        return self._tissue_rois
+
+    @tissue_rois.setter
+    def tissue_rois(self, rois):
+        self._tissue_rois = rois
 
     @property 
     def thumbnail(self):
@@ -187,8 +345,24 @@ class RoiReader():
 
     @property
     def slide(self):
-        slide_ = openslide.OpenSlide(self.inputfile)
-        return slide_
+        """the open slide; the handle (and the tile cache of OpenSlide) is kept
+        until `close`, and re-opened in a forked or unpickled copy of the reader"""
+        if self.__dict__.get('_slide') is None or self._slide_pid != os.getpid():
+            self._slide = openslide.OpenSlide(self.inputfile)
+            self._slide_pid = os.getpid()
+        return self._slide
+
+    def close(self):
+        "close the slide handle"
+        slide = self.__dict__.pop('_slide', None)
+        if slide is not None and self._slide_pid == os.getpid():
+            slide.close()
+
+    def __getstate__(self):
+        # slide handles are not shared with other processes
+        state = self.__dict__.copy()
+        state.pop('_slide', None)
+        return state
 
 
     def extract_tissue(self, color=False, filtersize=7, minlen=50):
@@ -226,13 +400,13 @@ class RoiReader():
         - minlen      -- minimal tissue contour length
         '''
                    
-        if not hasattr(self, 'tissue_rois'):
+        if '_tissue_rois' not in self.__dict__:
             self.extract_tissue(color=color, filtersize=filtersize, minlen=minlen) 
 
-        if hasattr(self,'rois'):
+        if '_rois' in self.__dict__:
             self.rois = self.rois + self.tissue_rois
         else:
-            self.rois = self.tissue_rois
+            self.rois = self.annotations + self.tissue_rois
 
         if self.verbose:
             print('-'*15)
@@ -257,6 +431,8 @@ class RoiReader():
             print('-'*45)
             roi_name_counts = pd.Series([rr["name"] for rr in self.rois]).value_counts()
             print(roi_name_counts)
+        # without the chunks removed as empty
+        self.tissue_rois = [roi for roi in self.rois if roi['name']=='tissue']
 
 
     @property
@@ -273,6 +449,23 @@ class RoiReader():
             self._df['polygon'] = self._df['polygon'].map(resolve_selfintersection)
         return self._df
 
+    @property
+    def spatial_index(self):
+        """bounding boxes `[xmin, ymin, xmax, ymax]` of the ROI polygons,
+        aligned with the rows of `df`"""
+        if '_spatial_index' not in self.__dict__:
+            bounds = [pg.bounds if not pg.is_empty else (np.inf, np.inf, -np.inf, -np.inf)
+                      for pg in self.df['polygon']]
+            self._spatial_index = np.asarray(bounds, dtype=float).reshape(-1, 4)
+        return self._spatial_index
+
+    def query_bbox(self, bounds):
+        "boolean mask of `df` rows whose bounding boxes intersect `bounds = (xmin, ymin, xmax, ymax)`"
+        xmin, ymin, xmax, ymax = bounds
+        index = self.spatial_index
+        return ((index[:,0] <= xmax) & (index[:,2] >= xmin) &
+                (index[:,1] <= ymax) & (index[:,3] >= ymin))
+
     @property
     def df_tissue(self):
         return self.df[self._df.name=='tissue']
@@ -357,7 +550,9 @@ class RoiReader():
             patch_size = [patch_size]*2
         patch_size = [x for x in patch_size]
         patch = CentredRectangle(xc, yc, *patch_size)
-        mask = self.df['polygon'].map(lambda x: patch.intersects(x))
+        mask = self.query_bbox(patch.bounds)
+        candidates = np.flatnonzero(mask)
+        mask[candidates] = [patch.intersects(x) for x in self.df['polygon'].values[candidates]]
         df = self.df[mask].copy()
         df.loc[:,'polygon'] = df['polygon'].map(lambda x: patch & x)
         df = df[df['polygon'].map(lambda x: isinstance(x, (Polygon, MultiPolygon)))]
@@ -451,11 +646,11 @@ class RoiReader():
             else:
                 return self.empty_mask(patch_size, scale)
 
-        return ROIFrame(df)
+        return _get_roiframe_()(df)
 
 
     def get_patch(self, xc, yc, patch_size, scale=1,
-                  magn_base = 4, use_cached=True, **kwargs):
+                  magn_base = 4, use_cached=True, resampler=None, **kwargs):
         if 'target_subsample' in kwargs:
             scale = kwargs.pop('target_subsample')
             warn('deprication warning', DeprecationWarning)
@@ -466,10 +661,22 @@ class RoiReader():
                             patch_size = patch_size,
                             magn_base = magn_base,
                             scale=scale,
-                            use_cached=use_cached)
+                            use_cached=use_cached,
+                            resampler=resampler)
         return patch    
 
 
+    def get_patch_pyramid(self, xc, yc, size, scales,
+                          use_cached=True, resampler='auto'):
+        """read patches of the same output `size` (int or `[w, h]`) at the same centre
+        at several `scales`, e.g. `[1, 4, 16]` for context-aware models;
+        each pyramid level is decoded once (see `_get_patch_pyramid_`).
+        Returns a `[len(scales) x h x w x 3]` uint8 array"""
+        if isinstance(size, int):
+            size = [size]*2
+        return _get_patch_pyramid_(self.slide, xc, yc, size, scales,
+                                   use_cached=use_cached, resampler=resampler)
+
     def plot_patch(self, xc, yc, patch_size, scale=1,
                    magn_base=4, translate=True,
                    cocorle=False,
@@ -477,6 +684,9 @@ class RoiReader():
                    colordict={}, figsize=None,
                    vis_scale=True, lw=2,
                    fig=None, ax=None, alpha=0.1, **kwargs):
+        import matplotlib.pyplot as plt
+        from matplotlib import colors
+        from descartes import PolygonPatch
 
         if 'target_subsample' in kwargs:
             scale = kwargs.pop('target_subsample')
@@ -560,6 +770,7 @@ class RoiReader():
              colors = {}, image=True, annotations=True,
              styles = {},
              **kwargs):
+        import matplotlib.pyplot as plt
         left = 0
         top = 0
         if not hasattr(self, 'width'):
@@ -692,13 +903,54 @@ class RoiReader():
 class PatchIterator():
     def __init__(self, roireader, vertices=None,  
                  points=None, side=128,
-                 subsample=8, batch_size=4, preprocess=lambda x:x,
+                 subsample=8, batch_size=4, preprocess=None,
                  color_last=True,
                  oversample=1, mode='grid',
                  roi = False,
                  get_mask_for_names = None,
                  use_cached=True,
+                 shuffle=False, seed=None,
+                 bucket_size=None, curve='hilbert',
+                 batch_preprocess=None, reuse_buffer=False,
+                 resampler='auto', scales=None, augment=None,
                  verbose=False):
+        """
+        Batch assembly:
+        preprocess       -- function applied to every `[H x W x 3]` patch;
+                            patches are then stacked into a new batch array
+        batch_preprocess -- function applied once to the uint8 batch,
+                            `[B x H x W x 3]` (or `[B x 3 x H x W]` if not `color_last`);
+                            it may modify the batch in place and return it
+        Without `preprocess`, the RGB channels of every region are copied
+        straight into its slot of a uint8 batch buffer.
+        reuse_buffer     -- keep one batch buffer and return views into it,
+                            so that no memory is allocated per batch;
+                            a batch is valid only until the next one is read
+        resampler        -- downsampling method for scales between pyramid levels
+                            (see `slideslicer.resample`)
+        scales           -- multi-scale mode: read `side x side` patches at each of these
+                            downsampling factors around every point (`get_patch_pyramid`);
+                            batches are `[B x S x H x W x 3]` (or `[B x S x 3 x H x W]`);
+                            `subsample` still sets point spacing and ROI masks
+        augment          -- an `slideslicer.augment.Augmentation`: for every point a region
+                            with a √2 margin is read once, and `augment.num_crops`
+                            rotated / flipped / shifted crops are cut from it;
+                            batches hold `batch_size * num_crops` patches and
+                            ROI masks or polygons are transformed alike (without COCO RLE);
+                            without batching, all crops of the point are returned
+
+        Shuffling:
+        shuffle     -- `False`: keep the order of `points`;
+                       `'full'`: random permutation of all points;
+                       `'local'` (or `True`): points are sorted along a space-filling
+                       `curve` (`hilbert` or `zorder`) and cut into buckets of
+                       `bucket_size` neighbouring points; the order of buckets and
+                       the order of points within each bucket are shuffled,
+                       so that consecutive reads stay close on the slide
+        seed        -- base random seed; epoch `n` is shuffled with `seed + n`
+        bucket_size -- points per bucket (default: 8 batches)
+        Call `set_epoch(n)` or `on_epoch_end()` to re-shuffle.
+        """
 
         self.verbose = verbose
         self.use_cached = use_cached
@@ -722,37 +974,138 @@ class PatchIterator():
         self.index = -1
         self.indices = np.arange(len(self.points))
         self.preprocess = preprocess
+        self.batch_preprocess = batch_preprocess
+        self.reuse_buffer = reuse_buffer
+        self._buffer = None
+        self.resampler = resampler
+        self.scales = scales
+        self.side = side
+        if augment is not None and scales is not None:
+            raise ValueError('augmentation of multi-scale patches is not supported')
+        self.augment = augment
+
+        if shuffle is True:
+            shuffle = 'local'
+        if shuffle not in (False, None, 'full', 'local'):
+            raise ValueError('unknown shuffle mode: %s' % shuffle)
+        self.shuffle = shuffle
+        self.seed = seed
+        self.bucket_size = bucket_size or 8*self._batch_size
+        self.curve = curve
+        self.epoch = 0
+        if self.shuffle == 'local':
+            self._curve_order = curve_order(self.points, curve=curve,
+                                            cell_size=self.side_magn)
+        if self.shuffle:
+            self.set_epoch(0)
+
+    @classmethod
+    def from_plan(cls, roireader, plan, slide_id=None, **kwargs):
+        """construct from rows of a sampling plan (see `slideslicer.sampling_plan`),
+        e.g. a memory-mapped shard; `slide_id` selects rows of one slide.
+        Patch side and subsampling are taken from the plan"""
+        from .sampling_plan import plan_points
+        if slide_id is not None:
+            plan = plan[plan['slide_id'] == slide_id]
+        if len(plan) == 0:
+            raise ValueError('no windows in the plan')
+        if len(np.unique(plan['size'])) > 1 or len(np.unique(plan['subsample'])) > 1:
+            raise ValueError('plan rows with different patch sizes')
+        subsample = plan['subsample'][0].item()
+        if float(subsample).is_integer():
+            subsample = int(subsample)
+        return cls(roireader, points=plan_points(plan),
+                   side=int(plan['size'][0]), subsample=subsample, **kwargs)
+
+    def set_epoch(self, epoch):
+        "re-shuffle the points for the given epoch and rewind"
+        self.epoch = epoch
+        self.index = -1
+        if not self.shuffle:
+            return
+        seed = None if self.seed is None else self.seed + epoch
+        rng = np.random.RandomState(seed)
+        if self.shuffle == 'full':
+            self.indices = rng.permutation(len(self.points))
+            return
+        buckets = [self._curve_order[ii:ii+self.bucket_size]
+                   for ii in range(0, len(self._curve_order), self.bucket_size)]
+        if len(buckets) == 0:
+            self.indices = np.arange(0)
+            return
+        self.indices = np.concatenate([rng.permutation(buckets[ii])
+                                       for ii in rng.permutation(len(buckets))])
+
+    def on_epoch_end(self):
+        self.set_epoch(self.epoch + 1)
 
     def __len__(self):
         return int(np.ceil(len(self.points)/self._batch_size))
         
+    def _get_buffer_(self, num, shape, out=None):
+        "uint8 batch buffer for `num` samples of `shape`"
+        if out is not None:
+            return out[:num]
+        shape = (self._batch_size,) + tuple(shape)
+        buffer = self._buffer
+        if buffer is None or buffer.shape != shape:
+            buffer = np.empty(shape, dtype=np.uint8)
+            if self.reuse_buffer:
+                self._buffer = buffer
+        return buffer[:num]
+
     def __getitem__(self, key):
+        return self.read_batch(key)
+
+    def read_batch(self, key, out=None):
+        """read batch number `key`; patches are written into `out`
+        (a uint8 array of the full batch shape, e.g. in shared memory) if given
+        and no per-patch `preprocess` is set"""
         start = key*self._batch_size
         end = min(len(self.indices), (1+key)*self._batch_size)
         assert end>start
-        batch_x = []
+        batch_x = None if self.preprocess is None else []
         coords = []
         if self.roi:
             batch_roi = []
 
         patch_size = [self.side_magn]*2
-        for ind in range(start, end):
+        if self.augment is not None:
+            rng = self.augment.get_rng(key, epoch=self.epoch)
+            big_side = self.augment.margin_side(self.side)
+            patch_size = [big_side*self.subsample]*2
+        for nn, ind in enumerate(range(start, end)):
             pp = self.points[self.indices[ind]]
             if self.verbose:
                 print('{}, {}, ({}, {}), target_subsample={}, use_cached={}'
                       .format(*pp,  *[self.side_magn]*2, self.subsample,
                               self.use_cached))
 
-            patch = self.roireader.get_patch(*pp, patch_size,
-                                             target_subsample=self.subsample,
-                                             use_cached=self.use_cached)
-            patch = np.asarray(patch)[...,:3]
+            if self.scales is not None:
+                patches = self.roireader.get_patch_pyramid(*pp, self.side, self.scales,
+                                                           use_cached=self.use_cached,
+                                                           resampler=self.resampler)
+                # the patch at `subsample` (if read) for tissue refinement of ROIs
+                patch = patches[list(self.scales).index(self.subsample)] \
+                        if self.subsample in self.scales else None
+            else:
+                patch = self.roireader.get_patch(*pp, patch_size,
+                                                 scale=self.subsample,
+                                                 use_cached=self.use_cached,
+                                                 resampler=self.resampler)
+                patch = np.asarray(patch)[...,:3]
+                patches = patch
+            if self.augment is not None:
+                matrices = self.augment.sample_matrices(self.side, big_side, rng)
             if self.roi:
                 try:
                     roi_ = self.roireader.get_patch_rois(*pp, patch_size,
                                scale=self.subsample,
-                               translate=True, cocorle=True,
-                               refine_tissue=True, patch_img=patch,
+                               translate=True,
+                               # masks are decoded from RLE; polygons of augmented crops carry none
+                               cocorle=(self.augment is None or
+                                        self.get_mask_for_names is not None),
+                               refine_tissue=patch is not None, patch_img=patch,
                                get_mask_for_names=self.get_mask_for_names,
                                )
                 except Exception as ee:
@@ -760,23 +1113,67 @@ class PatchIterator():
                          self.roireader.filenamebase, int(pp[0]), int(pp[1])))
                     raise ee
 
-                if not self.color_last and len(roi_.shape)>2:
-                    roi_ = roi_.transpose(2,0,1)
-                batch_roi.append(roi_)
+                if self.augment is None:
+                    rois_ = [roi_]
+                elif isinstance(roi_, np.ndarray):
+                    rois_ = list(self.augment.apply_mask(roi_, matrices, self.side))
+                else:
+                    rois_ = self.augment.apply_rois(roi_, matrices, self.side)
+                for roi_ in rois_:
+                    if not self.color_last and len(roi_.shape)>2:
+                        roi_ = roi_.transpose(2,0,1)
+                    batch_roi.append(roi_)
+
+            if self.preprocess is not None:
+                if self.augment is not None:
+                    patches = list(self.augment.apply_img(patches, matrices, self.side))
+                else:
+                    patches = [patches]
+                for patch in patches:
+                    patch = self.preprocess(patch)
+                    if not self.color_last:
+                        patch = np.moveaxis(patch, -1, -3)
+                    batch_x.append(patch)
+            elif self.augment is not None:
+                shape = (self.augment.num_crops, self.side, self.side, 3)
+                if not self.color_last:
+                    shape = (shape[0], 3) + shape[1:3]
+                if batch_x is None:
+                    if out is not None:
+                        # `out` holds the flat batch `[B*K x ...]`
+                        out = out.reshape((-1,) + shape)
+                    batch_x = self._get_buffer_(end - start, shape, out=out)
+                if self.color_last:
+                    # crops are warped straight into the batch slot
+                    self.augment.apply_img(patches, matrices, self.side, out=batch_x[nn])
+                else:
+                    crops = self.augment.apply_img(patches, matrices, self.side)
+                    np.copyto(batch_x[nn], np.moveaxis(crops, -1, -3))
+            else:
+                if not self.color_last:
+                    patches = np.moveaxis(patches, -1, -3)
+                if batch_x is None:
+                    batch_x = self._get_buffer_(end - start, patches.shape, out=out)
+                # a single copy of the RGB channels into the batch slot
+                np.copyto(batch_x[nn], patches)
+            if self.augment is not None:
+                coords.extend([pp]*self.augment.num_crops)
+            else:
+                coords.append(pp)
 
-            patch = self.preprocess(patch)
-            if not self.color_last:
-                patch = patch.transpose(2,0,1)
-            batch_x.append(patch)
-            coords.append(pp)
+        if self.preprocess is not None:
+            batch_x = np.stack(batch_x)
+        elif self.augment is not None:
+            batch_x = batch_x.reshape((-1,) + batch_x.shape[2:])
+        if self.batch_preprocess is not None:
+            batch_x = self.batch_preprocess(batch_x)
 
-        if self.batch_size is None or self.batch_size==0:
+        if (self.batch_size is None or self.batch_size==0) and self.augment is None:
             batch_x = batch_x[0]
             coords = coords[0]
             if self.roi:
                 batch_roi = batch_roi[0]
         else:
-            batch_x = np.stack(batch_x)
             coords = np.stack(coords)
             if self.roi:
                 if (self.get_mask_for_names is not None) and \
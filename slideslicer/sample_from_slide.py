@@ -1,9 +1,7 @@
 # coding: utf-8
 
-from PIL import Image
 import numpy as np
 from collections import Counter
-import pandas as pd
 import os
 import re
 import json
@@ -14,6 +12,8 @@ import cv2
 from pycocotools.mask import encode, decode
 
 from slideslicer.extract_rois_svs_xml import extract_rois_svs_xml
+from slideslicer.encoding import ImageEncoding
+from slideslicer.lazyimport import lazy_import
 from slideslicer.slideutils import (plot_contour, get_median_color, 
                         get_thumbnail_magnification,
                         get_img_bbox, get_rotated_highres_roi,
@@ -25,6 +25,8 @@ from slideslicer.slideutils import (plot_contour, get_median_color,
                         get_contour_centre, read_roi_patches_from_slide,
                         clip_roi_wi_bbox, sample_points)
 
+pd = lazy_import('pandas')
+
 
 def get_img_id(svsname):
     imgid = re.sub("\.svs$","", 
@@ -116,6 +118,7 @@ def get_tissue_rois(slide,
                     random=False,
                     normal_only=True,
                     shift_factor = 2, 
+                    order = None,
                    ):
 
     print("NORMAL_ONLY", normal_only)
@@ -130,7 +133,8 @@ def get_tissue_rois(slide,
         points = sample_points(cont,
                               spacing = step,
                               shift = -step//shift_factor,
-                              mode = 'random' if random else 'grid')
+                              mode = 'random' if random else 'grid',
+                              order = order)
 
         print("roi {} #{}:\t{:d} points sampled".format(roi["name"], roi["id"],len(points), ))
         pointroilist = [{"vertices":[pp], "area":0} for pp in points]
@@ -158,6 +162,70 @@ def get_tissue_rois(slide,
         yield imgroiiter
 
 
+def write_patch(prefix, reg, rois, sink=None, parentdir="data", encoding='png'):
+    """save a patch image and its rois
+    either as a `{prefix}.png` + `{prefix}.json` file pair, or,
+    if a `sink` is provided (see `slideslicer.shards.ShardWriter`),
+    as a sample keyed by the prefix relative to `parentdir`.
+    `encoding` is an `ImageEncoding` or its string form, e.g. `png:1`, `webp`, `jpeg:90`, `raw`
+    """
+    encoding = ImageEncoding.from_string(encoding)
+    if sink is None:
+        fn_json = prefix + ".json"
+        os.makedirs(os.path.dirname(fn_json), exist_ok=True)
+        print(encoding.save(reg, prefix))
+        with open(fn_json, 'w+') as fhj: json.dump(rois, fhj)
+    else:
+        key = os.path.relpath(prefix, parentdir)
+        sink.write(key, **{encoding.ext: encoding.encode(reg), 'json': rois})
+
+
+def export_patches(items, parentdir="data",
+                   lower = [0, 0, 180],
+                   upper = [179, 10, 255],
+                   close=50,
+                   open_=30,
+                   filtersize = 20,
+                   sink=None,
+                   num_workers=0,
+                   queue_size=8,
+                   encoding='png',
+                   ):
+    """annotate (`add_roi_bytes`) and save (`write_patch`) patches.
+
+    Inputs:
+    items        -- iterable of `(prefix, reg, rois)` tuples
+    sink         -- optional `slideslicer.shards.ShardWriter`
+    encoding     -- image encoding policy, see `slideslicer.encoding.ImageEncoding`
+    num_workers  -- if >0, run reading, annotation, and encoding/writing
+                    as separate stages with `num_workers` threads for each of the latter two
+                    (see `slideslicer.pipeline.run_pipeline`)
+    queue_size   -- number of patches buffered between the stages
+    """
+    def annotate_(item):
+        prefix, reg, rois = item
+        rois = add_roi_bytes(rois, np.asarray(reg),
+                lower=lower, upper=upper,
+                open=open_, close=close,
+                filtersize=filtersize)
+        return prefix, reg, rois
+
+    encoding = ImageEncoding.from_string(encoding)
+
+    def write_(item):
+        prefix, reg, rois = item
+        write_patch(prefix, reg, rois, sink=sink, parentdir=parentdir,
+                    encoding=encoding)
+
+    if num_workers > 0:
+        from .pipeline import run_pipeline
+        run_pipeline(items, [(annotate_, num_workers), (write_, num_workers)],
+                     queue_size=queue_size)
+    else:
+        for item in items:
+            write_(annotate_(item))
+
+
 def save_tissue_chunks(imgroiiter, imgid, parentdir="data",
                        lower = [0, 0, 180],
                        upper = [179, 10, 255],
@@ -165,29 +233,32 @@ def save_tissue_chunks(imgroiiter, imgid, parentdir="data",
                        open_=30,
                        filtersize = 20,
                        frac_thr=16,
+                       sink=None,
+                       num_workers=0,
+                       queue_size=8,
+                       encoding='png',
                        ):
-    for ii, (reg, rois, _, start_xy) in enumerate(imgroiiter):
-        sumdict = summarize_rois_wi_patch(rois, bg_names = [], frac_thr=frac_thr)
-        prefix = get_prefix(imgid, start_xy, sumdict["name"], sumdict["id"], ii,
-                            parentdir=parentdir,)
+    """save patches yielded by `read_roi_patches_from_slide`;
+    if `sink` (a `slideslicer.shards.ShardWriter`) is provided,
+    patches are appended to tar shards instead of individual files;
+    see `export_patches` for `num_workers`, `queue_size`, and `encoding`"""
+    def read_():
+        for ii, (reg, rois, _, start_xy) in enumerate(imgroiiter):
+            sumdict = summarize_rois_wi_patch(rois, bg_names = [], frac_thr=frac_thr)
+            prefix = get_prefix(imgid, start_xy, sumdict["name"], sumdict["id"], ii,
+                                parentdir=parentdir,)
+            #fn_summary_json = prefix + "-summary.json"
+            #with open(fn_summary_json, 'w+') as fhj: json.dump(sumdict, fhj)
+            yield prefix, reg, rois
 
-        #fn_summary_json = prefix + "-summary.json"
-        fn_json = prefix + ".json"
-        fnoutpng = prefix + '.png'
-        print(fnoutpng)
-
-        os.makedirs(os.path.dirname(fn_json), exist_ok=True)
-        #with open(fn_summary_json, 'w+') as fhj: json.dump(sumdict, fhj)
-        if isinstance(reg, Image.Image):
-            reg.save(fnoutpng)
-        else:
-            Image.fromarray(reg).save(fnoutpng)
-
-        rois = add_roi_bytes(rois, np.asarray(reg),
-                lower=lower, upper=upper,
-                open=open_, close=close,
-                filtersize=filtersize)
-        with open(fn_json, 'w+') as fhj: json.dump(rois, fhj)
+    export_patches(read_(), parentdir=parentdir,
+                   lower=lower, upper=upper,
+                   close=close, open_=open_,
+                   filtersize=filtersize,
+                   sink=sink,
+                   num_workers=num_workers,
+                   queue_size=queue_size,
+                   encoding=encoding)
 
 
 def add_roi_bytes(rois, reg,
@@ -331,6 +402,40 @@ if __name__ == '__main__':
       default=1,
       help='.')
 
+    parser.add_argument(
+      '--shard-size',
+      type=int,
+      default=0,
+      help='pack patches into tar shards of given number of patches each '
+           '(by default every patch is saved as a separate png + json pair)')
+
+    parser.add_argument(
+      '--num-workers',
+      type=int,
+      default=0,
+      help='number of threads for annotating and for encoding/writing patches '
+           '(by default everything runs inline in the reading loop)')
+
+    parser.add_argument(
+      '--encoding',
+      type=str,
+      default='png',
+      help='image encoding: png[:level], webp (lossless), jpeg[:quality], or raw (npy)')
+
+    parser.add_argument(
+      '--roi-cache',
+      type=str,
+      default=None,
+      help='ROI cache directory (see `slideslicer.cohort`); skips XML parsing for cached slides')
+
+    parser.add_argument(
+      '--order',
+      type=str,
+      default=None,
+      help='order of reading patches: hilbert, zorder, serpentine, or row; '
+           'space-filling curves keep consecutive reads within nearby slide tiles '
+           '(default: the order of sampling; patch numbers in file names follow the order)')
+
     prms = parser.parse_args()
     VISUALIZE = False
 
@@ -350,10 +455,18 @@ if __name__ == '__main__':
     target_size = [prms.target_side, prms.target_side,]
     #os.makedirs(outdir)
 
+    if prms.shard_size > 0:
+        from slideslicer.shards import ShardWriter
+        sink = ShardWriter(os.path.join(outdir, "shards"), prefix=imgid,
+                           maxcount=prms.shard_size)
+    else:
+        sink = None
+
     # ## Read XML ROI, convert, and save as JSON
     fnjson = extract_rois_svs_xml(prms.fnxml, outdir=prms.json_dir,
                                   remove_empty = ~prms.keep_empty,
-                                  keeplevels=prms.keep_levels)
+                                  keeplevels=prms.keep_levels,
+                                  cache_dir=prms.roi_cache)
 
     with open(fnjson,'r') as fh:
         roilist = json.load(fh)
@@ -408,32 +521,29 @@ if __name__ == '__main__':
                                 maxarea = prms.max_area,
                                 nchannels=3,
                                 allcomponents=True,
+                                order=prms.order,
                                )
 
         print("READING AND SAVING SMALLER ROIS (GLOMERULI, INFLAMMATION LOCI ETC.)",
               file=sys.stderr) 
 
-        for reg, rois,_, start_xy in imgroiiter:
-            sumdict = summarize_rois_wi_patch(rois, bg_names = ["tissue"], frac_thr=16)
-            prefix = get_prefix(imgid, start_xy, sumdict["name"], sumdict["tissue_id"],
-                                sumdict["id"], parentdir=outdir, suffix='-targeted')
-            #fn_summary_json = prefix + "-summary.json"
-            fn_json = prefix + ".json"
-            fnoutpng = prefix + '.png'
-            print(fnoutpng)
-            os.makedirs(os.path.dirname(fn_json), exist_ok=True)
-            
-            #with open(fn_summary_json, 'w+') as fhj: json.dump(sumdict, fhj)
-            if isinstance(reg, Image.Image):
-                reg.save(fnoutpng)
-            else:
-                Image.fromarray(reg).save(fnoutpng)
-            
-            rois = add_roi_bytes(rois, reg, lower=lower, upper=upper,
-                                 close=close,
-                                 open=open_,
-                                 filtersize = filtersize)
-            with open(fn_json, 'w+') as fhj: json.dump( rois, fhj)
+        def targeted_():
+            for reg, rois,_, start_xy in imgroiiter:
+                sumdict = summarize_rois_wi_patch(rois, bg_names = ["tissue"], frac_thr=16)
+                prefix = get_prefix(imgid, start_xy, sumdict["name"], sumdict["tissue_id"],
+                                    sumdict["id"], parentdir=outdir, suffix='-targeted')
+                #fn_summary_json = prefix + "-summary.json"
+                #with open(fn_summary_json, 'w+') as fhj: json.dump(sumdict, fhj)
+                yield prefix, reg, rois
+
+        export_patches(targeted_(), parentdir=outdir,
+                       lower=lower, upper=upper,
+                       close=close,
+                       open_=open_,
+                       filtersize = filtersize,
+                       sink=sink,
+                       num_workers=prms.num_workers,
+                       encoding=prms.encoding)
 
     print("READING AND SAVING _FEATURELESS_ / NORMAL TISSUE", file=sys.stderr)
 
@@ -448,6 +558,7 @@ if __name__ == '__main__':
                                             maxarea = 1e7,
                                             random=False,
                                             normal_only = not prms.all_grid,
+                                            order = prms.order,
                                            ):
             # save
             print('saving tissue chunk')
@@ -455,4 +566,9 @@ if __name__ == '__main__':
                                close=close,
                                open_=open_,
                                frac_thr=16,
-                               filtersize = filtersize)
+                               filtersize = filtersize,
+                               sink=sink,
+                               num_workers=prms.num_workers,
+                               encoding=prms.encoding)
+    if sink is not None:
+        sink.close()
@@ -8,12 +8,13 @@ import re
 import json
 import yaml
 import openslide
-import cv2
 from shapely.geometry import Polygon, MultiPolygon
 
 from pycocotools.mask import encode, decode
 from copy import deepcopy
 from slideslicer.extract_rois_svs_xml import extract_rois_svs_xml 
+from slideslicer.encoding import ImageEncoding
+from slideslicer.coco_dataset import CocoDatasetWriter
 from slideslicer.slideutils import (plot_contour, get_median_color, get_thumbnail_magnification,
                        CropRotateRoi, get_img_bbox, get_rotated_highres_roi, get_uniform_tiles,
                        get_contour_centre, read_roi_patches_from_slide,
@@ -207,6 +208,26 @@ if __name__ == '__main__':
       default=50,
       help='morphological close kernel size')
 
+    parser.add_argument(
+      '--shard-size',
+      type=int,
+      default=0,
+      help='pack patches into tar shards of given number of patches each '
+           '(by default every patch is saved as a separate png + json pair)')
+
+    parser.add_argument(
+      '--encoding',
+      type=str,
+      default='png',
+      help='image encoding: png[:level], webp (lossless), jpeg[:quality], or raw (npy)')
+
+    parser.add_argument(
+      '--coco-json',
+      type=str,
+      default=None,
+      help='write annotations of all patches into this single COCO `.json` / `.jsonl` dataset '
+           '(with stable image and annotation ids) instead of a JSON file per patch')
+
     prms = parser.parse_args()
     VISUALIZE = False
 
@@ -233,12 +254,26 @@ if __name__ == '__main__':
     #print(pd.Series([roi["name"] for roi in roilist]).value_counts())
     #cell#
 
+    encoding = ImageEncoding.from_string(prms.encoding)
+
     magnification = 4**prms.magnlevel
     target_side_magn = prms.target_side*magnification
     IMGDIR = prms.out_root 
     #"/repos/data/coco/gloms/img_level2/"
     ANNDIR = IMGDIR
 
+    if prms.shard_size > 0:
+        from slideslicer.shards import ShardWriter
+        sink = ShardWriter(IMGDIR, prefix=os.path.basename(fnsvs).replace('.svs', ''),
+                           maxcount=prms.shard_size)
+    else:
+        sink = None
+
+    if prms.coco_json is not None:
+        dataset = CocoDatasetWriter(prms.coco_json, categories=CATEGORY_LOOKUP)
+    else:
+        dataset = None
+
     print("magnification: %d" % magnification)
     print("SAVING CHUNKS")
     nrois = 0
@@ -262,9 +297,25 @@ if __name__ == '__main__':
             filename, json_ = process_patch(rois, start_xy,
                                             img_size=[prms.target_side]*2, image_id=-1,
                                             rle=prms.rle)
-            cv2.imwrite(os.path.join(IMGDIR, filename), reg)
-            fpath_json = os.path.join(ANNDIR, filename.replace('.png', '.json'))
+            key = filename.replace('.png', '')
+            json_['images']['file_name'] = '{}.{}'.format(key, encoding.ext)
+            if dataset is not None:
+                dataset.add(json_['images'], json_['annotations'])
+                if sink is not None:
+                    sink.write(key, **{encoding.ext: encoding.encode(reg)})
+                else:
+                    encoding.save(reg, os.path.join(IMGDIR, key))
+                continue
+            if sink is not None:
+                sink.write(key, **{encoding.ext: encoding.encode(reg), 'json': json_})
+                continue
+            encoding.save(reg, os.path.join(IMGDIR, key))
+            fpath_json = os.path.join(ANNDIR, key + '.json')
             with open(fpath_json, 'w') as fh:
                 json.dump(json_, fh,)
+    if sink is not None:
+        sink.close()
+    if dataset is not None:
+        dataset.close()
     if nrois == 0:
         raise ValueError("nothing has been saved")
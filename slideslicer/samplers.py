@@ -0,0 +1,177 @@
+# coding: utf-8
+"""class-balanced online sampling of patch windows
+
+Instead of exporting all patches and sub-selecting them by class,
+candidate windows (patch centres) of every slide are summarized by
+the fraction of their area covered by each ROI class (`get_window_stats`),
+labelled by their dominant class (`label_windows`), and drawn online
+with given class proportions by `ClassBalancedSampler`.
+Draws take O(1) per sample: a class is drawn from an alias table
+over classes, and a window is drawn from an alias table over
+the windows of that class.
+
+    stats = [get_window_stats(reader, pts, patch_size, class_names) for ...]
+    labels = [label_windows(ss, class_names) for ss in stats]
+    sampler = ClassBalancedSampler(labels, class_names)
+    dataset = MultiSlideDataset(slides, points, num_samples=100000, sampler=sampler, ...)
+"""
+import numpy as np
+from shapely.geometry import box
+
+
+class AliasTable():
+    """Walker's alias method (in Vose's formulation):
+    O(n) construction, O(1) per draw from a discrete distribution"""
+    def __init__(self, weights):
+        weights = np.asarray(weights, dtype=float)
+        n = len(weights)
+        if n == 0 or not (weights.sum() > 0):
+            raise ValueError('weights must contain a positive entry')
+        prob = weights * n / weights.sum()
+        alias = np.zeros(n, dtype=np.int64)
+        small = [ii for ii in range(n) if prob[ii] < 1.0]
+        large = [ii for ii in range(n) if prob[ii] >= 1.0]
+        while small and large:
+            ss, ll = small.pop(), large.pop()
+            alias[ss] = ll
+            prob[ll] -= 1.0 - prob[ss]
+            (small if prob[ll] < 1.0 else large).append(ll)
+        # remainders are 1 up to rounding
+        for ii in small + large:
+            prob[ii] = 1.0
+        self.prob = prob
+        self.alias = alias
+
+    def __len__(self):
+        return len(self.prob)
+
+    def draw(self, size=None, rng=np.random):
+        "draw indices distributed according to the weights"
+        column = rng.randint(len(self.prob), size=size)
+        accept = rng.rand(*np.shape(column)) < self.prob[column]
+        return np.where(accept, column, self.alias[column])
+
+
+def get_window_stats(reader, points, patch_size, class_names=None):
+    """fraction of the area of each window covered by each ROI class
+
+    Inputs:
+    reader      -- `RoiReader`
+    points      -- `[N x 2]` window centres
+    patch_size  -- window size in level-0 pixels (int or `[w, h]`)
+    class_names -- ROI names to summarize (default: all names of the reader)
+
+    Returns:
+    a `[N x C]` float32 array of area fractions (overlapping ROIs of a class are summed)
+    and the list of class names
+    """
+    if isinstance(patch_size, int):
+        patch_size = [patch_size]*2
+    df = reader.df
+    if class_names is None:
+        class_names = sorted(set(df['name']))
+    class_ind = {name: ii for ii, name in enumerate(class_names)}
+    polygons = df['polygon'].values
+    names = df['name'].values
+    halfw, halfh = patch_size[0]/2, patch_size[1]/2
+    stats = np.zeros((len(points), len(class_names)), dtype=np.float32)
+    for nn, (xc, yc) in enumerate(points):
+        bounds = (xc - halfw, yc - halfh, xc + halfw, yc + halfh)
+        window = box(*bounds)
+        for ii in np.flatnonzero(reader.query_bbox(bounds)):
+            if names[ii] in class_ind:
+                stats[nn, class_ind[names[ii]]] += window.intersection(polygons[ii]).area
+    stats /= patch_size[0]*patch_size[1]
+    return stats, list(class_names)
+
+
+def label_windows(stats, class_names, bg_names=('tissue',), min_fraction=0.0):
+    """label windows by the class with the largest area fraction;
+    background classes (`bg_names`) are used only if no other class
+    covers more than `min_fraction` of the window.
+    Returns integer labels (indices into `class_names`; -1 for blank windows)"""
+    stats = np.asarray(stats)
+    fg = np.asarray([name not in bg_names for name in class_names])
+    labels = np.full(len(stats), -1, dtype=np.int64)
+    if len(stats) == 0:
+        return labels
+    if fg.any():
+        fgstats = np.where(fg, stats, -1)
+        best = fgstats.argmax(1)
+        has_fg = fgstats[np.arange(len(stats)), best] > min_fraction
+        labels[has_fg] = best[has_fg]
+    else:
+        has_fg = np.zeros(len(stats), dtype=bool)
+    if (~fg).any():
+        bgstats = np.where(~fg, stats, -1)
+        best = bgstats.argmax(1)
+        has_bg = ~has_fg & (bgstats[np.arange(len(stats)), best] > 0)
+        labels[has_bg] = best[has_bg]
+    return labels
+
+
+class ClassBalancedSampler():
+    def __init__(self, labels, class_names=None, class_weights=None,
+                 window_weights=None):
+        """
+        Inputs:
+        labels         -- list of per-slide integer label arrays (see `label_windows`),
+                          in the order of the slides' points; negative labels are never drawn
+        class_names    -- names of the classes (for `class_weights` given as a dict)
+        class_weights  -- target proportions of classes in the draws: a sequence
+                          or a dict by class name; by default classes are balanced
+        window_weights -- optional list of per-slide arrays of window weights
+                          (e.g. tissue fractions) for drawing windows within a class
+        """
+        lengths = [len(ll) for ll in labels]
+        self.offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        labels = np.concatenate([np.asarray(ll, dtype=np.int64) for ll in labels])
+        if window_weights is not None:
+            window_weights = np.concatenate([np.asarray(ww, dtype=float) for ww in window_weights])
+
+        self.class_names = class_names
+        self.classes = np.unique(labels[labels >= 0])
+        if len(self.classes) == 0:
+            raise ValueError('no labelled windows to sample from')
+        self.members = []
+        self.member_tables = []
+        for cc in self.classes:
+            members = np.flatnonzero(labels == cc)
+            self.members.append(members)
+            if window_weights is None:
+                self.member_tables.append(None)
+            else:
+                self.member_tables.append(AliasTable(window_weights[members]))
+
+        if class_weights is None:
+            weights = np.ones(len(self.classes))
+        elif isinstance(class_weights, dict):
+            weights = np.asarray([class_weights.get(class_names[cc], 0.0)
+                                  for cc in self.classes], dtype=float)
+        else:
+            weights = np.asarray(class_weights, dtype=float)[self.classes]
+        self.class_table = AliasTable(weights)
+
+    @property
+    def class_counts(self):
+        "number of candidate windows per class"
+        return {int(cc): len(mm) for cc, mm in zip(self.classes, self.members)}
+
+    def sample(self, size, rng=np.random):
+        "draw global window indices (into concatenated per-slide points)"
+        class_draws = self.class_table.draw(size, rng=rng)
+        indices = np.empty(size, dtype=np.int64)
+        for kk in np.unique(class_draws):
+            where = np.flatnonzero(class_draws == kk)
+            members = self.members[kk]
+            if self.member_tables[kk] is None:
+                pick = rng.randint(len(members), size=len(where))
+            else:
+                pick = self.member_tables[kk].draw(len(where), rng=rng)
+            indices[where] = members[pick]
+        return indices
+
+    def locate(self, indices):
+        "global window indices to `(slide indices, window indices within slides)`"
+        slide_inds = np.searchsorted(self.offsets, indices, side='right') - 1
+        return slide_inds, indices - self.offsets[slide_inds]
@@ -0,0 +1,180 @@
+# coding: utf-8
+"""precomputed sampling plans
+
+A sampling plan lists every candidate patch window of a cohort
+in a single structured numpy array, one row per window:
+
+    slide_id   -- position of the slide in the plan's slide list
+    x, y       -- window centre (level-0 pixels)
+    subsample  -- downsampling factor of the patch (as `PatchIterator(subsample=...)`)
+    size       -- side of the patch in output pixels (as `PatchIterator(side=...)`)
+    tissue     -- fraction of the window covered by tissue chunks
+    {class}    -- fraction of the window covered by each annotation class
+
+The plan is saved as `{fn}` (`.npy`, appended if missing) with a `{fn}.meta.json` sidecar
+holding the slide list and the class names. Training jobs memory-map the plan
+instead of re-running point sampling, and can take disjoint shards of it:
+
+    python -m slideslicer.sampling_plan plan.npy slides/*.svs --side 256 --subsample 4
+
+    plan, meta = load_sampling_plan('plan.npy')
+    rows = shard_plan(plan, shard=rank, num_shards=world_size)
+    dataset = MultiSlideDataset.from_plan('plan.npy', shard=rank, num_shards=world_size)
+"""
+import sys
+import json
+import numpy as np
+from .slideutils import sample_points
+from .geom_tools import curve_order
+from .samplers import get_window_stats
+
+BASE_FIELDS = [('slide_id', '<i4'),
+               ('x', '<i8'),
+               ('y', '<i8'),
+               ('subsample', '<f4'),
+               ('size', '<i4'),
+               ('tissue', '<f4'),
+               ]
+
+
+def get_plan_filename(fn):
+    "the plan file name with the `.npy` extension that `np.save` appends"
+    return fn if fn.endswith('.npy') else fn + '.npy'
+
+
+def get_meta_filename(fn):
+    return get_plan_filename(fn) + '.meta.json'
+
+
+def plan_dtype(class_names):
+    return np.dtype(BASE_FIELDS + [(name, '<f4') for name in class_names])
+
+
+def plan_slide(reader, side=128, subsample=8, oversample=1, mode='grid', order='hilbert'):
+    """sample windows within the tissue chunks of a slide and summarize their content.
+    Returns window centres `[N x 2]` and a dict of area fractions by ROI name"""
+    side_magn = side*subsample
+    spacing = side_magn/oversample
+    points = [sample_points(roi['vertices'], spacing=spacing, mode=mode)
+              for roi in reader.tissue_rois]
+    points = [pp for pp in points if len(pp)]
+    if len(points) == 0:
+        return np.zeros((0, 2), dtype=np.int64), {}
+    points = np.concatenate(points)
+    if order is not None:
+        points = points[curve_order(points, curve=order, cell_size=spacing)]
+    stats, names = get_window_stats(reader, points, side_magn)
+    return points, dict(zip(names, stats.T))
+
+
+def _plan_slide_(args):
+    fnslide, kwargs, reader_kwargs = args
+    from .roi_reader import RoiReader
+    try:
+        reader = RoiReader(fnslide, save=False, verbose=False, **reader_kwargs)
+        points, stats = plan_slide(reader, **kwargs)
+        return fnslide, points, stats, None
+    except Exception as ee:
+        return fnslide, None, None, repr(ee)
+
+
+def make_sampling_plan(fn, slides, side=128, subsample=8, oversample=1, mode='grid',
+                       order='hilbert', class_names=None, processes=1, reader_kwargs=None,
+                       skip_errors=True):
+    """sample and summarize candidate windows of all `slides` (in parallel if `processes` > 1)
+    and save the plan into `fn`; slides that fail to load are skipped with a warning,
+    or, unless `skip_errors`, raise a `RuntimeError` before anything is saved.
+    Returns the plan array"""
+    fn = get_plan_filename(fn)
+    kwargs = dict(side=side, subsample=subsample, oversample=oversample, mode=mode, order=order)
+    tasks = [(fnslide, kwargs, reader_kwargs or {}) for fnslide in slides]
+    if processes == 1:
+        results = list(map(_plan_slide_, tasks))
+    else:
+        from multiprocessing import Pool
+        with Pool(processes) as pool:
+            results = pool.map(_plan_slide_, tasks)
+
+    errors = [(fnslide, error) for fnslide, _, _, error in results if error is not None]
+    if errors and not skip_errors:
+        raise RuntimeError('; '.join('{}: {}'.format(*ee) for ee in errors))
+    if class_names is None:
+        class_names = sorted(set(name for rr in results if rr[2] is not None
+                                 for name in rr[2]) - {'tissue'})
+    dtype = plan_dtype(class_names)
+    parts = []
+    slide_list = []
+    for fnslide, points, stats, error in results:
+        if error is not None:
+            print('skipping', fnslide, error, sep='\t', file=sys.stderr)
+            continue
+        rows = np.zeros(len(points), dtype=dtype)
+        rows['slide_id'] = len(slide_list)
+        rows['x'], rows['y'] = points[:, 0], points[:, 1]
+        rows['subsample'] = subsample
+        rows['size'] = side
+        rows['tissue'] = stats.get('tissue', 0)
+        for name in class_names:
+            rows[name] = stats.get(name, 0)
+        parts.append(rows)
+        slide_list.append(fnslide)
+    plan = np.concatenate(parts) if parts else np.zeros(0, dtype=dtype)
+
+    np.save(fn, plan)
+    with open(get_meta_filename(fn), 'w') as fh:
+        json.dump({'slides': slide_list,
+                   'class_names': class_names,
+                   'num_windows': len(plan),
+                   'params': kwargs,
+                   }, fh)
+    return plan
+
+
+def load_sampling_plan(fn, mmap=True):
+    "returns the plan array (memory-mapped by default) and its meta data"
+    fn = get_plan_filename(fn)
+    with open(get_meta_filename(fn)) as fh:
+        meta = json.load(fh)
+    plan = np.load(fn, mmap_mode='r' if mmap else None)
+    return plan, meta
+
+
+def shard_plan(plan, shard, num_shards):
+    """a deterministic contiguous part of the plan for `shard` out of `num_shards`;
+    shards are disjoint and cover the plan"""
+    if not 0 <= shard < num_shards:
+        raise ValueError('shard must be in [0, %d)' % num_shards)
+    bounds = np.linspace(0, len(plan), num_shards + 1).astype(int)
+    return plan[bounds[shard]:bounds[shard+1]]
+
+
+def plan_points(rows):
+    "window centres of plan rows as an `[N x 2]` array"
+    return np.stack([rows['x'], rows['y']], axis=1)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='write candidate patch windows of a cohort into a sampling plan')
+    parser.add_argument('output', type=str, help='output `.npy` plan file')
+    parser.add_argument('slides', nargs='+', type=str, help='slide files (annotations are expected next to them)')
+    parser.add_argument('--side', type=int, default=128, help='side of patches in output pixels')
+    parser.add_argument('--subsample', type=int, default=8, help='downsampling factor of patches')
+    parser.add_argument('--oversample', type=float, default=1, help='windows per patch side')
+    parser.add_argument('--mode', type=str, default='grid', help='point sampling mode (see `sample_points`)')
+    parser.add_argument('--order', type=str, default='hilbert',
+                        help='order of windows within a slide: hilbert, zorder, serpentine, or row')
+    parser.add_argument('--classes', nargs='+', default=None,
+                        help='annotation classes to summarize (default: all found)')
+    parser.add_argument('--processes', type=int, default=1, help='number of processes')
+    parser.add_argument('--roi-cache', type=str, default=None, help='ROI cache directory')
+    prms = parser.parse_args()
+
+    plan = make_sampling_plan(prms.output, prms.slides, side=prms.side, subsample=prms.subsample,
+                              oversample=prms.oversample, mode=prms.mode, order=prms.order,
+                              class_names=prms.classes, processes=prms.processes,
+                              reader_kwargs=dict(cache_dir=prms.roi_cache))
+    print('{} windows from {} slides'.format(len(plan), len(np.unique(plan['slide_id']))),
+          file=sys.stderr)
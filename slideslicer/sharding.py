@@ -0,0 +1,332 @@
+# coding: utf-8
+"""deterministic sharding of cohort work across nodes sharing a filesystem
+
+Work items (slides) are assigned to `num_shards` shards by estimated cost
+with a deterministic greedy (longest processing time first) balancing,
+so that every node computes the same assignment from the same inputs.
+Items are claimed through claim files created atomically with `O_CREAT | O_EXCL`
+in a shared work directory; a node that runs out of its own items
+steals unclaimed items of other shards. No locks or services are needed:
+
+    {work_dir}/claims/{key}.claim   -- claimed by a node (holds node name, pid, time)
+    {work_dir}/done/{key}.done      -- finished
+
+Failed items are released for a retry. Claims of nodes that die stay in place:
+with `stale_after` (`--stale-after`) seconds, longer than any item takes,
+unfinished items claimed earlier than that are taken over by other nodes;
+without it they are never reclaimed (see the `release` command).
+
+Per node, e.g. in place of hand-made slide lists and bash loops:
+
+    while XML=$(python -m slideslicer.sharding next --work-dir work --shard $I --num-shards $N slides/*.xml)
+    do
+        python sample_from_slide.py $XML && python -m slideslicer.sharding done --work-dir work $XML
+    done
+
+or, for sampling plans (see `slideslicer.sampling_plan`):
+
+    python -m slideslicer.sharding plan --work-dir work --shard $I --num-shards $N slides/*.svs
+    python -m slideslicer.sharding merge-plans plan.npy work/plans/*.npy
+"""
+import os
+import re
+import sys
+import json
+import time
+import socket
+import hashlib
+import numpy as np
+
+
+def file_costs(items):
+    "cost estimates from file sizes"
+    return [os.path.getsize(fn) if os.path.exists(fn) else 0 for fn in items]
+
+
+def plan_costs(plan, meta):
+    """cost estimates of the slides of a sampling plan:
+    number of windows times the mean tissue fraction of the windows"""
+    costs = []
+    for ii in range(len(meta['slides'])):
+        tissue = plan['tissue'][plan['slide_id'] == ii]
+        costs.append(len(tissue) * float(tissue.mean()) if len(tissue) else 0.0)
+    return costs
+
+
+def assign_shards(costs, num_shards):
+    """balance items across shards: items are taken by decreasing cost
+    (ties by position) and given to the least loaded shard (ties by shard number).
+    Returns an array of shard numbers, one per item"""
+    costs = np.asarray(costs, dtype=float)
+    order = sorted(range(len(costs)), key=lambda ii: (-costs[ii], ii))
+    loads = np.zeros(num_shards)
+    shards = np.zeros(len(costs), dtype=int)
+    for ii in order:
+        shard = int(np.argmin(loads))
+        shards[ii] = shard
+        loads[shard] += costs[ii]
+    return shards
+
+
+def get_item_key(item):
+    "file-system safe key of a work item, stable across nodes given the same item string"
+    base = re.sub(r'[^\w.-]', '_', os.path.splitext(os.path.basename(item))[0])
+    return '{}-{}'.format(base, hashlib.sha1(item.encode()).hexdigest()[:8])
+
+
+class WorkQueue():
+    def __init__(self, work_dir, items, num_shards=1, costs=None, node=None, stale_after=None):
+        """
+        Inputs:
+        work_dir    -- shared directory for claim and done files
+        items       -- work items (e.g. slide file names); the same list on every node
+        num_shards  -- number of shards
+        costs       -- cost estimates per item (default: file sizes)
+        node        -- node name written into claim files (default: host name)
+        stale_after -- seconds after which claims of unfinished items may be taken over
+                       (default: never)
+        """
+        self.work_dir = work_dir
+        self.items = list(items)
+        self.num_shards = num_shards
+        self.costs = file_costs(self.items) if costs is None else list(costs)
+        self.shards = assign_shards(self.costs, num_shards)
+        self.node = node or socket.gethostname()
+        self.stale_after = stale_after
+        for subdir in ('claims', 'done'):
+            os.makedirs(os.path.join(work_dir, subdir), exist_ok=True)
+
+    def _path_(self, item, kind):
+        subdir = 'claims' if kind == 'claim' else kind
+        return os.path.join(self.work_dir, subdir, get_item_key(item) + '.' + kind)
+
+    def shard_items(self, shard):
+        "items assigned to a shard, in the input order"
+        return [item for item, ss in zip(self.items, self.shards) if ss == shard]
+
+    def claim(self, item):
+        "atomically claim an item; returns `False` if it is already claimed"
+        try:
+            fd = os.open(self._path_(item, 'claim'), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as fh:
+            json.dump({'item': item, 'node': self.node, 'pid': os.getpid(),
+                       'time': time.time()}, fh)
+        return True
+
+    def release(self, item):
+        "give up a claim (e.g. after a failure) so that the item can be retried"
+        try:
+            os.remove(self._path_(item, 'claim'))
+        except FileNotFoundError:
+            pass
+
+    def mark_done(self, item, **info):
+        with open(self._path_(item, 'done'), 'w') as fh:
+            json.dump(dict(info, item=item, node=self.node, time=time.time()), fh)
+
+    def is_claimed(self, item):
+        return os.path.exists(self._path_(item, 'claim'))
+
+    def _claim_age_(self, path):
+        try:
+            return time.time() - os.path.getmtime(path)
+        except FileNotFoundError:
+            return None
+
+    def is_stale(self, item):
+        "whether an unfinished item was claimed more than `stale_after` seconds ago"
+        if self.stale_after is None or self.is_done(item):
+            return False
+        age = self._claim_age_(self._path_(item, 'claim'))
+        return age is not None and age > self.stale_after
+
+    def reclaim(self, item):
+        """take over a stale claim; the claim file is moved aside atomically first,
+        so that only one of the nodes racing for it succeeds"""
+        path = self._path_(item, 'claim')
+        aside = '{}.{}.{}'.format(path, self.node, os.getpid())
+        try:
+            os.rename(path, aside)
+        except FileNotFoundError:
+            return False
+        age = self._claim_age_(aside)
+        if age is not None and age <= self.stale_after:
+            # another node has reclaimed it in the meantime: put its claim back
+            try:
+                os.link(aside, path)
+            except FileExistsError:
+                pass
+            os.remove(aside)
+            return False
+        os.remove(aside)
+        return self.claim(item)
+
+    def is_done(self, item):
+        return os.path.exists(self._path_(item, 'done'))
+
+    def next_item(self, shard, steal=True, skip=()):
+        """claim the next item: own items first, in order;
+        then, if `steal`, unclaimed items of the other shards,
+        taken from the ends of their lists; stale claims count as unclaimed.
+        Returns `None` when nothing is left"""
+        candidates = self.shard_items(shard)
+        if steal:
+            for offset in range(1, self.num_shards):
+                candidates += self.shard_items((shard + offset) % self.num_shards)[::-1]
+        for item in candidates:
+            if item in skip:
+                continue
+            if self.is_stale(item):
+                if self.reclaim(item):
+                    return item
+            elif not self.is_claimed(item) and self.claim(item):
+                return item
+        return None
+
+    def iter_items(self, shard, steal=True, skip=()):
+        """claim and yield items until none are left;
+        `skip` may be a set that grows while iterating (e.g. with failed items)"""
+        while True:
+            item = self.next_item(shard, steal=steal, skip=skip)
+            if item is None:
+                return
+            yield item
+
+    def status(self):
+        "counts of done, claimed (in progress), and pending items per shard"
+        status = []
+        for shard in range(self.num_shards):
+            items = self.shard_items(shard)
+            done = sum(self.is_done(item) for item in items)
+            claimed = sum(self.is_claimed(item) for item in items) - done
+            status.append({'shard': shard, 'items': len(items),
+                           'cost': float(sum(cc for cc, ss in zip(self.costs, self.shards)
+                                             if ss == shard)),
+                           'done': done, 'claimed': claimed,
+                           'pending': len(items) - done - claimed})
+        return status
+
+
+def run_sharded(func, queue, shard, steal=True):
+    """apply `func` to every item claimed by this node;
+    failed items are released for a retry and reported.
+    Returns lists of finished and failed items"""
+    finished, failed = [], []
+    skip = set()
+    for item in queue.iter_items(shard, steal=steal, skip=skip):
+        try:
+            info = func(item)
+        except Exception as ee:
+            print(item, repr(ee), sep='\t', file=sys.stderr)
+            queue.release(item)
+            skip.add(item)
+            failed.append(item)
+            continue
+        queue.mark_done(item, **(info if isinstance(info, dict) else {}))
+        finished.append(item)
+    return finished, failed
+
+
+def merge_sampling_plans(inputs, fnout):
+    """concatenate sampling plans (e.g. one per slide or per shard) into one plan,
+    re-numbering slides in input order; class columns missing from an input are zero"""
+    from .sampling_plan import load_sampling_plan, plan_dtype, get_meta_filename, get_plan_filename
+    fnout = get_plan_filename(fnout)
+    plans = [load_sampling_plan(fn) for fn in inputs]
+    class_names = []
+    for _, meta in plans:
+        class_names += [name for name in meta['class_names'] if name not in class_names]
+    dtype = plan_dtype(class_names)
+    parts = []
+    slides = []
+    params = None
+    for plan, meta in plans:
+        rows = np.zeros(len(plan), dtype=dtype)
+        for name in plan.dtype.names:
+            rows[name] = plan[name]
+        rows['slide_id'] = plan['slide_id'] + len(slides)
+        slides += meta['slides']
+        params = params or meta.get('params')
+        parts.append(rows)
+    merged = np.concatenate(parts) if parts else np.zeros(0, dtype=dtype)
+    np.save(fnout, merged)
+    with open(get_meta_filename(fnout), 'w') as fh:
+        json.dump({'slides': slides,
+                   'class_names': class_names,
+                   'num_windows': len(merged),
+                   'params': params,
+                   }, fh)
+    return merged
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='deterministic sharding of slides across nodes with work-stealing claim files')
+    parser.add_argument('command', choices=['assign', 'next', 'done', 'release', 'status',
+                                            'plan', 'merge-plans'])
+    parser.add_argument('items', nargs='+', type=str,
+                        help='work items (slides); for `merge-plans`: output and input plans')
+    parser.add_argument('--work-dir', type=str, default='work', help='shared work directory')
+    parser.add_argument('--shard', type=int, default=0, help='shard of this node')
+    parser.add_argument('--num-shards', type=int, default=1, help='number of shards')
+    parser.add_argument('--no-steal', action='store_true', default=False,
+                        help='do not take over items of other shards')
+    parser.add_argument('--stale-after', type=float, default=None,
+                        help='seconds after which claims of unfinished items are taken over '
+                             '(default: never)')
+    parser.add_argument('--costs', type=str, default=None,
+                        help='a sampling plan to estimate costs from (default: file sizes)')
+    parser.add_argument('--side', type=int, default=128, help='`plan`: side of patches in output pixels')
+    parser.add_argument('--subsample', type=int, default=8, help='`plan`: downsampling factor of patches')
+    parser.add_argument('--classes', nargs='+', default=None, help='`plan`: annotation classes to summarize')
+    prms = parser.parse_args()
+
+    if prms.command == 'merge-plans':
+        merged = merge_sampling_plans(prms.items[1:], prms.items[0])
+        print('{} windows'.format(len(merged)), file=sys.stderr)
+        sys.exit(0)
+
+    costs = None
+    if prms.costs is not None:
+        from .sampling_plan import load_sampling_plan
+        plan, meta = load_sampling_plan(prms.costs)
+        bymeta = dict(zip(meta['slides'], plan_costs(plan, meta)))
+        costs = [bymeta.get(item, 0.0) for item in prms.items]
+    queue = WorkQueue(prms.work_dir, prms.items, num_shards=prms.num_shards, costs=costs,
+                      stale_after=prms.stale_after)
+
+    if prms.command == 'assign':
+        for item, shard in zip(queue.items, queue.shards):
+            print(shard, item, sep='\t')
+    elif prms.command == 'next':
+        item = queue.next_item(prms.shard, steal=not prms.no_steal)
+        if item is None:
+            sys.exit(1)
+        print(item)
+    elif prms.command == 'done':
+        for item in prms.items:
+            queue.mark_done(item)
+    elif prms.command == 'release':
+        for item in prms.items:
+            queue.release(item)
+    elif prms.command == 'status':
+        for ss in queue.status():
+            print('\t'.join('{}: {}'.format(kk, vv) for kk, vv in ss.items()))
+    elif prms.command == 'plan':
+        from .sampling_plan import make_sampling_plan
+        plandir = os.path.join(prms.work_dir, 'plans')
+        os.makedirs(plandir, exist_ok=True)
+
+        def plan_(item):
+            fnplan = os.path.join(plandir, get_item_key(item) + '.npy')
+            # a failed slide raises, so that its claim is released instead of marked done
+            plan = make_sampling_plan(fnplan, [item], side=prms.side, subsample=prms.subsample,
+                                      class_names=prms.classes, skip_errors=False)
+            return {'plan': fnplan, 'windows': len(plan)}
+
+        finished, failed = run_sharded(plan_, queue, prms.shard, steal=not prms.no_steal)
+        print('{} slides planned, {} failed'.format(len(finished), len(failed)), file=sys.stderr)
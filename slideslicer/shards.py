@@ -0,0 +1,249 @@
+# coding: utf-8
+"""packing of exported patches into rolling tar shards
+
+Instead of writing every patch as a separate `.png` + `.json` pair,
+the patches are appended to `tar` files (`{prefix}-000000.tar`, ...)
+that roll over after a given number of samples or bytes.
+Each sample is stored as a group of members sharing a key:
+
+    {key}.png
+    {key}.json
+
+Next to each shard a sidecar index `{prefix}-000000.idx` is written,
+one JSON line per member:
+
+    {"key": ..., "ext": "png", "offset": <data offset>, "size": <bytes>}
+
+so that samples can be either streamed sequentially (`ShardReader.__iter__`)
+or fetched randomly by key (`ShardReader[key]`).
+"""
+import os
+import io
+import re
+import json
+import time
+import tarfile
+import threading
+from glob import glob
+from collections import OrderedDict
+
+
+def _encode_member_(ext, value):
+    "convert a member value into bytes based on its extension"
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return bytes(value)
+    if ext == 'json':
+        return json.dumps(value).encode('utf-8')
+    if isinstance(value, str):
+        return value.encode('utf-8')
+    raise TypeError('cannot serialize member "{}" of type {}'.format(ext, type(value)))
+
+
+def _decode_member_(ext, data, decode=True):
+    if decode and ext == 'json':
+        return json.loads(data.decode('utf-8'))
+    return data
+
+
+def _split_member_name_(name):
+    "split `dir/key.ext` into (`dir/key`, `ext`)"
+    key, _, ext = name.rpartition('.')
+    return key, ext
+
+
+class ShardWriter():
+    """sequentially append samples to rolling tar shards with sidecar indices
+
+    Usage:
+
+        with ShardWriter(outdir, prefix=imgid, maxcount=10000) as sink:
+            sink.write(key, png=png_bytes, json=rois)
+    """
+    def __init__(self, outdir, prefix='shard',
+                 maxcount=10000, maxsize=1e9,
+                 verbose=False):
+        """
+        Inputs:
+        outdir    -- directory where the shards are written
+        prefix    -- shard file name prefix
+        maxcount  -- maximal number of samples per shard
+        maxsize   -- maximal number of bytes per shard
+        """
+        self.outdir = outdir
+        self.prefix = prefix
+        self.maxcount = maxcount
+        self.maxsize = maxsize
+        self.verbose = verbose
+        self.shard = -1
+        self.shards = []
+        self.total = 0
+        self._tar = None
+        self._idx = None
+        self._lock = threading.Lock()
+        os.makedirs(outdir, exist_ok=True)
+
+    @property
+    def fnshard(self):
+        return os.path.join(self.outdir, '{}-{:06d}.tar'.format(self.prefix, self.shard))
+
+    def _next_shard_(self):
+        self.close()
+        self.shard += 1
+        self.count = 0
+        self._tar = tarfile.open(self.fnshard, 'w')
+        self._idx = open(re.sub(r'\.tar$', '.idx', self.fnshard), 'w')
+        self.shards.append(self.fnshard)
+        if self.verbose:
+            print('writing shard', self.fnshard)
+
+    def _add_member_(self, name, data):
+        tarinfo = tarfile.TarInfo(name)
+        tarinfo.size = len(data)
+        tarinfo.mtime = time.time()
+        header = tarinfo.tobuf(self._tar.format, self._tar.encoding, self._tar.errors)
+        offset = self._tar.offset + len(header)
+        self._tar.addfile(tarinfo, io.BytesIO(data))
+        return offset
+
+    def write(self, key, **members):
+        """append a sample.
+        Inputs:
+        key       -- unique sample key, e.g. a `get_prefix` path relative to the output directory
+        members   -- extension to value mapping, e.g. `png=<bytes>, json=<list of rois>`;
+                     `bytes` are stored as is, other values of `json` are serialized
+
+        Safe to call from multiple threads; samples are appended one at a time.
+        """
+        members = [(ext, _encode_member_(ext, value)) for ext, value in members.items()]
+        with self._lock:
+            return self._write_(key, members)
+
+    def _write_(self, key, members):
+        if self._tar is None or self.count >= self.maxcount or \
+                (self.maxsize is not None and self._tar.offset >= self.maxsize):
+            self._next_shard_()
+        for ext, data in members:
+            offset = self._add_member_('{}.{}'.format(key, ext), data)
+            self._idx.write(json.dumps({'key': key, 'ext': ext,
+                                        'offset': offset, 'size': len(data)}) + '\n')
+        self.count += 1
+        self.total += 1
+        return self.fnshard
+
+    def close(self):
+        if self._tar is not None:
+            self._tar.close()
+            self._idx.close()
+            self._tar = None
+            self._idx = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_shard_index(fnidx):
+    """read a sidecar index into an ordered dictionary:
+        {key: {ext: (offset, size), ...}, ...}
+    """
+    index = OrderedDict()
+    with open(fnidx) as fh:
+        for line in fh:
+            entry = json.loads(line)
+            index.setdefault(entry['key'], {})[entry['ext']] = (entry['offset'], entry['size'])
+    return index
+
+
+class ShardReader():
+    """read samples written by `ShardWriter`
+
+    Iteration streams the shards sequentially (no index required)
+    and yields `(key, {ext: value})` tuples;
+    indexing by key uses the sidecar indices for random access.
+    """
+    def __init__(self, shards, decode=True):
+        """
+        Inputs:
+        shards    -- a directory, a glob pattern, or a list of `.tar` shard paths
+        decode    -- parse `.json` members (otherwise return raw bytes)
+        """
+        if isinstance(shards, str):
+            if os.path.isdir(shards):
+                shards = os.path.join(shards, '*.tar')
+            shards = sorted(glob(shards))
+        self.shards = list(shards)
+        self.decode = decode
+
+    @property
+    def index(self):
+        "mapping from keys to (shard, {ext: (offset, size)})"
+        if not hasattr(self, '_index'):
+            self._index = OrderedDict()
+            for fnshard in self.shards:
+                fnidx = re.sub(r'\.tar$', '.idx', fnshard)
+                for key, members in read_shard_index(fnidx).items():
+                    self._index[key] = (fnshard, members)
+        return self._index
+
+    def keys(self):
+        return self.index.keys()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, key):
+        fnshard, members = self.index[key]
+        sample = {}
+        with open(fnshard, 'rb') as fh:
+            for ext, (offset, size) in members.items():
+                fh.seek(offset)
+                sample[ext] = _decode_member_(ext, fh.read(size), self.decode)
+        return sample
+
+    def __iter__(self):
+        for fnshard in self.shards:
+            key = None
+            sample = {}
+            with tarfile.open(fnshard, 'r|') as tar:
+                for tarinfo in tar:
+                    if not tarinfo.isfile():
+                        continue
+                    key_, ext = _split_member_name_(tarinfo.name)
+                    if key_ != key and key is not None:
+                        yield key, sample
+                        sample = {}
+                    key = key_
+                    data = tar.extractfile(tarinfo).read()
+                    sample[ext] = _decode_member_(ext, data, self.decode)
+            if key is not None:
+                yield key, sample
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='list the content of patch shards or unpack them into individual files')
+    parser.add_argument(
+      'shards',
+      type=str,
+      help='a directory or a glob pattern of `.tar` shards')
+    parser.add_argument(
+      '--extract-to',
+      type=str,
+      default=None,
+      help='unpack samples into individual files within this directory')
+
+    prms = parser.parse_args()
+    reader = ShardReader(prms.shards, decode=False)
+    for key, sample in reader:
+        if prms.extract_to is None:
+            print(key, *sorted(sample.keys()), sep='\t')
+            continue
+        for ext, data in sample.items():
+            fnout = os.path.join(prms.extract_to, '{}.{}'.format(key, ext))
+            os.makedirs(os.path.dirname(fnout), exist_ok=True)
+            with open(fnout, 'wb') as fh:
+                fh.write(data)
@@ -0,0 +1,206 @@
+# coding: utf-8
+"""shared-memory batch transport from loader processes
+
+Batches of a `PatchIterator` (or any dataset with `__len__` and `__getitem__`
+returning a tuple of arrays) are read by worker processes into fixed-size
+slots of ring buffers in `multiprocessing.shared_memory`. Only slot numbers
+pass through queues, so the cost of handing a batch over does not depend
+on its size. The consumer receives numpy views into a slot, valid until the
+slot is released:
+
+    loader = SharedMemoryLoader(PatchIterator(...), num_workers=4, slots_per_worker=2)
+    for batch_x, coords in loader:
+        ...   # views are released when the next batch is requested
+    loader.close()
+
+    for (batch_x, coords), token in loader.iter_with_tokens():
+        ...
+        loader.release(token)
+
+Every worker owns its slots and reads batches `k` with `k % num_workers == worker`,
+so batches are delivered in order. Items of a batch that are not arrays of fixed
+shape (e.g. lists of ROI data frames) are pickled instead.
+If the dataset has `read_batch(key, out=...)`, the patches are written
+straight into the slot.
+"""
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import numpy as np
+
+_DONE = None
+
+
+class BatchRing():
+    """fixed-size slots for batch arrays in shared memory
+
+    Inputs:
+    specs     -- list of `(shape, dtype)` of the arrays of a full batch
+    num_slots -- number of slots
+    """
+    def __init__(self, specs, num_slots):
+        self.specs = [(tuple(shape), np.dtype(dtype)) for shape, dtype in specs]
+        self.num_slots = num_slots
+        self._shms = [shared_memory.SharedMemory(create=True,
+                          size=max(1, num_slots * int(np.prod(shape)) * dtype.itemsize))
+                      for shape, dtype in self.specs]
+        self._owner = True
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_shms'] = [shm.name for shm in self._shms]
+        state['_owner'] = False
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # worker processes share the resource tracker of the parent,
+        # which unlinks the blocks if the parent dies without `close`
+        self._shms = [shared_memory.SharedMemory(name=name) for name in self._shms]
+
+    def views(self, slot):
+        "numpy arrays backed by the slot"
+        return [np.ndarray((self.num_slots,) + shape, dtype=dtype, buffer=shm.buf)[slot]
+                for (shape, dtype), shm in zip(self.specs, self._shms)]
+
+    def close(self):
+        for shm in self._shms:
+            shm.close()
+        if self._owner:
+            for shm in self._shms:
+                shm.unlink()
+        self._shms = []
+
+
+def _worker_(dataset, ring, slots, keys, free, ready, array_items):
+    try:
+        for key in keys:
+            slot = free.get()
+            views = ring.views(slot)
+            if hasattr(dataset, 'read_batch') and array_items[0] is not None:
+                batch = list(dataset.read_batch(key, out=views[array_items[0]]))
+            else:
+                batch = list(dataset[key])
+            lengths = {}
+            for item, pos in enumerate(array_items):
+                if pos is None:
+                    continue
+                value = np.asarray(batch[item])
+                view = views[pos]
+                if not np.shares_memory(value, view):
+                    view[:len(value)] = value
+                lengths[item] = len(value)
+                batch[item] = None
+            ready.put((key, slot, lengths, batch))
+    except Exception as ee:
+        ready.put((None, None, None, repr(ee)))
+    ready.put(_DONE)
+
+
+class SharedMemoryLoader():
+    def __init__(self, dataset, num_workers=2, slots_per_worker=2,
+                 start_method=None):
+        """
+        Inputs:
+        dataset          -- `PatchIterator` or a sequence of batches (tuples of arrays)
+        num_workers      -- number of loader processes
+        slots_per_worker -- number of batches a worker may read ahead
+        start_method     -- multiprocessing start method (default: platform default)
+
+        The layout of the slots is inferred from the first batch:
+        items of the batch that are numpy arrays get a slot array of their shape;
+        all batches must fit in it (the last batch may be shorter).
+        """
+        self.dataset = dataset
+        self.num_workers = num_workers
+        self.slots_per_worker = slots_per_worker
+        self._ctx = mp.get_context(start_method)
+
+        sample = dataset[0]
+        specs = []
+        self.array_items = []
+        for value in sample:
+            if isinstance(value, np.ndarray) and value.ndim > 0:
+                self.array_items.append(len(specs))
+                specs.append((value.shape, value.dtype))
+            else:
+                self.array_items.append(None)
+        self.ring = BatchRing(specs, num_workers * slots_per_worker)
+        self._workers = []
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def _start_(self):
+        self._join_()
+        # fresh queues, so that no slots are left from an interrupted epoch
+        self._free = [self._ctx.Queue() for _ in range(self.num_workers)]
+        self._ready = [self._ctx.Queue() for _ in range(self.num_workers)]
+        for ww in range(self.num_workers):
+            slots = list(range(ww * self.slots_per_worker, (ww + 1) * self.slots_per_worker))
+            for slot in slots:
+                self._free[ww].put(slot)
+            keys = list(range(ww, len(self.dataset), self.num_workers))
+            proc = self._ctx.Process(target=_worker_, daemon=True,
+                                     args=(self.dataset, self.ring, slots, keys,
+                                           self._free[ww], self._ready[ww], self.array_items))
+            proc.start()
+            self._workers.append(proc)
+
+    def _join_(self):
+        for proc in self._workers:
+            if proc.is_alive():
+                proc.terminate()
+            proc.join()
+        self._workers = []
+
+    def release(self, token):
+        "return a slot to its worker"
+        worker, slot = token
+        self._free[worker].put(slot)
+
+    def iter_with_tokens(self):
+        """yield `(batch, token)`; arrays of the batch are views into shared memory
+        valid until `release(token)`"""
+        self._start_()
+        for key in range(len(self.dataset)):
+            worker = key % self.num_workers
+            message = self._ready[worker].get()
+            if message is _DONE or message[0] is None:
+                error = None if message is _DONE else message[3]
+                self.close()
+                raise RuntimeError('loader worker {} failed: {}'.format(worker, error))
+            key_, slot, lengths, batch = message
+            assert key_ == key
+            views = self.ring.views(slot)
+            for item, pos in enumerate(self.array_items):
+                if pos is not None:
+                    batch[item] = views[pos][:lengths[item]]
+            yield tuple(batch), (worker, slot)
+        for worker in range(self.num_workers):
+            self._ready[worker].get()
+        self._join_()
+
+    def __iter__(self):
+        token = None
+        for batch, token_ in self.iter_with_tokens():
+            if token is not None:
+                self.release(token)
+            token = token_
+            yield batch
+        if token is not None:
+            self.release(token)
+
+    def close(self):
+        for proc in self._workers:
+            proc.terminate()
+            proc.join()
+        self._workers = []
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
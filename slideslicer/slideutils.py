@@ -6,7 +6,6 @@ from collections import Counter
 from itertools import product
 from copy import deepcopy
 
-import pandas as pd
 import re
 import json
 import openslide
@@ -21,6 +20,7 @@ from shapely.geometry import Point, MultiPoint, asMultiPoint, box
 from shapely.affinity import rotate
 from .geom_tools import get_contour_centre
 from .geom_tools import resolve_selfintersection
+from .geom_tools import curve_order
 
 # move to parse_leica_xml.py 
 def get_ellipse_points(verticeslist, num=200):
@@ -236,7 +236,6 @@ class CropRotateRoi():
         if use_offset:
             self.offset = co.min(0)
             co -= self.offset
-            print("offset", self.offset)
         # calculate the affine transformation
         self.enlarge = enlarge
         #if isinstance(img, np.ndarray):
@@ -365,26 +364,134 @@ def transform_roi_to_rotated_chunk(transform_mag, rr, roi_start, roi_size,
             return roi
 
 
+def _open_output_(out, shape, dtype='uint8'):
+    """an output array: `out` itself, a new `.npy` memory map if `out` is a file name,
+    or a memory map on an anonymous temporary file if `out` is `None`"""
+    shape = tuple(int(x) for x in shape)
+    if isinstance(out, np.ndarray):
+        if out.shape != shape:
+            raise ValueError('output of shape {} expected, got {}'.format(shape, out.shape))
+        return out
+    if out is None:
+        import tempfile
+        return np.memmap(tempfile.TemporaryFile(), dtype=dtype, mode='w+', shape=shape)
+    return np.lib.format.open_memmap(out, mode='w+', dtype=dtype, shape=shape)
+
+
+def rotate_region_tiled(slide, transform, read_start, read_size,
+                        out=None, tile_size=2048, border_value=None,
+                        interpolation=cv2.INTER_CUBIC):
+    """apply the affine transform of a `CropRotateRoi` to a level-0 region of a slide
+    tile by tile: every output tile is mapped back onto the slide, only the source window
+    it needs is read and warped, and the result is written into `out`.
+    Peak memory is bounded by the tile size rather than by the chunk size.
+
+    Inputs:
+    slide        -- `openslide.OpenSlide`
+    transform    -- `CropRotateRoi` built on level-0 coordinates of the chunk (with `use_offset=True`)
+    read_start   -- level-0 origin `(x, y)` of the region the transform applies to
+    read_size    -- level-0 size `(w, h)` of the region; pixels outside it are filled with `border_value`
+    out          -- output RGBA array `[H x W x 4]` of size `transform.img_size`,
+                    a `.npy` file name to memory-map, or `None` for a memory map on a temporary file
+    tile_size    -- side of output tiles
+    border_value -- RGB(A) fill colour (default: `transform.borderValue`)
+    """
+    width, height = transform.img_size
+    out = _open_output_(out, (height, width, 4))
+    if border_value is None:
+        border_value = transform.borderValue
+    fill = np.zeros(4, dtype=np.uint8)
+    if border_value is not None:
+        border_value = np.asarray(border_value).ravel()
+        fill[:len(border_value)] = border_value[:4]
+        if len(border_value) < 4:
+            fill[3] = 255
+
+    read_start = np.asarray(read_start, dtype=int)
+    read_end = read_start + np.asarray(read_size, dtype=int)
+    offset = getattr(transform, 'offset', np.zeros(2, dtype=int))
+    full_matrix = transform.full_affine_matrix
+    inverse = np.linalg.inv(full_matrix)
+    # source pixels needed by the interpolation kernel beyond the mapped corners
+    margin = 3
+    for y0 in range(0, height, tile_size):
+        for x0 in range(0, width, tile_size):
+            tw, th = min(tile_size, width - x0), min(tile_size, height - y0)
+            tile = out[y0:y0+th, x0:x0+tw]
+            corners = np.array([[x0-1, y0-1], [x0+tw, y0-1],
+                                [x0+tw, y0+th], [x0-1, y0+th]], dtype=float)
+            src = CropRotateRoi._pad_vectors_(corners).dot(inverse[:2].T) + offset
+            src_start = np.maximum(np.floor(src.min(0)).astype(int) - margin, read_start)
+            src_end = np.minimum(np.ceil(src.max(0)).astype(int) + margin + 1, read_end)
+            if (src_end <= src_start).any():
+                tile[:] = fill
+                continue
+            region = np.asarray(slide.read_region(tuple(int(x) for x in src_start), 0,
+                                                  tuple(int(x) for x in src_end - src_start)))
+            # map window pixels to tile pixels
+            shift = np.eye(3)
+            shift[:2, 2] = src_start - offset
+            local = full_matrix.dot(shift)
+            local[:2, 2] -= (x0, y0)
+            warped = np.zeros((th, tw, 4), dtype=np.uint8)
+            cv2.warpAffine(region, local[:2], (tw, th), dst=warped,
+                           flags=interpolation, borderMode=cv2.BORDER_TRANSPARENT)
+            warped[warped[:, :, 3] == 0] = fill
+            tile[:] = warped
+    if isinstance(out, np.memmap):
+        out.flush()
+    return out
+
+
+def get_tissue_mask_tiled(img, color=True, filtersize=35, tile_size=2048, out=None, **kwargs):
+    """`get_threshold_tissue_mask` of a large (memory-mapped) image computed tile by tile
+    with overlapping margins, so that blur and morphology match the whole-image result.
+    Grayscale (Otsu) thresholds are global and are computed on the whole image."""
+    if not color:
+        return get_threshold_tissue_mask(img[..., :3], color=color, filtersize=filtersize, **kwargs)
+    height, width = img.shape[:2]
+    mask = _open_output_(out, (height, width))
+    # the Gaussian kernel and the closing and opening each reach up to `filtersize` pixels
+    halo = 3*filtersize + 1
+    for y0 in range(0, height, tile_size):
+        for x0 in range(0, width, tile_size):
+            ys, xs = max(0, y0 - halo), max(0, x0 - halo)
+            ye, xe = min(height, y0 + tile_size + halo), min(width, x0 + tile_size + halo)
+            mask_ = get_threshold_tissue_mask(np.ascontiguousarray(img[ys:ye, xs:xe, :3]),
+                                              color=color, filtersize=filtersize, **kwargs)
+            mask[y0:y0+tile_size, x0:x0+tile_size] = mask_[y0-ys:y0-ys+tile_size,
+                                                           x0-xs:x0-xs+tile_size]
+    return mask
+
+
 def get_rotated_highres_roi(slide, chunkroi_small, 
                     feature_rois = [],
                     color=True, filtersize=35, minlen=500,
-                    median_color=None, angle=None
+                    median_color=None, angle=None,
+                    tile_size=2048, out=None,
                     ):
+    """straighten a tissue chunk at full resolution.
+    The chunk is rotated tile by tile into a memory-mapped RGBA array
+    (see `rotate_region_tiled`; `out` may be a `.npy` file name), so that
+    memory use does not grow with the chunk size.
+
+    Returns the transform (`CropRotateRoi`), the rotated region,
+    the refined contour of the chunk in the rotated region, and the feature ROIs
+    within the chunk in rotated coordinates."""
     if median_color is None:
         median_color = get_median_color(slide)
     ratio = get_thumbnail_magnification(slide)
     
     roi_start, roi_size = roi_loc(chunkroi_small)
-    region = slide.read_region((roi_start*ratio).astype(int), 0, 
-                               (roi_size*ratio).astype(int))
+    read_start = (roi_start*ratio).astype(int)
+    read_size = (roi_size*ratio).astype(int)
 
-    transform_mag = CropRotateRoi(region, chunkroi_small*ratio,
+    transform_mag = CropRotateRoi(chunkroi_small*ratio,
                           angle=angle,
                           use_offset=True,
                           borderValue=median_color)
-    region_ = transform_mag(region,
-#                             crop=True
-                           )
+    region_ = rotate_region_tiled(slide, transform_mag, read_start, read_size,
+                                  out=out, tile_size=tile_size)
     # transform feature rois:
     rois_within_chunk = []
     for rr in feature_rois:
@@ -395,13 +502,13 @@ def get_rotated_highres_roi(slide, chunkroi_small,
             print(rr["name"])
             rois_within_chunk.append(rr)
     # re-estimate the contour
-    mask_ = get_threshold_tissue_mask(region_, color=color, filtersize=filtersize)
+    mask_ = get_tissue_mask_tiled(region_, color=color, filtersize=filtersize, tile_size=tile_size)
     chunkroi_large_refined = convert_mask2contour(mask_, minlen = minlen)
     assert len(chunkroi_large_refined)>0
     # take the longest contour
     maxidx = np.argmax([len(x) for x in chunkroi_large_refined])
     chunkroi_large_refined = chunkroi_large_refined[maxidx]
-    return transform_roi_to_rotated_chunk, region_, chunkroi_large_refined, rois_within_chunk
+    return transform_mag, region_, chunkroi_large_refined, rois_within_chunk
 
 def get_img_bbox(img):
     h = img.shape[0]
@@ -458,6 +565,7 @@ def read_roi_patches_from_slide(slide, roilist,
                         nomask=False,
                         verbose=False,
                         check_point_num = False,
+                        order = None,
                        ):
     """
     Input:
@@ -469,6 +577,8 @@ def read_roi_patches_from_slide(slide, roilist,
     + maxarea      -- maximal area to remove too big rois
     + color        -- (int, tuple(int)) color to fill in the mask
     + nchannels    -- max number of channels (set to 3 to remove 4' transparancy channel)
+    + order        -- order of visiting rois: `None` (as given), `row`, `serpentine`, `hilbert`, or `zorder`;
+                      the latter keep consecutive reads within nearby slide tiles
     
     Yields (iterator):
     
@@ -494,6 +604,10 @@ def read_roi_patches_from_slide(slide, roilist,
     size_xy = (target_size[1],target_size[0])
     size_xy_magn = (int(target_size[1] * magnification), int(target_size[0]*magnification))
     slide_w, slide_h = slide.dimensions
+    if order is not None and len(roilist) > 1:
+        centres = [get_contour_centre(roi["vertices"]) for roi in roilist]
+        roilist = [roilist[ii] for ii in curve_order(centres, curve=order,
+                                                     cell_size=max(target_size))]
     for roi in roilist:
         if maxarea is not None and (roi['area'] > maxarea):
             warn('too large ROI\t{}'.format(str(roi['area'])))
@@ -739,7 +853,7 @@ def intersect_contour_points(contour, points):
     contour = np.asarray(contour, dtype=int)
     # binary mask for clipping
     mask = np.asarray(
-            [cv2.pointPolygonTest(contour, tuple(pp), False) for pp in points])>0
+            [cv2.pointPolygonTest(contour, (float(pp[0]), float(pp[1])), False) for pp in points])>0
     # clip
     points = points[mask]
     return points
@@ -794,7 +908,8 @@ def sample_points(contour,
                   spacing=200,
                   shift=0,
                   mode='grid',
-                  random_seed=None):
+                  random_seed=None,
+                  order=None):
     """
     sample points within a roi
 
@@ -804,6 +919,7 @@ def sample_points(contour,
     spacing
     shift
     random: generates random uniform sample; otherwise grid
+    order: `None` (row-major for grids), `row`, `serpentine`, `hilbert`, or `zorder`
     """
     if (n_points is None) and (spacing is None):
         raise ValueError('either `spacing` or `n_points` must be specified')
@@ -872,7 +988,9 @@ def sample_points(contour,
 
     # binary mask for clipping
     mask = np.asarray(
-            [cv2.pointPolygonTest(contour, tuple(pp), False) for pp in points])>0
+            [cv2.pointPolygonTest(contour, (float(pp[0]), float(pp[1])), False) for pp in points])>0
     # clip
     points = points[mask]
+    if order is not None and len(points) > 1:
+        points = points[curve_order(points, curve=order, cell_size=spacing)]
     return points
@@ -0,0 +1,175 @@
+# coding: utf-8
+"""stitching of patch predictions into a slide-level map
+
+`Stitcher` takes batches of `(coords, predictions)` as they come out of a model
+fed by `PatchIterator` (patch centres in level-0 pixels) and accumulates
+window-weighted predictions into a memory-mapped float16 canvas at a chosen
+pyramid level, together with a canvas of summed weights.
+Overlapping patches are blended with a window that decays towards patch edges,
+which hides seams of tiled inference. Only the canvas region of one patch
+is held in memory at a time:
+
+    stitcher = Stitcher.from_slide(slide, patch_size=256*4, level=2,
+                                   num_channels=3, blending='hann', out='pred.npy')
+    for batch_x, coords in PatchIterator(reader, points=points, side=256, subsample=4):
+        stitcher.add(coords, model(batch_x))
+    probmap = stitcher.finalize()     # [H x W x C] float16, normalized
+
+Predictions may be segmentation outputs `[B x h x w (x C)]` of any resolution
+(they are resized to the patch footprint on the canvas)
+or per-patch scores `[B x C]`.
+"""
+import numpy as np
+import cv2
+
+BLENDINGS = ('uniform', 'triangle', 'hann', 'gaussian')
+
+
+def get_blending_window(shape, blending='hann', sigma=0.25, floor=1e-3):
+    """a 2D weight window of `shape` `(h, w)`;
+    `sigma` of the `gaussian` window is a fraction of the side;
+    weights are kept above `floor` so that the edges of the slide stay covered"""
+    if blending not in BLENDINGS:
+        raise ValueError('unknown blending window: %s' % blending)
+    profiles = []
+    for nn in shape:
+        # pixel centres in (0, 1)
+        tt = (np.arange(nn) + 0.5) / nn
+        if blending == 'uniform':
+            profile = np.ones(nn)
+        elif blending == 'triangle':
+            profile = 1 - np.abs(2*tt - 1)
+        elif blending == 'hann':
+            profile = np.sin(np.pi*tt)**2
+        else:
+            profile = np.exp(-0.5*((tt - 0.5)/sigma)**2)
+        profiles.append(profile)
+    window = np.outer(*profiles)
+    return np.maximum(window, floor).astype(np.float32)
+
+
+def get_weights_filename(fn):
+    if fn is None:
+        return None
+    if fn.endswith('.npy'):
+        fn = fn[:-len('.npy')]
+    return fn + '.weights.npy'
+
+
+def _open_canvas_(out, shape, dtype):
+    if out is None:
+        import tempfile
+        return np.memmap(tempfile.TemporaryFile(), dtype=dtype, mode='w+', shape=shape)
+    return np.lib.format.open_memmap(out, mode='w+', dtype=dtype, shape=shape)
+
+
+class Stitcher():
+    def __init__(self, dimensions, patch_size, downsample=1.0, num_channels=1,
+                 blending='hann', sigma=0.25, color_last=True, out=None):
+        """
+        Inputs:
+        dimensions   -- level-0 size of the slide `(width, height)`
+        patch_size   -- level-0 side of the patch footprint (`side * subsample` of `PatchIterator`),
+                        or `(width, height)`
+        downsample   -- level-0 pixels per canvas pixel (e.g. `slide.level_downsamples[level]`)
+        num_channels -- number of prediction channels
+        blending     -- weight window of overlapping patches: `uniform`, `triangle`, `hann`, or `gaussian`
+        sigma        -- width of the `gaussian` window as a fraction of the patch side
+        color_last   -- predictions with spatial dimensions are `[B x h x w x C]`
+                        (otherwise `[B x C x h x w]`)
+        out          -- `.npy` file name of the canvas (default: an anonymous temporary file);
+                        summed weights go to `get_weights_filename(out)`
+        """
+        self.dimensions = tuple(int(x) for x in dimensions)
+        if np.isscalar(patch_size):
+            patch_size = (patch_size, patch_size)
+        self.patch_size = tuple(patch_size)
+        self.downsample = float(downsample)
+        self.num_channels = num_channels
+        self.color_last = color_last
+        self.out = out
+
+        width, height = [int(np.ceil(dd / self.downsample)) for dd in self.dimensions]
+        self.shape = (height, width, num_channels)
+        # footprint of a patch on the canvas
+        self.footprint = tuple(max(1, int(round(ps / self.downsample))) for ps in self.patch_size)
+        self.window = get_blending_window(self.footprint[::-1], blending=blending, sigma=sigma)
+        self.canvas = _open_canvas_(out, self.shape, np.float16)
+        self.weights = _open_canvas_(get_weights_filename(out), self.shape[:2], np.float16)
+        self.num_patches = 0
+
+    @classmethod
+    def from_slide(cls, slide, patch_size, level=0, **kwargs):
+        "a stitcher with the canvas at a pyramid `level` of an `openslide.OpenSlide`"
+        return cls(slide.dimensions, patch_size,
+                   downsample=slide.level_downsamples[level], **kwargs)
+
+    def _as_maps_(self, predictions):
+        "predictions as `[B x h x w x C]` float32 arrays"
+        predictions = np.asarray(predictions, dtype=np.float32)
+        if predictions.ndim == 1:
+            predictions = predictions[:, None]
+        if predictions.ndim == 2:
+            # per-patch scores
+            return predictions[:, None, None, :]
+        if predictions.ndim == 3:
+            return predictions[..., None]
+        if not self.color_last:
+            predictions = np.moveaxis(predictions, 1, -1)
+        return predictions
+
+    def add(self, coords, predictions):
+        """accumulate a batch of predictions;
+        `coords` are patch centres `[B x 2]` `(x, y)` in level-0 pixels"""
+        coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+        maps = self._as_maps_(predictions)
+        if len(maps) != len(coords):
+            raise ValueError('{} coordinates for {} predictions'.format(len(coords), len(maps)))
+        if maps.shape[-1] != self.num_channels:
+            raise ValueError('{} channels expected, got {}'.format(self.num_channels, maps.shape[-1]))
+        fw, fh = self.footprint
+        height, width = self.shape[:2]
+        for (xc, yc), pred in zip(coords, maps):
+            if pred.shape[:2] != (fh, fw):
+                pred = cv2.resize(pred, (fw, fh), interpolation=cv2.INTER_LINEAR)
+                pred = pred.reshape(fh, fw, -1)
+            x0 = int(round(xc / self.downsample - fw / 2))
+            y0 = int(round(yc / self.downsample - fh / 2))
+            # clip the footprint to the canvas
+            xs, ys = max(0, x0), max(0, y0)
+            xe, ye = min(width, x0 + fw), min(height, y0 + fh)
+            if xe <= xs or ye <= ys:
+                continue
+            window = self.window[ys-y0:ye-y0, xs-x0:xe-x0]
+            pred = pred[ys-y0:ye-y0, xs-x0:xe-x0]
+            # sums are formed in float32 and stored in float16
+            self.canvas[ys:ye, xs:xe] = (self.canvas[ys:ye, xs:xe].astype(np.float32) +
+                                         pred * window[..., None])
+            self.weights[ys:ye, xs:xe] = self.weights[ys:ye, xs:xe].astype(np.float32) + window
+            self.num_patches += 1
+
+    def finalize(self, fill_value=np.nan, tile_size=4096):
+        """divide the weighted sums by the summed weights in place, tile by tile;
+        pixels not covered by any patch get `fill_value`.
+        Returns the normalized `[H x W x C]` float16 map (the canvas)"""
+        height = self.shape[0]
+        for y0 in range(0, height, tile_size):
+            weights = self.weights[y0:y0+tile_size].astype(np.float32)[..., None]
+            tile = self.canvas[y0:y0+tile_size].astype(np.float32)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                tile = np.where(weights > 0, tile / weights, fill_value)
+            self.canvas[y0:y0+tile_size] = tile
+        for arr in (self.canvas, self.weights):
+            if isinstance(arr, np.memmap):
+                arr.flush()
+        return self.canvas
+
+    def write_pyramid(self, fn, **kwargs):
+        """write the (finalized) canvas as a tiled pyramid
+        (see `slideslicer.pyramid.write_pyramid`)"""
+        from .pyramid import write_pyramid
+        return write_pyramid(self.canvas, fn, **kwargs)
+
+    def canvas_to_level0(self, xy):
+        "canvas pixel coordinates `(x, y)` to level-0 pixels"
+        return (np.asarray(xy, dtype=float) + 0.5) * self.downsample
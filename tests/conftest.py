@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+
+from slideslicer.pyramid import write_pyramid
+
+XML = '''<Annotations>
+<Annotation Name="glom" Text="glom" Type="Freehand" Area="100" AreaMicrons="25"><Coordinates>
+<Coordinate X="1400" Y="900"/><Coordinate X="1600" Y="900"/><Coordinate X="1600" Y="1100"/><Coordinate X="1400" Y="1100"/></Coordinates></Annotation>
+</Annotations>
+'''
+
+
+@pytest.fixture(scope='session')
+def slide_file(tmp_path_factory):
+    """a tiled TIFF slide (readable by OpenSlide) with two textured tissue chunks
+    on white glass and a `glom` annotation within the larger one"""
+    height, width = 2048, 3072
+    yy, xx = np.mgrid[:height, :width]
+    img = np.full((height, width, 3), 245, dtype=np.uint8)
+    tissue = ((xx - 1500) / 1000.)**2 + ((yy - 1000) / 700.)**2 < 1
+    # a chunk without annotations
+    tissue |= ((xx - 300)**2 + (yy - 1750)**2) < 200**2
+    texture = np.stack([200 - (xx // 7) % 40, 120 + (yy // 5) % 50,
+                        180 - (xx + yy) // 9 % 30], axis=-1).astype(np.uint8)
+    img[tissue] = texture[tissue]
+    dirname = tmp_path_factory.mktemp('slide')
+    write_pyramid(img, str(dirname / 'slide.tif'), tile_size=256)
+    (dirname / 'slide.xml').write_text(XML)
+    return str(dirname / 'slide.tif')
@@ -0,0 +1,18 @@
+import numpy as np
+import pandas as pd
+from shapely.geometry import Polygon
+
+from slideslicer.augment import Augmentation
+
+
+def test_apply_rois_split_by_crop():
+    # a U shape whose bottom bar lies outside of the crop: clipping leaves two legs
+    shape = Polygon([(10, 20), (30, 20), (30, 150), (60, 150), (60, 20), (90, 20),
+                     (90, 200), (10, 200)])
+    df = pd.DataFrame({'name': ['glom'], 'polygon': [shape]})
+    identity = np.array([[[1.0, 0.0, 0.0], [0.0, 1.0, 0.0]]])
+    out, = Augmentation().apply_rois(df, identity, side=100)
+    assert out['polygon'].iloc[0].geom_type == 'MultiPolygon'
+    # vertices are those of the larger leg
+    verts = np.asarray(out['vertices'].iloc[0])
+    assert verts[:, 0].min() == 60 and verts[:, 0].max() == 90
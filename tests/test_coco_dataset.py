@@ -0,0 +1,33 @@
+import pytest
+
+from slideslicer.coco_dataset import (CocoDatasetWriter, read_coco_meta, iter_coco_records,
+                                      merge_coco_datasets)
+
+IMAGE = {'file_name': 'patch.png', 'width': 64, 'height': 64}
+
+
+@pytest.mark.parametrize('ext', ['.json', '.jsonl'])
+def test_merge_colliding_category_ids(tmp_path, ext):
+    inputs = []
+    for nn, name in enumerate(['glom', 'infl']):
+        fn = str(tmp_path / ('slide%d%s' % (nn, ext)))
+        # both inputs use id 1 for different names
+        with CocoDatasetWriter(fn, categories={name: 1}) as dataset:
+            dataset.add(IMAGE, [{'category_id': 1, 'bbox': [0, 0, 8, 8]}])
+        inputs.append(fn)
+    fnout = merge_coco_datasets(inputs, str(tmp_path / ('merged' + ext)))
+
+    categories = {cat['name']: cat['id'] for cat in read_coco_meta(fnout)['categories']}
+    assert categories == {'glom': 1, 'infl': 2}
+    anns = [ann for _, anns in iter_coco_records(fnout) for ann in anns]
+    assert [ann['category_id'] for ann in anns] == [1, 2]
+    assert all('category_name' not in ann for ann in anns)
+
+
+def test_writer_new_name_with_taken_id(tmp_path):
+    with CocoDatasetWriter(str(tmp_path / 'out.jsonl'), categories={'glom': 1}) as dataset:
+        dataset.add(IMAGE, [{'category_id': 1, 'category_name': 'infl'},
+                            {'category_id': 1, 'category_name': 'glom'}])
+        assert dataset.categories == {'glom': 1, 'infl': 2}
+    anns = [ann for _, anns in iter_coco_records(str(tmp_path / 'out.jsonl')) for ann in anns]
+    assert [ann['category_id'] for ann in anns] == [2, 1]
@@ -0,0 +1,64 @@
+import numpy as np
+import cv2
+import pytest
+
+from slideslicer.pyramid import write_pyramid, PyramidReader
+from slideslicer.compact import compact_slide, CompactSlide
+
+WIDTH, HEIGHT = 2048, 1024
+CHUNKS = [[(100, 100), (600, 100), (600, 400), (100, 400)],
+          [(1400, 600), (1900, 650), (1880, 900), (1380, 850)]]
+
+
+class _Reader_():
+    "the parts of `RoiReader` used by `compact_slide`"
+    def __init__(self, slide):
+        self.slide = slide
+        self.inputfile = slide.filename
+        self.tissue_rois = [{'id': nn, 'name': 'tissue', 'vertices': vv}
+                            for nn, vv in enumerate(CHUNKS)]
+        self.annotations = []
+
+
+@pytest.fixture(scope='module')
+def original(tmp_path_factory):
+    yy, xx = np.mgrid[:HEIGHT, :WIDTH]
+    img = np.stack([xx // 8, yy // 4, np.full_like(xx, 128)], axis=-1).astype(np.uint8)
+    fn = str(tmp_path_factory.mktemp('slide') / 'slide.tif')
+    write_pyramid(img, fn, tile_size=256)
+    return img, fn
+
+
+@pytest.mark.parametrize('straighten', [False, True])
+@pytest.mark.parametrize('location', [(100, 450), (650, 100), (300, 300), (1300, 500)])
+def test_read_next_to_chunks(tmp_path, original, straighten, location):
+    img, fnslide = original
+    fn = str(tmp_path / 'compact.tif')
+    with PyramidReader(fnslide) as slide:
+        compact_slide(_Reader_(slide), fn, straighten=straighten, margin=16)
+    with CompactSlide(fn) as compact:
+        region = np.asarray(compact.read_region(location, 0, (500, 300)))
+    x0, y0 = location
+    expected = img[y0:y0+300, x0:x0+500].astype(int)
+    filled = region[..., 3] > 0
+    # pixels of the compact image are those of the slide at the same place
+    # (up to the interpolation of straightened chunks, which blends their edges)
+    diff = np.abs(region[..., :3].astype(int) - expected).max(-1)
+    interior = cv2.erode(filled.astype(np.uint8), np.ones((3, 3), np.uint8)) > 0
+    assert (diff[interior] > (8 if straighten else 0)).sum() == 0
+    if location in [(100, 450), (650, 100)]:
+        # glass next to a chunk stays empty
+        assert filled.sum() == 0
+    else:
+        assert filled.sum() > 0
+
+
+def test_to_compact_outside(tmp_path, original):
+    _, fnslide = original
+    fn = str(tmp_path / 'compact.tif')
+    with PyramidReader(fnslide) as slide:
+        compact_slide(_Reader_(slide), fn, straighten=True, margin=16)
+    with CompactSlide(fn) as compact:
+        xy = compact.to_compact([(300, 250), (1000, 500), (1650, 750)])
+        assert np.isnan(xy[1]).all() and np.isfinite(xy[[0, 2]]).all()
+        assert np.allclose(compact.to_original(xy[[0, 2]]), [(300, 250), (1650, 750)])
@@ -0,0 +1,5 @@
+def test_star_import():
+    namespace = {}
+    exec('from slideslicer import *', namespace)
+    for name in ('RoiReader', 'PatchIterator', 'sample_points', 'curve_order', 'leica', 'coco'):
+        assert name in namespace
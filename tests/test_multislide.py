@@ -0,0 +1,25 @@
+import numpy as np
+import pytest
+
+from slideslicer.roi_reader import RoiReader
+from slideslicer.multislide import SlideCache, MultiSlideDataset
+
+
+def test_eviction_drops_memoized_data(slide_file):
+    readers = [RoiReader(slide_file, save=False, verbose=False, lazy=True) for _ in range(3)]
+    cache = SlideCache(readers, max_open=1)
+    reader, _ = cache[0]
+    reader.df, reader.spatial_index
+    assert '_df' in reader.__dict__ and '_rois' in reader.__dict__
+    cache[1]
+    assert cache.resident == [1]
+    for attr in ('_df', '_spatial_index', '_rois', '_tissue_rois', '_slide'):
+        assert reader.__dict__.get(attr) is None
+    # rebuilt on demand
+    assert len(reader.df) == len(readers[1].rois)
+    cache.close()
+
+
+def test_no_points(slide_file):
+    with pytest.raises(ValueError):
+        MultiSlideDataset([slide_file]*2, [np.zeros((0, 2))]*2, num_samples=10)
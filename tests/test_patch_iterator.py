@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+from slideslicer.roi_reader import RoiReader, PatchIterator
+from slideslicer.augment import Augmentation
+from slideslicer.shm_transport import SharedMemoryLoader
+
+POINTS = np.array([[1000 + 150*ii, 800 + 100*(ii % 3)] for ii in range(10)])
+
+
+@pytest.fixture
+def reader(slide_file):
+    reader = RoiReader(slide_file, save=False, verbose=False)
+    yield reader
+    reader.close()
+
+
+def _iterator_(reader, **kwargs):
+    return PatchIterator(reader, points=POINTS, side=64, subsample=2, batch_size=4,
+                         augment=Augmentation(num_crops=3, seed=0), **kwargs)
+
+
+@pytest.mark.parametrize('color_last', [True, False])
+def test_augment_shared_memory(reader, color_last):
+    it = _iterator_(reader, color_last=color_last)
+    loader = SharedMemoryLoader(it, num_workers=2, start_method='fork')
+    try:
+        batches = [(np.array(batch_x), np.array(coords)) for batch_x, coords in loader]
+    finally:
+        loader.close()
+    assert len(batches) == len(it)
+    for key, (batch_x, coords) in enumerate(batches):
+        expected_x, expected_coords = it[key]
+        assert batch_x.shape == expected_x.shape
+        assert np.array_equal(batch_x, expected_x)
+        assert np.array_equal(coords, expected_coords)
+
+
+def test_augment_changes_with_epoch(reader):
+    it = _iterator_(reader)
+    first = it[0][0].copy()
+    assert np.array_equal(it[0][0], first)
+    it.on_epoch_end()
+    assert not np.array_equal(it[0][0], first)
+    it.set_epoch(0)
+    assert np.array_equal(it[0][0], first)
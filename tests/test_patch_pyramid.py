@@ -0,0 +1,23 @@
+import numpy as np
+from PIL import Image
+
+from slideslicer.roi_reader import _get_patch_pyramid_
+
+
+class _MockSlide_():
+    "an SVS-like slide with inexact level downsamples that records its reads"
+    level_downsamples = (1.0, 4.000121, 16.0069)
+
+    def __init__(self):
+        self.reads = []
+
+    def read_region(self, location, level, size):
+        self.reads.append((level, tuple(size)))
+        return Image.new('RGBA', tuple(size), (200, 100, 50, 255))
+
+
+def test_levels_of_inexact_downsamples():
+    slide = _MockSlide_()
+    out = _get_patch_pyramid_(slide, 4096, 4096, (256, 256), [1, 4, 16])
+    assert out.shape == (3, 256, 256, 3)
+    assert sorted(slide.reads) == [(0, (256, 256)), (1, (256, 256)), (2, (256, 256))]
@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+from slideslicer.pyramid import write_pyramid, get_level_dimensions, PyramidReader
+from slideslicer.roi_reader import _get_patch_
+
+SIDE = 2048
+
+
+def _box_(arr, factor):
+    h, w = arr.shape[0] // factor, arr.shape[1] // factor
+    return arr.reshape((h, factor, w, factor) + arr.shape[2:]).astype(np.float64).mean(axis=(1, 3))
+
+
+@pytest.fixture(scope='module')
+def source():
+    yy, xx = np.mgrid[:SIDE, :SIDE]
+    rgb = np.stack([xx * 255 // SIDE, yy * 255 // SIDE, (xx + yy) * 255 // (2*SIDE)], axis=-1)
+    heatmap = np.stack([np.sin(xx / 97.0), np.cos(yy / 53.0)], axis=-1) * 0.5 + 0.5
+    return rgb.astype(np.uint8), heatmap.astype(np.float16)
+
+
+def test_level_dimensions():
+    assert get_level_dimensions((2049, 1000), tile_size=256) == [(2049, 1000), (513, 250), (129, 63)]
+    assert get_level_dimensions((1000, 1000), tile_size=256, level_factor=2) == \
+        [(1000, 1000), (500, 500), (250, 250)]
+    with pytest.raises(ValueError):
+        get_level_dimensions((1000, 1000), level_factor=3)
+
+
+@pytest.mark.parametrize('ext', ['.tif', '_tiles'])
+@pytest.mark.parametrize('scale', [4, 8, 16])
+def test_get_patch_rgb(tmp_path, source, ext, scale):
+    rgb, _ = source
+    fn = str(tmp_path / ('rgb' + ext))
+    write_pyramid(rgb, fn, tile_size=256)
+    with PyramidReader(fn) as pyramid:
+        assert pyramid.level_downsamples == pytest.approx((1, 4, 16))
+        patch = _get_patch_(pyramid, 1024, 1024, patch_size=[512, 512], scale=scale,
+                            resampler='auto')
+        assert patch.shape == (512 // scale, 512 // scale, 3) and patch.dtype == np.uint8
+        expected = _box_(rgb[768:1280, 768:1280], scale)
+        assert np.abs(patch - expected).max() <= 2
+
+        region = _get_patch_(pyramid, 1024, 1024, patch_size=[512, 512], scale=scale)
+        assert region.size == (512 // scale, 512 // scale)
+
+
+@pytest.mark.parametrize('ext', ['.tif', '_tiles'])
+@pytest.mark.parametrize('scale', [4, 8])
+def test_get_patch_heatmap(tmp_path, source, ext, scale):
+    _, heatmap = source
+    fn = str(tmp_path / ('heatmap' + ext))
+    write_pyramid(heatmap, fn, tile_size=256, reduce='mean')
+    with PyramidReader(fn) as pyramid:
+        patch = _get_patch_(pyramid, 1024, 1024, patch_size=[512, 512], scale=scale,
+                            resampler='auto')
+        assert patch.shape == (512 // scale, 512 // scale, 2) and patch.dtype == np.float16
+        expected = _box_(heatmap[768:1280, 768:1280].astype(np.float32), scale)
+        assert np.abs(patch.astype(np.float32) - expected).max() < 1e-2
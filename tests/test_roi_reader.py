@@ -0,0 +1,17 @@
+from slideslicer.roi_reader import RoiReader
+
+
+def test_tissue_rois_with_cache(tmp_path, slide_file):
+    cache_dir = str(tmp_path / 'cache')
+    tissue = []
+    for _ in range(2):
+        # a cache miss, then a hit
+        reader = RoiReader(slide_file, save=False, verbose=False, cache_dir=cache_dir)
+        tissue.append(reader.tissue_rois)
+        reader.close()
+    # the empty chunk is removed in both cases
+    assert len(tissue[0]) == len(tissue[1]) == 1
+    assert tissue[0] == tissue[1]
+
+    reader = RoiReader(slide_file, save=False, verbose=False, remove_empty=False)
+    assert len(reader.tissue_rois) == 2
@@ -0,0 +1,23 @@
+import numpy as np
+import pytest
+
+from slideslicer.slideutils import sample_points
+
+CONTOUR = np.array([[100, 100], [900, 150], [950, 700], [400, 800], [120, 600]])
+
+
+@pytest.mark.parametrize('order', [None, 'row', 'serpentine', 'hilbert', 'zorder'])
+@pytest.mark.parametrize('mode', ['grid', 'rotated_grid', 'uniform_random'])
+def test_sample_points_modes(mode, order):
+    points = sample_points(CONTOUR, spacing=50, mode=mode, random_seed=0, order=order)
+    assert points.ndim == 2 and points.shape[1] == 2
+    assert len(points) > 0
+    unordered = sample_points(CONTOUR, spacing=50, mode=mode, random_seed=0)
+    # ordering permutes the same points
+    assert sorted(map(tuple, np.asarray(points).tolist())) == \
+        sorted(map(tuple, np.asarray(unordered).tolist()))
+
+
+def test_sample_points_unknown_mode():
+    with pytest.raises(ValueError):
+        sample_points(CONTOUR, spacing=50, mode='hexagonal')
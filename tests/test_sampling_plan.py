@@ -0,0 +1,18 @@
+import os
+
+from slideslicer.sampling_plan import make_sampling_plan, load_sampling_plan
+from slideslicer.sharding import merge_sampling_plans
+
+
+def test_plan_filename_without_extension(tmp_path):
+    fn = str(tmp_path / 'plan')
+    make_sampling_plan(fn, [str(tmp_path / 'missing.svs')], class_names=['glom'])
+    assert sorted(os.listdir(str(tmp_path))) == ['plan.npy', 'plan.npy.meta.json']
+    for name in (fn, fn + '.npy'):
+        plan, meta = load_sampling_plan(name)
+        assert len(plan) == 0 and meta['class_names'] == ['glom']
+
+    merged = str(tmp_path / 'merged')
+    merge_sampling_plans([fn], merged)
+    plan, meta = load_sampling_plan(merged + '.npy')
+    assert len(plan) == 0 and meta['class_names'] == ['glom']
@@ -0,0 +1,52 @@
+import os
+import time
+import pytest
+
+from slideslicer.sharding import WorkQueue, run_sharded
+from slideslicer.sampling_plan import make_sampling_plan
+
+ITEMS = ['a.svs', 'b.svs', 'c.svs']
+
+
+def test_failed_plan_is_released(tmp_path):
+    queue = WorkQueue(str(tmp_path / 'work'), ITEMS, costs=[1, 1, 1])
+
+    def plan_(item):
+        fnplan = str(tmp_path / (item + '.npy'))
+        plan = make_sampling_plan(fnplan, [str(tmp_path / item)], skip_errors=False)
+        return {'windows': len(plan)}
+
+    finished, failed = run_sharded(plan_, queue, 0)
+    assert finished == [] and failed == ITEMS
+    assert not any(queue.is_done(item) or queue.is_claimed(item) for item in ITEMS)
+    assert not any(os.path.exists(str(tmp_path / (item + '.npy'))) for item in ITEMS)
+
+
+def test_skip_errors(tmp_path):
+    fnplan = str(tmp_path / 'plan.npy')
+    plan = make_sampling_plan(fnplan, [str(tmp_path / 'missing.svs')])
+    assert len(plan) == 0 and os.path.exists(fnplan)
+    with pytest.raises(RuntimeError):
+        make_sampling_plan(fnplan, [str(tmp_path / 'missing.svs')], skip_errors=False)
+
+
+def test_stale_claims(tmp_path):
+    work_dir = str(tmp_path / 'work')
+    dead = WorkQueue(work_dir, ITEMS, costs=[3, 2, 1], node='dead')
+    assert dead.next_item(0) == 'a.svs'
+    assert dead.next_item(0) == 'b.svs'
+    dead.mark_done('b.svs')
+    # both claims are an hour old
+    for item in ('a.svs', 'b.svs'):
+        past = time.time() - 3600
+        os.utime(dead._path_(item, 'claim'), (past, past))
+
+    assert WorkQueue(work_dir, ITEMS, costs=[3, 2, 1]).next_item(0) == 'c.svs'
+    queue = WorkQueue(work_dir, ITEMS, costs=[3, 2, 1], node='alive', stale_after=60)
+    # the unfinished item is taken over once, the finished one never
+    assert queue.next_item(0) == 'a.svs'
+    assert queue.next_item(0) is None
+    assert WorkQueue(work_dir, ITEMS, stale_after=60).is_stale('a.svs') is False
+    # no claim files are left aside
+    claims = os.listdir(os.path.join(work_dir, 'claims'))
+    assert len(claims) == 3 and all(fn.endswith('.claim') for fn in claims)